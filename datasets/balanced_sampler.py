@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Sampler
+
+from utils.pyramid import pyramid_level_path
+from utils.shard_store import ShardStore
+
+
+class ClassBalancedSampler(Sampler):
+    """Draws the samples of a classification dataset with the same number of draws per label, grouped by storage.
+
+    Every epoch draws `num_samples` samples (the dataset size by default), split between the labels in proportion to
+    `class_weights` (equal by default), and cycles through the samples of every label in random order. The draws are
+    then ordered by where their images are stored, the shard and offset for sharded images or the folder otherwise,
+    with the shards or folders in random order, and cut into windows of `window` draws. Windows are yielded in random
+    order and shuffled inside, so the batches of a window read neighbouring images while every label keeps its share.
+    """
+
+    def __init__(self, dataset, num_samples=None, class_weights=None, window=256, generator=None):
+        super().__init__()
+        self.dataset = dataset
+        self.num_samples = num_samples if num_samples is not None else len(dataset)
+        self.window = window
+        self.generator = generator
+        labels = np.asarray(dataset.labels)
+        self.__label_indices = [np.flatnonzero(labels == label) for label in range(len(dataset.label_list))]
+        weights = np.array([(class_weights or {}).get(label, 1.0) for label in dataset.label_list], dtype=np.float64)
+        # Labels without samples, e.g. NORMAL which only the patch transform assigns, are not drawn
+        weights[[len(indices) == 0 for indices in self.__label_indices]] = 0
+        if weights.sum() == 0:
+            raise Exception('No label with samples to draw.')
+        self.__label_draws = self.__split(self.num_samples, weights)
+        self.__groups, self.__positions = self.__storage_locations(dataset)
+
+    @staticmethod
+    def __split(num_samples, weights):
+        # Largest remainder rounding, so that the draws add up to num_samples
+        shares = num_samples * weights / weights.sum()
+        draws = np.floor(shares).astype(np.int64)
+        remainder = num_samples - draws.sum()
+        draws[np.argsort(draws - shares, kind='stable')[:remainder]] += 1
+        return draws
+
+    @staticmethod
+    def __storage_locations(dataset):
+        # Storage group of every sample, and its position inside the group
+        records = dataset.records
+        codes = records.codes('image_path')
+        paths = records.categories('image_path')
+        if dataset.shard_path is not None:
+            store = ShardStore(dataset.shard_path)
+            entries = [store.entry(pyramid_level_path(path, dataset.pyramid_factor)) or (-1, 0) for path in paths]
+            groups = np.array([entry[0] for entry in entries], dtype=np.int64)
+            positions = np.array([entry[1] for entry in entries], dtype=np.int64)
+        else:
+            groups, _ = pd.factorize(np.array([os.path.dirname(path) for path in paths], dtype=object))
+            positions = np.argsort(np.argsort(np.asarray(paths, dtype=str), kind='stable'))
+        return groups[codes], positions[codes]
+
+    def __draws(self):
+        draws = []
+        for indices, num_draws in zip(self.__label_indices, self.__label_draws):
+            if num_draws == 0:
+                continue
+            # Every sample of a label is drawn once before any is drawn again
+            cycles = [torch.randperm(len(indices), generator=self.generator).numpy()
+                      for _ in range(-(-num_draws // len(indices)))]
+            draws.append(indices[np.concatenate(cycles)[:num_draws]])
+        return np.concatenate(draws)
+
+    def __iter__(self):
+        draws = self.__draws()
+        group_ranks = torch.randperm(int(self.__groups.max()) + 2, generator=self.generator).numpy()
+        ties = torch.randperm(len(draws), generator=self.generator).numpy()
+        draws = draws[ties]
+        draws = draws[np.lexsort((self.__positions[draws], group_ranks[self.__groups[draws] + 1]))]
+        windows = [draws[start:start + self.window] for start in range(0, len(draws), self.window)]
+        for window_index in torch.randperm(len(windows), generator=self.generator).tolist():
+            window = windows[window_index]
+            yield from window[torch.randperm(len(window), generator=self.generator).numpy()].tolist()
+
+    def __len__(self):
+        return self.num_samples
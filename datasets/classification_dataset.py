@@ -1,3 +1,5 @@
+import numpy as np
+
 from datasets.generic_dataset import CBISDDSMGenericDataset
 
 
@@ -11,7 +13,15 @@ class CBISDDSMClassificationDataset(CBISDDSMGenericDataset):
                  train_image_transform=None,
                  train_image_transform_for_mask_flags=None,
                  test_image_transform=None,
-                 test_image_transform_for_mask_flags=None):
+                 test_image_transform_for_mask_flags=None,
+                 tiled=False,
+                 shard_path=None,
+                 train_batch_transform=None,
+                 train_batch_transform_for_mask_flags=None,
+                 test_batch_transform=None,
+                 test_batch_transform_for_mask_flags=None,
+                 image_cache=None,
+                 pyramid_factor=1):
         super().__init__(dataframe,
                          download_path,
                          masks=masks,
@@ -19,18 +29,32 @@ class CBISDDSMClassificationDataset(CBISDDSMGenericDataset):
                          train_image_transform=train_image_transform,
                          train_image_transform_for_mask_flags=train_image_transform_for_mask_flags,
                          test_image_transform=test_image_transform,
-                         test_image_transform_for_mask_flags=test_image_transform_for_mask_flags)
+                         test_image_transform_for_mask_flags=test_image_transform_for_mask_flags,
+                         tiled=tiled,
+                         shard_path=shard_path,
+                         train_batch_transform=train_batch_transform,
+                         train_batch_transform_for_mask_flags=train_batch_transform_for_mask_flags,
+                         test_batch_transform=test_batch_transform,
+                         test_batch_transform_for_mask_flags=test_batch_transform_for_mask_flags,
+                         image_cache=image_cache,
+                         pyramid_factor=pyramid_factor)
 
         self.label_field = label_field
         self.label_list = label_list
+        self.__label_index = {label: i for i, label in enumerate(label_list)}
+        self._item_fields = tuple(self._item_fields) + (label_field,)
+        self.labels = np.array([self.__label_index[label] for label in self.records.column(label_field)],
+                               dtype=np.int64)
 
-    def __getitem__(self, idx):
-        image_tensor, item = super().__getitem__(idx)
+    def _item(self, idx):
+        return self._variant(idx, self.records.item(idx, self._item_fields))
 
+    def _target(self, item):
+        # Patch transforms may relabel the sample (e.g. as NORMAL)
         label_full = item[self.label_field]
-        label = self.label_list.index(label_full)
+        label = self.__label_index[label_full]
 
-        return image_tensor, label
+        return label
 
     def _get_label_visualize(self, label):
         label = self.label_list[label]
@@ -40,43 +64,40 @@ class CBISDDSMClassificationDataset(CBISDDSMGenericDataset):
     def num_classes(self):
         return len(self.label_list)
 
-    def split_train_val(self, val_ratio, shuffle=False, random_state=None):
-        df1, df2 = self._split_dataframe(val_ratio, shuffle, random_state)
-        val_dataset = CBISDDSMClassificationDataset(df2, self.download_path, self.label_field, self.label_list,
-                                                    masks=self.include_masks, transform=self.transform,
-                                                    train_image_transform=self._train_image_transforms,
-                                                    train_image_transform_for_mask_flags=self._train_image_transform_for_mask_flags,
-                                                    test_image_transform=self._test_image_transforms,
-                                                    test_image_transform_for_mask_flags=self._test_image_transform_for_mask_flags)
+    def _subset(self, records):
+        # Splits are views of the records of this dataset with the same settings
+        return CBISDDSMClassificationDataset(records, self.download_path, self.label_field, self.label_list,
+                                             masks=self.include_masks, transform=self.transform,
+                                             train_image_transform=self._train_image_transforms,
+                                             train_image_transform_for_mask_flags=self._train_image_transform_for_mask_flags,
+                                             test_image_transform=self._test_image_transforms,
+                                             test_image_transform_for_mask_flags=self._test_image_transform_for_mask_flags,
+                                             tiled=self.tiled,
+                                             shard_path=self.shard_path,
+                                             train_batch_transform=self._train_batch_transforms,
+                                             train_batch_transform_for_mask_flags=self._train_batch_transform_for_mask_flags,
+                                             test_batch_transform=self._test_batch_transforms,
+                                             test_batch_transform_for_mask_flags=self._test_batch_transform_for_mask_flags,
+                                             image_cache=self.image_cache,
+                                             pyramid_factor=self.pyramid_factor)
+
+    def split_train_val(self, val_ratio, shuffle=False, random_state=None, group_by='patient_id', stratify=False):
+        records1, records2 = self._split_records(val_ratio, shuffle, random_state, group_by,
+                                                 self.label_field if stratify else None)
+        val_dataset = self._subset(records2)
         val_dataset.test_mode()
-        train_dataset = CBISDDSMClassificationDataset(df1, self.download_path, self.label_field, self.label_list,
-                                                      masks=self.include_masks, transform=self.transform,
-                                                      train_image_transform=self._train_image_transforms,
-                                                      train_image_transform_for_mask_flags=self._train_image_transform_for_mask_flags,
-                                                      test_image_transform=self._test_image_transforms,
-                                                      test_image_transform_for_mask_flags=self._test_image_transform_for_mask_flags)
+        train_dataset = self._subset(records1)
         train_dataset.train_mode()
         return train_dataset, val_dataset
 
-    def split_crossval(self, folds, shuffle=False, random_state=None):
-        dataframe_pairs = self._split_dataframe_crossval(folds, shuffle, random_state)
+    def split_crossval(self, folds, shuffle=False, random_state=None, group_by='patient_id', stratify=False):
+        records_pairs = self._split_records_crossval(folds, shuffle, random_state, group_by,
+                                                     self.label_field if stratify else None)
         dataset_pairs = []
-        for i in range(folds):
-            train_dataset = CBISDDSMClassificationDataset(dataframe_pairs[i][0], self.download_path, self.label_field,
-                                                          self.label_list,
-                                                          masks=self.include_masks, transform=self.transform,
-                                                          train_image_transform=self._train_image_transforms,
-                                                          train_image_transform_for_mask_flags=self._train_image_transform_for_mask_flags,
-                                                          test_image_transform=self._test_image_transforms,
-                                                          test_image_transform_for_mask_flags=self._test_image_transform_for_mask_flags)
+        for train_records, val_records in records_pairs:
+            train_dataset = self._subset(train_records)
             train_dataset.train_mode()
-            val_dataset = CBISDDSMClassificationDataset(dataframe_pairs[i][1], self.download_path, self.label_field,
-                                                        self.label_list,
-                                                        masks=self.include_masks, transform=self.transform,
-                                                        train_image_transform=self._train_image_transforms,
-                                                        train_image_transform_for_mask_flags=self._train_image_transform_for_mask_flags,
-                                                        test_image_transform=self._test_image_transforms,
-                                                        test_image_transform_for_mask_flags=self._test_image_transform_for_mask_flags)
+            val_dataset = self._subset(val_records)
             val_dataset.test_mode()
             dataset_pairs.append((train_dataset, val_dataset))
         return dataset_pairs
@@ -1,29 +1,64 @@
+import multiprocessing
 import os
+import time
 from typing import List, Union, Tuple
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # Workaround found in: https://stackoverflow.com/questions/42462431/oserror-broken-data-stream-when-reading-image-file
 import torch
 from matplotlib import pyplot as plt
-from torchvision.transforms import functional as F
 from torchvision.transforms import Compose
 import pandas as pd
+import numpy as np
+import cv2
+
+from datasets.image_cache import SharedImageCache
+from datasets.image_sources import TiledImageSource, ArrayImageSource, materialize
+from datasets.profiling import DatasetProfiler, SampleTrace
+from datasets.sample_records import SampleRecords
+from transforms.batch_transforms import BatchAugmentation
+from utils.pyramid import pyramid_level_path
+from utils.shard_store import ShardStore
+from utils.tiled_image import tiled_image_path
+
+# Attributes used by the patch transforms, which are read for every sample
+TRANSFORM_FIELDS = ('image_path', 'mask_path', 'pathology',
+                    'minx', 'maxx', 'miny', 'maxy', 'cx', 'cy',
+                    'breast_minx', 'breast_maxx', 'breast_miny', 'breast_maxy', 'breast_cx', 'breast_cy')
+
 
 class CBISDDSMGenericDataset(Dataset):
     def __init__(self,
-                 dataframe: pd.DataFrame,
+                 dataframe: Union[pd.DataFrame, SampleRecords],
                  download_path: str,
                  masks: bool = False,
                  transform: Compose = None,
                  train_image_transform: Union[List[torch.nn.Module], Tuple[torch.nn.Module]] = None,
                  train_image_transform_for_mask_flags=None,
                  test_image_transform: Union[List[torch.nn.Module], Tuple[torch.nn.Module]] = None,
-                 test_image_transform_for_mask_flags=None):
-        self.dataframe: pd.DataFrame = dataframe
+                 test_image_transform_for_mask_flags=None,
+                 tiled: bool = False,
+                 shard_path: str = None,
+                 train_batch_transform: Union[List[torch.nn.Module], Tuple[torch.nn.Module]] = None,
+                 train_batch_transform_for_mask_flags=None,
+                 test_batch_transform: Union[List[torch.nn.Module], Tuple[torch.nn.Module]] = None,
+                 test_batch_transform_for_mask_flags=None,
+                 image_cache: SharedImageCache = None,
+                 pyramid_factor: int = 1):
+        self.records: SampleRecords = dataframe if isinstance(dataframe, SampleRecords) else SampleRecords(dataframe)
+        self._item_fields: Tuple[str] = TRANSFORM_FIELDS
         self.download_path: str = download_path
         self.transform: Compose = transform
         self.include_masks: bool = masks
+        self.tiled: bool = tiled
+        self.shard_path: str = shard_path
+        self.__shard_store = ShardStore(shard_path) if shard_path is not None else None
+        self.image_cache: SharedImageCache = image_cache
+        # Images are read from the pyramid level downsampled by this factor, to which the coordinates are scaled
+        self.pyramid_factor: int = pyramid_factor
+        self.profiler: DatasetProfiler = None
+        self.__epoch = multiprocessing.RawValue('q', 0)
         self.current_index: int = 0
         self.__train_mode: bool = True
         self.__test_mode: bool = False
@@ -31,27 +66,93 @@ class CBISDDSMGenericDataset(Dataset):
         self._train_image_transform_for_mask_flags = train_image_transform_for_mask_flags
         self._test_image_transforms = test_image_transform
         self._test_image_transform_for_mask_flags = test_image_transform_for_mask_flags
+        self._train_batch_transforms = train_batch_transform
+        self._train_batch_transform_for_mask_flags = train_batch_transform_for_mask_flags
+        self._test_batch_transforms = test_batch_transform
+        self._test_batch_transform_for_mask_flags = test_batch_transform_for_mask_flags
+        self.__train_batch_augmentation = BatchAugmentation(train_batch_transform,
+                                                            train_batch_transform_for_mask_flags) \
+            if train_batch_transform else None
+        self.__test_batch_augmentation = BatchAugmentation(test_batch_transform,
+                                                           test_batch_transform_for_mask_flags) \
+            if test_batch_transform else None
+
+    @property
+    def dataframe(self) -> pd.DataFrame:
+        return self.records.to_dataframe()
 
     def __getitem__(self, index):
-        item = self.dataframe.iloc[index].to_dict()
-        img_path = os.path.join(self.download_path, item['image_path'])
-        image = Image.open(img_path)
-        max_value = 65536 if image.mode == 'I' else 256
-        image_tensor = F.pil_to_tensor(image).float()
-        image_tensor /= max_value
-        image_tensor_list = [image_tensor]
+        image_tensor_list, item = self._load_sample(self._item(index))
+        return image_tensor_list, self._target(item)
+
+    def _item(self, index):
+        item = self._variant(index, self.records.item(index))
+        item.pop('variants', None)
+        return item
+
+    def _variant(self, index, item):
+        # Cached datasets may hold several renderings of every lesion, of which one is read per epoch
+        if 'variants' not in self.records:
+            return item
+        variants = self.records.value('variants', index)
+        # Every variant is read once in len(variants) epochs, starting from an offset that differs between lesions
+        offset = (index * 2654435761) % 2 ** 32
+        item.update(variants[(offset + self.__epoch.value) % len(variants)])
+        return item
+
+    def set_epoch(self, epoch: int):
+        # The epoch is shared with the DataLoader workers, persistent ones included
+        self.__epoch.value = epoch
+
+    @property
+    def epoch(self) -> int:
+        return self.__epoch.value
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Spawned DataLoader workers share the epoch, while pickle and deepcopy keep its value in a new one
+        if multiprocessing.context.get_spawning_popen() is None:
+            state['_CBISDDSMGenericDataset__epoch'] = self.__epoch.value
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.__epoch, int):
+            self.__epoch = multiprocessing.RawValue('q', self.__epoch)
+
+    def _target(self, item):
+        return item
+
+    def metadata(self, index):
+        return self.records.item(index)
+
+    def _load_sample(self, item, image=None, mask=None):
+        # Stages are only timed while profiling, so that the default path carries no instrumentation
+        trace = SampleTrace() if self.profiler is not None else None
+        if trace is not None:
+            sample_start = time.perf_counter()
+
+        if image is None:
+            image = self._load_image(item['image_path'], trace=trace)
+        image_tensor_list = [image]
 
         if self.include_masks:
-            mask_img_path = os.path.join(self.download_path, item['mask_path'])
-            mask_image = Image.open(mask_img_path)
-            mask_image_tensor = F.pil_to_tensor(mask_image).float()
-            mask_image_tensor /= 255
-            image_tensor_list.append(mask_image_tensor)
+            if mask is None:
+                mask = self._load_image(item['mask_path'], max_value=255, trace=trace)
+            image_tensor_list.append(mask)
 
         sample = {'image_tensor_list': image_tensor_list, 'item': item}
 
+        if trace is not None:
+            start = time.perf_counter()
         if self.transform is not None:
             sample = self.transform(sample)
+        if trace is not None:
+            start = trace.add('patch_transform', start)
+
+        sample['image_tensor_list'] = [materialize(image) for image in sample['image_tensor_list']]
+        if trace is not None:
+            start = trace.add('materialize', start)
 
         if self.__train_mode and self._train_image_transforms is not None:
             for transform, mask_flag in zip(self._train_image_transforms, self._train_image_transform_for_mask_flags):
@@ -72,10 +173,79 @@ class CBISDDSMGenericDataset(Dataset):
         else:
             raise Exception("No train/test mode selected")
 
+        if trace is not None:
+            trace.add('image_transforms', start)
+            # Lazy images read their pixels during the patch transform or materialisation
+            trace.bytes_read += sum(getattr(image, 'bytes_read', 0) for image in image_tensor_list)
+            trace.add('sample', sample_start)
+            self.profiler.add(trace)
+
         return sample['image_tensor_list'], sample['item']
 
+    def enable_profiling(self, summary_every: int = None, trace_dir: str = None):
+        # Must be called before the DataLoader starts its workers, which share the profiler counters
+        self.profiler = DatasetProfiler(summary_every=summary_every, trace_dir=trace_dir)
+        return self
+
+    def disable_profiling(self):
+        self.profiler = None
+        return self
+
+    def augment_batch(self, image_batch_list):
+        augmentation = self.__train_batch_augmentation if self.__train_mode else self.__test_batch_augmentation
+        if augmentation is not None:
+            image_batch_list = augmentation(image_batch_list)
+        return image_batch_list
+
+    def collate_fn(self, batch):
+        image_batch_list, target = default_collate(batch)
+        return self.augment_batch(image_batch_list), target
+
+    def _load_image(self, path, max_value=None, trace=None):
+        path = pyramid_level_path(path, self.pyramid_factor)
+        if self.__shard_store is not None:
+            return self._array_image(self.__shard_store.get(path), max_value=max_value)
+
+        img_path = os.path.join(self.download_path, path)
+        if img_path.endswith('.npy'):
+            # Float caches are stored already normalised
+            return ArrayImageSource(np.load(img_path, mmap_mode='c'), max_value=1)
+        if self.tiled:
+            # Decoding is deferred until the patch transform requests a window
+            return TiledImageSource(tiled_image_path(img_path), max_value=max_value)
+        if self.image_cache is not None:
+            return ArrayImageSource(self.image_cache.get(img_path, lambda: self.__decode(img_path)),
+                                    max_value=max_value)
+
+        if trace is not None:
+            start = time.perf_counter()
+            trace.bytes_read += os.path.getsize(img_path)
+        # The integer pixels are kept, and only the window the patch transform crops is converted to float
+        image = ArrayImageSource(self.__decode(img_path), max_value=max_value)
+        if trace is not None:
+            trace.add('decode', start)
+        return image
+
+    @staticmethod
+    def _array_image(array, max_value=None):
+        # Float arrays, e.g. of float caches, are stored already normalised
+        return ArrayImageSource(array, max_value=1 if array.dtype.kind == 'f' else max_value)
+
+    @staticmethod
+    def __decode(img_path):
+        # OpenCV decodes 16-bit PNG files straight to uint16, PIL remains for the files it cannot read
+        array = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+        if array is not None and array.ndim == 2:
+            return array
+        image = Image.open(img_path)
+        array = np.array(image)
+        if image.mode == 'I':
+            # Older Pillow versions open 16-bit images as 32-bit integers
+            array = array.astype(np.uint16)
+        return array
+
     def __len__(self):
-        return len(self.dataframe.index)
+        return len(self.records)
 
     def __iter__(self):
         self.current_index = 0
@@ -105,43 +275,55 @@ class CBISDDSMGenericDataset(Dataset):
         self.__test_mode = True
         return self
 
-    def _split_dataframe(self, split_ratio, shuffle=False, random_state=None):
-        if shuffle:
-            dataframe = self.dataframe.sample(frac=1, random_state=random_state)
+    def _split_indices(self, shares, shuffle=False, random_state=None, group_by='patient_id', stratify_by=None):
+        # Rows of a group (e.g. the views of a patient) fall in the same part, whose size, and label counts if
+        # stratified, follow its share
+        num_samples = len(self.records)
+        if group_by is not None and group_by in self.records:
+            _, groups = np.unique(self.records.codes(group_by), return_inverse=True)
         else:
-            dataframe = self.dataframe
-
-        num_samples = len(dataframe.index)
-        num_samples1 = int(num_samples * split_ratio)
-
-        dataframe1 = dataframe.iloc[num_samples1:, :]
-        dataframe2 = dataframe.iloc[:num_samples1, :]
-
-        return dataframe1, dataframe2
-
-    def _split_dataframe_crossval(self, folds, shuffle=False, random_state=None):
-        if shuffle:
-            dataframe = self.dataframe.sample(frac=1, random_state=random_state)
+            groups = np.arange(num_samples)
+        if stratify_by is not None:
+            _, labels = np.unique(self.records.codes(stratify_by), return_inverse=True)
         else:
-            dataframe = self.dataframe
+            labels = np.zeros(num_samples, dtype=np.int64)
+        num_groups = int(groups.max()) + 1 if num_samples > 0 else 0
+        group_counts = np.zeros((num_groups, int(labels.max()) + 1 if num_samples > 0 else 1))
+        np.add.at(group_counts, (groups, labels), 1)
 
-        num_samples = len(dataframe.index)
-        num_sample_per_fold = int(num_samples / folds)
+        order = np.random.RandomState(random_state).permutation(num_groups) if shuffle else np.arange(num_groups)
+        # Largest groups are placed first, which leaves the small ones to even out the parts
+        order = order[np.argsort(-group_counts[order].sum(axis=1), kind='stable')]
+        targets = np.outer(shares, group_counts.sum(axis=0))
+        counts = np.zeros_like(targets)
+        parts = np.empty(num_groups, dtype=np.int64)
+        for group in order:
+            group_count = group_counts[group]
+            cost = ((counts + group_count - targets) ** 2 - (counts - targets) ** 2).sum(axis=1)
+            parts[group] = np.argmin(cost)
+            counts[parts[group]] += group_count
 
-        fold_dataframes = []
-        for i in range(folds):
-            start_i = i * num_sample_per_fold
-            end_i = (i + 1) * num_sample_per_fold
-            fold_dataframe = dataframe.iloc[start_i:end_i, :]
-            fold_dataframes.append(fold_dataframe)
+        row_parts = parts[groups]
+        return [np.flatnonzero(row_parts == part) for part in range(len(shares))]
 
-        cv_dataframe_pairs = []
-        for i in range(folds):
-            train_dataframe = pd.concat(list(d for ind, d in enumerate(fold_dataframes) if ind != i), ignore_index=True)
-            val_dataframe = fold_dataframes[i]
-            cv_dataframe_pairs.append((train_dataframe, val_dataframe))
+    def _split_records(self, split_ratio, shuffle=False, random_state=None, group_by='patient_id',
+                       stratify_by=None):
+        indices1, indices2 = self._split_indices((1 - split_ratio, split_ratio), shuffle, random_state, group_by,
+                                                 stratify_by)
+        return self.records.view(indices1), self.records.view(indices2)
 
-        return cv_dataframe_pairs
+    def _split_records_crossval(self, folds, shuffle=False, random_state=None, group_by='patient_id',
+                                stratify_by=None):
+        fold_indices = self._split_indices(np.full(folds, 1 / folds), shuffle, random_state, group_by, stratify_by)
+        num_empty = sum(1 for indices in fold_indices if len(indices) == 0)
+        if num_empty > 0:
+            raise ValueError(f'{num_empty} of {folds} folds are empty, as there are fewer groups than folds. '
+                             f'Please select fewer folds.')
+        cv_records_pairs = []
+        for i in range(folds):
+            train_indices = np.sort(np.concatenate([indices for ind, indices in enumerate(fold_indices) if ind != i]))
+            cv_records_pairs.append((self.records.view(train_indices), self.records.view(fold_indices[i])))
+        return cv_records_pairs
 
     def visualize(self):
         if self.include_masks:
@@ -0,0 +1,125 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+_HITS, _MISSES, _EVICTIONS, _BYTES, _ENTRIES = range(5)
+
+
+def _shared_memory_dir():
+    # tmpfs is backed by memory, and its pages are shared by every process mapping a file
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def _remove(path, owner_pid):
+    if os.getpid() == owner_pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class SharedImageCache:
+    """Decoded images kept in shared memory, evicted least recently used beyond a byte budget.
+
+    Entries are .npy files in a tmpfs folder, memory-mapped by the readers, so all DataLoader workers of the node
+    share them. The lock and counters are inherited by the workers, and the folder is removed with the cache.
+    """
+
+    def __init__(self, max_bytes, root=None):
+        self.max_bytes = int(max_bytes)
+        self.root = tempfile.mkdtemp(prefix='cbis_ddsm_images_', dir=root if root is not None else _shared_memory_dir())
+        self.__lock = multiprocessing.Lock()
+        self.__counters = multiprocessing.RawArray('q', 5)
+        self.__finalizer = weakref.finalize(self, _remove, self.root, os.getpid())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Only the creating process removes the folder
+        del state['_SharedImageCache__finalizer']
+        return state
+
+    def __path(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, key, load):
+        path = self.__path(key)
+        try:
+            array = np.load(path, mmap_mode='c')
+        except FileNotFoundError:
+            array = None
+        if array is not None:
+            try:
+                # The modification time orders the entries for eviction
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            with self.__lock:
+                self.__counters[_HITS] += 1
+            return array
+
+        array = load()
+        with self.__lock:
+            self.__counters[_MISSES] += 1
+        if array.nbytes > self.max_bytes:
+            return array
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fout:
+            np.save(fout, array)
+        size = os.path.getsize(tmp_path)
+        with self.__lock:
+            if os.path.exists(path):
+                # Another worker stored the same image meanwhile
+                os.remove(tmp_path)
+                return array
+            os.replace(tmp_path, path)
+            self.__counters[_BYTES] += size
+            self.__counters[_ENTRIES] += 1
+            if self.__counters[_BYTES] > self.max_bytes:
+                self.__evict(path)
+        return array
+
+    def __evict(self, keep_path):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.npy') and entry.path != keep_path:
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+        for _, size, path in entries:
+            if self.__counters[_BYTES] <= self.max_bytes:
+                break
+            # Readers holding a memory map of the file keep their pages until they release it
+            os.remove(path)
+            self.__counters[_BYTES] -= size
+            self.__counters[_ENTRIES] -= 1
+            self.__counters[_EVICTIONS] += 1
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.__counters[_HITS], 'misses': self.__counters[_MISSES],
+                    'evictions': self.__counters[_EVICTIONS], 'bytes': self.__counters[_BYTES],
+                    'entries': self.__counters[_ENTRIES]}
+
+    def reset_stats(self):
+        with self.__lock:
+            self.__counters[_HITS] = 0
+            self.__counters[_MISSES] = 0
+            self.__counters[_EVICTIONS] = 0
+
+    def clear(self):
+        with self.__lock:
+            for entry in os.scandir(self.root):
+                if entry.name.endswith('.npy'):
+                    os.remove(entry.path)
+            self.__counters[_BYTES] = 0
+            self.__counters[_ENTRIES] = 0
+
+    def close(self):
+        finalizer = self.__dict__.get('_SharedImageCache__finalizer')
+        if finalizer is not None:
+            finalizer()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(max_bytes={self.max_bytes})"
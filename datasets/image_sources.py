@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+
+from utils.tiled_image import TiledImage
+
+
+def _max_value(dtype):
+    if np.issubdtype(dtype, np.floating):
+        return 1
+    return 65536 if dtype == np.uint16 else 256
+
+
+def _to_tensor(array, max_value):
+    tensor = torch.from_numpy(array).float()
+    tensor /= max_value
+    return tensor.unsqueeze(0)
+
+
+class TiledImageSource:
+    """Lazy image that decodes only the tiles covering a requested window."""
+
+    def __init__(self, path, max_value=None):
+        self.__image = TiledImage(path)
+        self.__max_value = max_value if max_value is not None else _max_value(self.__image.dtype)
+
+    @property
+    def shape(self):
+        return (1,) + self.__image.shape
+
+    @property
+    def bytes_read(self):
+        return self.__image.bytes_read
+
+    def read_window(self, miny, maxy, minx, maxx):
+        return _to_tensor(self.__image.read_window(miny, maxy, minx, maxx), self.__max_value)
+
+    def read(self):
+        return _to_tensor(self.__image.read(), self.__max_value)
+
+
+class ArrayImageSource:
+    """Lazy image over an array, e.g. a memory-mapped shard view, that converts only the requested window."""
+
+    def __init__(self, array, max_value=None):
+        self.__array = array
+        self.__max_value = max_value if max_value is not None else _max_value(array.dtype)
+        self.bytes_read = 0
+
+    @property
+    def shape(self):
+        return (1,) + self.__array.shape
+
+    def read_window(self, miny, maxy, minx, maxx):
+        window = self.__array[max(miny, 0): maxy, max(minx, 0): maxx]
+        self.bytes_read += window.nbytes
+        return _to_tensor(window, self.__max_value)
+
+    def read(self):
+        self.bytes_read += self.__array.nbytes
+        return _to_tensor(self.__array, self.__max_value)
+
+
+def materialize(image):
+    if isinstance(image, torch.Tensor):
+        return image
+    return image.read()
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler, default_collate
+
+MULTI_PATCH_MODES = ('random', 'all_lesions')
+
+
+class CBISDDSMMultiPatchDataset(Dataset):
+    """Yields several patches per decoded mammogram of a lesion dataset.
+
+    Every index is a mammogram. In 'random' mode it yields `patches_per_image` patches of lesions drawn at random
+    from the mammogram, each through the patch transform of the dataset, so a random patch transform wrapped with
+    normal patches gives a mix of lesion and normal patches. In 'all_lesions' mode it yields one patch per lesion.
+    """
+
+    def __init__(self, dataset, patches_per_image=4, mode='random'):
+        if mode not in MULTI_PATCH_MODES:
+            raise ValueError(f'Unknown multi-patch mode {mode}. Choose one of {MULTI_PATCH_MODES}.')
+        self.dataset = dataset
+        self.patches_per_image = patches_per_image
+        self.mode = mode
+        codes = dataset.records.codes('image_path')
+        order = np.argsort(codes, kind='stable')
+        boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+        self.image_lesions = [group for group in np.split(order, boundaries) if len(group) > 0]
+        self.lesion_counts = np.array([len(group) for group in self.image_lesions], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.image_lesions)
+
+    def num_patches(self, index):
+        return self.patches_per_image if self.mode == 'random' else int(self.lesion_counts[index])
+
+    def __getitem__(self, index):
+        lesions = self.image_lesions[index]
+        if self.mode == 'random':
+            lesions = lesions[torch.randint(0, len(lesions), (self.patches_per_image,)).numpy()]
+
+        # The mammogram is decoded once, and every patch crops it
+        image = self.dataset._load_image(self.dataset.records.value('image_path', int(lesions[0])))
+        patches = []
+        for lesion in lesions:
+            image_tensor_list, item = self.dataset._load_sample(self.dataset._item(int(lesion)), image=image)
+            patches.append((image_tensor_list, self.dataset._target(item)))
+        return patches
+
+    def collate_fn(self, batch):
+        image_batch_list, target = default_collate([patch for patches in batch for patch in patches])
+        return self.dataset.augment_batch(image_batch_list), target
+
+
+class MultiPatchBatchSampler(Sampler):
+    """Batches of mammograms of a CBISDDSMMultiPatchDataset that hold about `batch_size` patches.
+
+    In 'random' mode mammograms are drawn with probability proportional to their number of lesions, and an epoch
+    yields about as many patches as there are lesions, as the one patch per lesion dataset. In 'all_lesions' mode
+    every mammogram is used once per epoch.
+    """
+
+    def __init__(self, dataset: CBISDDSMMultiPatchDataset, batch_size, shuffle=True, drop_last=False, generator=None):
+        super().__init__()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __indices(self):
+        counts = self.dataset.lesion_counts
+        if self.dataset.mode == 'random':
+            num_images = math.ceil(counts.sum() / self.dataset.patches_per_image)
+            weights = torch.as_tensor(counts, dtype=torch.double)
+            indices = torch.multinomial(weights, num_images, replacement=True, generator=self.generator)
+            # Without shuffling the drawn mammograms are visited in index order
+            return indices.tolist() if self.shuffle else indices.sort().values.tolist()
+        if self.shuffle:
+            return torch.randperm(len(counts), generator=self.generator).tolist()
+        return list(range(len(counts)))
+
+    def __batches(self, indices):
+        batch, num_patches = [], 0
+        for index in indices:
+            patches = self.dataset.num_patches(index)
+            if len(batch) > 0 and num_patches + patches > self.batch_size:
+                yield batch
+                batch, num_patches = [], 0
+            batch.append(index)
+            num_patches += patches
+        if len(batch) > 0 and (not self.drop_last or num_patches >= self.batch_size):
+            yield batch
+
+    def __iter__(self):
+        return self.__batches(self.__indices())
+
+    def __len__(self):
+        # Exact in 'random' mode. In 'all_lesions' mode the packing depends on the order, so it is an estimate.
+        if self.dataset.mode == 'random':
+            indices = [0] * math.ceil(self.dataset.lesion_counts.sum() / self.dataset.patches_per_image)
+        else:
+            indices = range(len(self.dataset))
+        return sum(1 for _ in self.__batches(indices))
@@ -0,0 +1,109 @@
+import glob
+import json
+import multiprocessing
+import os
+import time
+
+STAGES = ('decode', 'patch_transform', 'materialize', 'image_transforms', 'sample')
+
+
+class SampleTrace:
+    """Stage timings and bytes read while loading one sample."""
+
+    __slots__ = ('events', 'bytes_read')
+
+    def __init__(self):
+        self.events = []
+        self.bytes_read = 0
+
+    def add(self, stage, start):
+        end = time.perf_counter()
+        self.events.append((stage, start, end))
+        return end
+
+
+class DatasetProfiler:
+    """Per-stage wall time and bytes read by a dataset, aggregated over all DataLoader workers.
+
+    The totals are kept in shared memory inherited by the workers, so the profiler must be enabled before the
+    DataLoader starts them. With a trace folder, every process also appends its stage events to its own file, which
+    export_trace() merges into a Chrome trace (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, summary_every=None, trace_dir=None):
+        self.summary_every = summary_every
+        self.trace_dir = trace_dir
+        self.__lock = multiprocessing.Lock()
+        self.__seconds = multiprocessing.RawArray('d', len(STAGES))
+        self.__counts = multiprocessing.RawArray('q', len(STAGES))
+        # Number of samples and bytes read
+        self.__totals = multiprocessing.RawArray('q', 2)
+        self.__trace_file = None
+        self.__trace_pid = None
+        if trace_dir is not None:
+            os.makedirs(trace_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_DatasetProfiler__trace_file'] = None
+        return state
+
+    def __write_trace(self, trace):
+        if self.__trace_pid != os.getpid():
+            # Every worker writes its own file
+            self.__trace_pid = os.getpid()
+            self.__trace_file = open(os.path.join(self.trace_dir, f'trace_{self.__trace_pid}.jsonl'), 'a')
+        for stage, start, end in trace.events:
+            self.__trace_file.write(json.dumps({'name': stage, 'ph': 'X', 'ts': start * 1e6,
+                                                'dur': (end - start) * 1e6, 'pid': self.__trace_pid,
+                                                'tid': self.__trace_pid}) + '\n')
+        self.__trace_file.flush()
+
+    def add(self, trace):
+        with self.__lock:
+            for stage, start, end in trace.events:
+                index = STAGES.index(stage)
+                self.__seconds[index] += end - start
+                self.__counts[index] += 1
+            self.__totals[0] += 1
+            self.__totals[1] += trace.bytes_read
+            num_samples = self.__totals[0]
+        if self.trace_dir is not None:
+            self.__write_trace(trace)
+        if self.summary_every and num_samples % self.summary_every == 0:
+            print(self.summary())
+
+    def stats(self):
+        with self.__lock:
+            stages = {stage: {'seconds': self.__seconds[i], 'count': self.__counts[i]}
+                      for i, stage in enumerate(STAGES) if self.__counts[i] > 0}
+            return {'samples': self.__totals[0], 'bytes_read': self.__totals[1], 'stages': stages}
+
+    def reset(self):
+        with self.__lock:
+            for i in range(len(STAGES)):
+                self.__seconds[i] = 0
+                self.__counts[i] = 0
+            self.__totals[0] = 0
+            self.__totals[1] = 0
+
+    def summary(self):
+        stats = self.stats()
+        num_samples = max(stats['samples'], 1)
+        lines = ['{} samples, {:.1f} MB read ({:.1f} kB per sample)'.format(
+            stats['samples'], stats['bytes_read'] / 1e6, stats['bytes_read'] / num_samples / 1e3)]
+        for stage, values in stats['stages'].items():
+            lines.append('  {:<18}{:>10.1f} ms/sample{:>10.1f} s total'.format(
+                stage, values['seconds'] / num_samples * 1e3, values['seconds']))
+        return os.linesep.join(lines)
+
+    def export_trace(self, path):
+        if self.trace_dir is None:
+            raise Exception('The profiler was created without a trace folder.')
+        events = []
+        for trace_path in sorted(glob.glob(os.path.join(self.trace_dir, 'trace_*.jsonl'))):
+            with open(trace_path) as fin:
+                events.extend(json.loads(line) for line in fin if line.strip())
+        with open(path, 'w') as fout:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fout)
+        return len(events)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from utils.packed_strings import PackedStrings
+
+
+class SampleRecords:
+    """Per-sample attributes stored column-wise in typed numpy arrays.
+
+    Numeric columns keep their values, list columns are stored as JSON strings and every other column is
+    integer-encoded against a table of its distinct values. Strings are packed in byte buffers rather than held as
+    Python objects, whose reference counts would copy the pages shared with forked workers. A view selects rows of
+    other records by index and shares their arrays.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame):
+        self.columns = list(dataframe.columns)
+        self.__arrays = {}
+        self.__categories = {}
+        for column in self.columns:
+            series = dataframe[column]
+            if pd.api.types.is_integer_dtype(series.dtype):
+                self.__arrays[column] = pd.to_numeric(series, downcast='integer').to_numpy()
+            elif pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+                self.__arrays[column] = series.to_numpy()
+            elif len(series.index) > 0 and isinstance(series.iloc[0], (list, np.ndarray)):
+                # Every row indexes its own entry of the table
+                self.__arrays[column] = np.arange(len(series.index), dtype=np.int32)
+                self.__categories[column] = PackedStrings.from_values(series)
+            else:
+                codes, categories = pd.factorize(series, use_na_sentinel=True)
+                self.__arrays[column] = codes.astype(np.int32)
+                if all(isinstance(category, str) for category in categories):
+                    self.__categories[column] = PackedStrings(categories)
+                else:
+                    self.__categories[column] = np.asarray(categories, dtype=object)
+        self.__length = len(dataframe.index)
+        self.__indices = None
+
+    @classmethod
+    def _from_arrays(cls, columns, arrays, categories, length, indices=None):
+        records = cls.__new__(cls)
+        records.columns = columns
+        records._SampleRecords__arrays = arrays
+        records._SampleRecords__categories = categories
+        records._SampleRecords__length = length
+        records._SampleRecords__indices = indices
+        return records
+
+    def __array(self, column):
+        array = self.__arrays[column]
+        return array if self.__indices is None else array[self.__indices]
+
+    def __len__(self):
+        return self.__length
+
+    def __contains__(self, column):
+        return column in self.__arrays
+
+    def is_categorical(self, column):
+        categories = self.__categories.get(column)
+        return categories is not None and not (isinstance(categories, PackedStrings) and categories.is_json)
+
+    def codes(self, column):
+        return self.__array(column)
+
+    def categories(self, column):
+        categories = self.__categories[column]
+        return categories.take(range(len(categories))) if isinstance(categories, PackedStrings) else categories
+
+    def value(self, column, index):
+        if self.__indices is not None:
+            index = self.__indices[index]
+        value = self.__arrays[column][index]
+        categories = self.__categories.get(column)
+        if categories is None:
+            return value.item() if isinstance(value, np.generic) else value
+        return categories[value] if value >= 0 else np.nan
+
+    def column(self, column):
+        array = self.__array(column)
+        categories = self.__categories.get(column)
+        if categories is None:
+            return array
+        indices = np.maximum(array, 0)
+        values = categories.take(indices) if isinstance(categories, PackedStrings) else categories[indices]
+        if (array < 0).any():
+            values[array < 0] = np.nan
+        return values
+
+    def item(self, index, columns=None):
+        if columns is None:
+            columns = self.columns
+        return {column: self.value(column, index) for column in columns if column in self.__arrays}
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.__indices is not None:
+            indices = self.__indices[indices]
+        arrays = {column: array[indices] for column, array in self.__arrays.items()}
+        return self._from_arrays(self.columns, arrays, self.__categories, len(indices))
+
+    def view(self, indices):
+        # Only the row indices are stored, the arrays stay shared with these records
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.__indices is not None:
+            indices = self.__indices[indices]
+        return self._from_arrays(self.columns, self.__arrays, self.__categories, len(indices), indices)
+
+    def to_dataframe(self):
+        return pd.DataFrame({column: self.column(column) for column in self.columns})
@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils.pyramid import pyramid_level_path
+from utils.shard_store import ShardStore
+
+
+class CBISDDSMStreamingDataset(IterableDataset):
+    """Streams the samples of a sharded lesion dataset by reading its shards sequentially.
+
+    Every epoch the shards are visited in a random order and the samples of a shard in the order of their offsets,
+    reading images and masks with plain sequential reads. The stream is split into contiguous parts between the
+    DataLoader workers of all distributed ranks, and shuffled through a buffer of `buffer_size` samples.
+    """
+
+    def __init__(self, dataset, buffer_size=256, shuffle=True, seed=0):
+        if dataset.shard_path is None:
+            raise Exception('Streaming requires sharded images, see .sharded_images() or cache_here(sharded=True).')
+        self.dataset = dataset
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.__store = ShardStore(dataset.shard_path)
+
+    def set_epoch(self, epoch: int):
+        self.dataset.set_epoch(epoch)
+
+    @staticmethod
+    def __consumer():
+        # Position of this worker among the workers of all ranks
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def __entry(self, path):
+        entry = self.__store.entry(pyramid_level_path(path, self.dataset.pyramid_factor))
+        if entry is None:
+            raise FileNotFoundError(f'{path} not found in shard store {self.__store.root}')
+        return entry
+
+    def __order(self, items, generator):
+        # Samples ordered by shard, in random order, and by offset inside a shard
+        entries = [self.__entry(item['image_path']) for item in items]
+        shard_ids = np.array([entry[0] for entry in entries], dtype=np.int64)
+        offsets = np.array([entry[1] for entry in entries], dtype=np.int64)
+        shard_ranks = np.arange(int(shard_ids.max()) + 1 if len(items) > 0 else 0)
+        if self.shuffle:
+            shard_ranks = torch.randperm(len(shard_ranks), generator=generator).numpy()
+        return np.lexsort((offsets, shard_ranks[shard_ids]))
+
+    def __read(self, files, path, max_value=None):
+        shard_id, offset, dtype, shape = self.__entry(path)
+        fin = files.get(shard_id)
+        if fin is None:
+            fin = open(self.__store.shard_file(shard_id), 'rb')
+            files[shard_id] = fin
+        array = np.empty(shape, dtype=np.dtype(dtype))
+        fin.seek(offset)
+        fin.readinto(memoryview(array.reshape(-1)).cast('B'))
+        return self.dataset._array_image(array, max_value=max_value)
+
+    def __samples(self, items):
+        files = {}
+        try:
+            image_path, image = None, None
+            for item in items:
+                # Consecutive lesions of the same mammogram read it once
+                if item['image_path'] != image_path:
+                    image_path, image = item['image_path'], self.__read(files, item['image_path'])
+                mask = self.__read(files, item['mask_path'], max_value=255) if self.dataset.include_masks else None
+                image_tensor_list, item = self.dataset._load_sample(item, image=image, mask=mask)
+                yield image_tensor_list, self.dataset._target(item)
+        finally:
+            for fin in files.values():
+                fin.close()
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.dataset.epoch)
+        items = [self.dataset._item(index) for index in range(len(self.dataset))]
+        order = self.__order(items, generator)
+        consumer, num_consumers = self.__consumer()
+        indices = np.array_split(order, num_consumers)[consumer]
+        samples = self.__samples([items[index] for index in indices])
+        if not self.shuffle:
+            yield from samples
+            return
+
+        # Every worker shuffles its part differently
+        generator.manual_seed(self.seed + self.dataset.epoch * 1000003 + consumer)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            position = int(torch.randint(0, len(buffer), (1,), generator=generator))
+            yield buffer[position]
+            buffer[position] = sample
+        while len(buffer) > 0:
+            yield buffer.pop(int(torch.randint(0, len(buffer), (1,), generator=generator)))
+
+    def __len__(self):
+        # Samples streamed by the workers of this rank, up to one per worker
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        return len(np.array_split(np.arange(len(self.dataset)), world_size)[rank])
+
+    def collate_fn(self, batch):
+        return self.dataset.collate_fn(batch)
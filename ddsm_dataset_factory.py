@@ -1,17 +1,28 @@
-import hashlib
 import json
 import os.path
+import numpy as np
 import pandas as pd
 from typing import List, Dict, Tuple
+from torchvision import transforms
 from torchvision.transforms import Compose
-from tqdm import tqdm
 from datasets.generic_dataset import CBISDDSMGenericDataset
 from transforms.patches_centered import CenteredPatches
 from transforms.patches_random import RandomPatches
-from transforms.patches_normal import normal_patch_transform_wrapper
+from transforms.patches_normal import PatchesNormalWrapper
+from transforms.breast_crop import BreastCrop
 from datasets.classification_dataset import CBISDDSMClassificationDataset
-from PIL import Image
-import numpy as np
+from datasets.image_cache import SharedImageCache
+from utils.ddsm_cache_builder import CBISDDSMCacheBuilder
+from utils.ddsm_cache_store import CBISDDSMCacheStore
+from utils.ddsm_shard_packer import CBISDDSMShardPacker
+from utils.lesion_metadata import filter_lesions
+from utils.normal_patch_index import CBISDDSMNormalIndexBuilder
+from utils.pyramid import read_pyramid_factors
+
+# Image transforms that behave alike at every resolution, so they may precede the resize of a pyramid level
+SCALE_INVARIANT_TRANSFORMS = (transforms.Normalize, transforms.ColorJitter, transforms.ConvertImageDtype,
+                              transforms.RandomHorizontalFlip, transforms.RandomVerticalFlip,
+                              transforms.RandomRotation, transforms.RandomAffine)
 
 class CBISDDSMDatasetFactory:
     def __init__(self,
@@ -33,9 +44,15 @@ class CBISDDSMDatasetFactory:
         self.__image_transform_list_applied_training = []
         self.__image_transform_list_applied_validation = []
         self.__image_transform_list_applied_mask = []
+        self.__image_transform_list_batched = []
         self.__plus_normal = False
         self.__patch_transform_selected = False
+        self.__patch_shape = None
+        self.__patch_transform_builder = None
         self.__from_cache = False
+        self.__tiled = False
+        self.__shard_path = None
+        self.__image_cache = None
 
         if include_masses:
             self.__excluded_values['lesion_type'].remove('mass')
@@ -57,22 +74,13 @@ class CBISDDSMDatasetFactory:
             if self.__test:
                 csv_file_list.append(os.path.join(self.__download_folder, 'lesions_test.csv'))
 
-            self.__dataframe = pd.concat((pd.read_csv(f) for f in csv_file_list), ignore_index=True)
-        except:
+            # Drops, exclusions and mappings are applied in one pass, memoised on the files and the filters
+            self.__dataframe = filter_lesions(csv_file_list, self.__excluded_attrs, self.__excluded_values,
+                                              self.__attribute_mapped_values)
+        except (OSError, ValueError):
             print(f'Database seems not properly set up in folder {self.__config["download_path"]}. Please (re)run setup.py or check the paths in config.json.')
             return
 
-        self.__dataframe.drop(self.__excluded_attrs, axis=1, inplace=True)
-
-        for attribute, value_set in self.__excluded_values.items():
-            self.__dataframe = self.__dataframe.loc[~self.__dataframe[attribute].isin(list(value_set))]
-
-        for attribute, mapping in self.__attribute_mapped_values.items():
-            for v1, v2 in mapping.items():
-                self.__dataframe[attribute].replace(v1, v2, inplace=True)
-
-        self.__dataframe.reset_index(inplace=True, drop=True)
-
     def drop_attribute_values(self, attribute: str, *value_list: str):
         value_set = self.__excluded_values.get(attribute, set())
         for v in value_list:
@@ -106,6 +114,8 @@ class CBISDDSMDatasetFactory:
     def lesion_patches_centered(self, shape: Tuple[int] = (1024, 1024)):
         if self.__patch_transform_selected:
             raise Exception('Patch transform already selected!')
+        self.__patch_shape = tuple(shape)
+        self.__patch_transform_builder = CenteredPatches
         self.__transform_list.append(CenteredPatches(shape))
         self.__patch_transform_selected = True
         return self
@@ -113,72 +123,183 @@ class CBISDDSMDatasetFactory:
     def lesion_patches_random(self, shape: Tuple[int] = (1024, 1024), min_overlap=0.9, normal_probability=0.0):
         if self.__patch_transform_selected:
             raise Exception('Patch transform already selected!')
-        patch_transform = RandomPatches(shape, min_overlap=min_overlap)
-        if normal_probability > 0:
-            self.__plus_normal = True
-            patch_transform = normal_patch_transform_wrapper(patch_transform, normal_probability, shape,
-                                                             1 - min_overlap)
-        self.__transform_list.append(patch_transform)
+
+        def build(patch_shape):
+            patch_transform = RandomPatches(patch_shape, min_overlap=min_overlap)
+            if normal_probability > 0:
+                patch_transform = PatchesNormalWrapper(patch_transform, normal_probability, patch_shape,
+                                                       1 - min_overlap)
+            return patch_transform
+
+        self.__plus_normal = normal_probability > 0
+        self.__patch_shape = tuple(shape)
+        self.__patch_transform_builder = build
+        self.__transform_list.append(build(shape))
         self.__patch_transform_selected = True
         return self
 
-    def cache_here(self):
-        self.__fetch_filter_lesions()
-        cache_name = hashlib.sha1(pd.util.hash_pandas_object(self.__dataframe, index=True).values)
-        for trans in self.__transform_list:
-            cache_name.update(bytes(str(trans), 'utf-8'))
-        for trans in self.__image_transform_list:
-            cache_name.update(bytes(str(trans), 'utf-8'))
-        cache_name = cache_name.hexdigest()
+    def breast_crop(self, margin: float = 0.05, aspect_ratio: float = None, fill: float = 0):
+        # Whole images are cropped to the breast first, so that later transforms only process breast pixels
+        if self.__patch_transform_selected:
+            raise Exception('Patch transform already selected!')
+        self.__transform_list.append(BreastCrop(margin, aspect_ratio, fill))
+        self.__patch_transform_selected = True
+        return self
 
-        cache_path = os.path.join(self.__download_folder, 'cache', cache_name)
-        cache_dataframe_path = os.path.join(cache_path, "dataframe.csv")
+    def tiled_images(self):
+        self.__tiled = True
+        return self
 
-        if os.path.exists(cache_path) and os.path.exists(cache_dataframe_path):
-            self.__dataframe = pd.read_csv(cache_dataframe_path)
+    def sharded_images(self, shard_path: str = None):
+        self.__shard_path = shard_path if shard_path is not None else os.path.join(self.__download_folder, 'shards')
+        return self
+
+    def image_cache(self, max_bytes: int):
+        self.__image_cache = SharedImageCache(max_bytes)
+        return self
 
+    def __output_size(self, masks, applied_flags):
+        # Size of the first resize of the images, if only scale-invariant transforms precede it
+        for trans, for_mask, (for_train, for_val) in zip(self.__image_transform_list,
+                                                         self.__image_transform_list_applied_mask, applied_flags):
+            if isinstance(trans, transforms.Resize):
+                if not for_train or not for_val or (masks and not for_mask):
+                    return None
+                size = trans.size
+                return size[0] if isinstance(size, (list, tuple)) and len(size) == 1 else size
+            if not isinstance(trans, SCALE_INVARIANT_TRANSFORMS):
+                return None
+        return None
+
+    def __pyramid_factor(self, masks, applied_flags):
+        factors = read_pyramid_factors(self.__download_folder) if not self.__from_cache else []
+        output_size = self.__output_size(masks, applied_flags) if len(factors) > 0 else None
+        if output_size is None:
+            return 1
+        if self.__patch_shape is not None:
+            # Patch shapes are given as (width, height)
+            input_shape = (self.__patch_shape[1], self.__patch_shape[0])
+        elif all(column in self.__dataframe.columns for column in ('breast_minx', 'breast_maxx', 'breast_miny',
+                                                                     'breast_maxy')):
+            # The breast bounding box is a lower bound of the size of every mammogram
+            df = self.__dataframe
+            input_shape = (int((df['breast_maxy'] - df['breast_miny']).min()),
+                           int((df['breast_maxx'] - df['breast_minx']).min()))
         else:
-            os.makedirs(cache_path, exist_ok=True)
-            dataset = CBISDDSMGenericDataset(self.__dataframe, self.__download_folder,
-                                             masks=True,
-                                             transform=Compose(self.__transform_list),
-                                             train_image_transform=self.__image_transform_list,
-                                             test_image_transform=self.__image_transform_list)
-
-            counter = 0
-            for a in tqdm(dataset):
-                sample_name = f"{counter:05d}"
-
-                image_name = sample_name + ".png"
-                image_path = os.path.join(cache_path, image_name)
-                image = a[0][0].cpu().detach().numpy().squeeze() * 255
-                img_pil = Image.fromarray(image.astype(np.uint8))
-                img_pil.save(image_path, )
-                self.__dataframe.at[counter, "image_path"] = image_name
-
-                mask_name = sample_name + "_mask.png"
-                mask_path = os.path.join(cache_path, mask_name)
-                mask = a[0][1].cpu().detach().numpy().squeeze() * 255
-                mask_pil = Image.fromarray(mask.astype(np.uint8))
-                mask_pil.save(mask_path)
-                self.__dataframe.at[counter, "mask_path"] = mask_name
-
-                counter += 1
-
-            self.__dataframe.to_csv(cache_dataframe_path)
+            return 1
+        if isinstance(output_size, int):
+            ratio = min(input_shape) / output_size
+        else:
+            ratio = min(input_shape[0] / output_size[0], input_shape[1] / output_size[1])
+        return max([factor for factor in factors if factor <= ratio], default=1)
+
+    def __pyramid_dataframe(self, factor):
+        if factor == 1:
+            return self.__dataframe
+        df = self.__dataframe.copy()
+        for column in ('minx', 'miny', 'breast_minx', 'breast_miny'):
+            df[column] = df[column] // factor
+        # Centres are rounded, so that windows around them stay within half a level pixel of the full-resolution ones
+        for column in ('cx', 'cy', 'breast_cx', 'breast_cy'):
+            df[column] = np.rint(df[column] / factor).astype(int)
+        for column in ('maxx', 'maxy', 'breast_maxx', 'breast_maxy'):
+            df[column] = -(-df[column] // factor)
+        if 'breast_poly' in df.columns:
+            df['breast_poly'] = [(np.array(poly) // factor).tolist() for poly in df['breast_poly']]
+        return df
+
+    def __pyramid_transforms(self, factor):
+        if factor == 1 or self.__patch_transform_builder is None:
+            return self.__transform_list
+        return [self.__patch_transform_builder(tuple(max(int(round(size / factor)), 1)
+                                                     for size in self.__patch_shape))]
+
+    def __index_normal_positions(self, dataset, num_workers=None):
+        # Normal patches are drawn among the origins that avoid every lesion of the mammogram, selected or not
+        wrappers = [trans for trans in dataset.transform.transforms if isinstance(trans, PatchesNormalWrapper)]
+        if len(wrappers) == 0:
+            return
+        csv_file_list = [os.path.join(self.__download_folder, csv_name) for csv_name in
+                         ('lesions_train.csv', 'lesions_test.csv')
+                         if os.path.exists(os.path.join(self.__download_folder, csv_name))]
+        lesions = filter_lesions(csv_file_list)
+        lesion_masks = {}
+        for image_path, mask_path in zip(lesions['image_path'], lesions['mask_path']):
+            lesion_masks.setdefault(image_path, []).append(mask_path)
+        for wrapper in wrappers:
+            wrapper.position_index = CBISDDSMNormalIndexBuilder(dataset, lesion_masks, wrapper.patch_size,
+                                                                wrapper.min_breast_overlap,
+                                                                wrapper.max_abnorm_overlap,
+                                                                os.path.join(self.__download_folder, 'normal_index'),
+                                                                num_workers=num_workers).start()
+
+    def cache_here(self, num_workers: int = None, precision: str = 'uint8', variants: int = 1, sharded: bool = False):
+        self.__fetch_filter_lesions()
+        # Samples are rendered with the same transforms for training and validation
+        pyramid_factor = self.__pyramid_factor(True, [(True, True)] * len(self.__image_transform_list))
+        spec = '|'.join([str(trans) for trans in self.__transform_list] +
+                        [f'{trans}, for_mask={for_mask}' for trans, for_mask in
+                         zip(self.__image_transform_list, self.__image_transform_list_applied_mask)] +
+                        [f'precision={precision}', f'pyramid_factor={pyramid_factor}'] +
+                        (['normal_positions=indexed'] if self.__plus_normal else []))
+
+        store = CBISDDSMCacheStore(os.path.join(self.__download_folder, 'cache'))
+        sample_keys = store.sample_keys(self.__dataframe, spec, variants)
+        dataset = CBISDDSMGenericDataset(self.__pyramid_dataframe(pyramid_factor), self.__download_folder,
+                                         masks=True,
+                                         transform=Compose(self.__pyramid_transforms(pyramid_factor)),
+                                         train_image_transform=self.__image_transform_list,
+                                         train_image_transform_for_mask_flags=self.__image_transform_list_applied_mask,
+                                         test_image_transform=self.__image_transform_list,
+                                         test_image_transform_for_mask_flags=self.__image_transform_list_applied_mask,
+                                         tiled=self.__tiled,
+                                         shard_path=self.__shard_path,
+                                         pyramid_factor=pyramid_factor)
+        self.__index_normal_positions(dataset, num_workers)
+
+        # Only the samples missing from the store are rendered
+        cached_files = CBISDDSMCacheBuilder(dataset, store, sample_keys, num_workers=num_workers,
+                                            precision=precision).start()
+        config_path = store.register(spec, [(image_name, mask_name) for index_variants in cached_files.values()
+                                            for image_name, mask_name, _ in index_variants])
+        variant_items = [[dict(changes, image_path=image_name, mask_path=mask_name)
+                          for image_name, mask_name, changes in cached_files[index]]
+                         for index in range(len(self.__dataframe.index))]
+        # Rows keep the lesion attributes and point to the files of the first variant. Attributes the transforms
+        # changed (e.g. the NORMAL label of normal patches) are only kept in the variants, of which the dataset reads
+        # one per epoch.
+        for field in ('image_path', 'mask_path'):
+            self.__dataframe[field] = [items[0][field] for items in variant_items]
+        if variants > 1 or any(len(items[0]) > 2 for items in variant_items):
+            self.__dataframe['variants'] = variant_items
 
         self.__transform_list.clear()
         self.__image_transform_list.clear()
         self.__image_transform_list_applied_training.clear()
         self.__image_transform_list_applied_validation.clear()
-        self.__download_folder = cache_path
+        self.__image_transform_list_applied_mask.clear()
+        self.__image_transform_list_batched.clear()
+        self.__patch_shape = None
+        self.__patch_transform_builder = None
+        self.__download_folder = store.samples_path
         self.__from_cache = True
-        
+        self.__tiled = False
+        self.__shard_path = None
+        if sharded:
+            # The samples are also packed in the order of the lesions, for streaming them sequentially
+            self.__shard_path = CBISDDSMShardPacker(self.__dataframe, store.samples_path,
+                                                    store.config_shard_path(config_path),
+                                                    num_workers=num_workers).start()
+
         return self
 
 
-    def add_image_transforms(self, transform_list: List, for_train: bool = True, for_val: bool = True, for_mask=True):
+    def add_image_transforms(self, transform_list: List, for_train: bool = True, for_val: bool = True, for_mask=True,
+                             batched: bool = False):
+        if not batched and any(self.__image_transform_list_batched):
+            raise Exception('Per-sample image transforms cannot follow batched image transforms!')
         self.__image_transform_list.extend(transform_list)
+        self.__image_transform_list_batched.extend([batched]*len(transform_list))
         self.__image_transform_list_applied_training.extend([for_train]*len(transform_list))
         self.__image_transform_list_applied_validation.extend([for_val]*len(transform_list))
         self.__image_transform_list_applied_mask.extend([for_mask]*len(transform_list))
@@ -190,31 +311,53 @@ class CBISDDSMDatasetFactory:
         self.__cross_validation_folds = k_folds
         return self
 
+    def __select_image_transforms(self, applied_flags):
+        selected = [(trans, for_mask, batched) for trans, for_mask, batched, applied in
+                    zip(self.__image_transform_list, self.__image_transform_list_applied_mask,
+                        self.__image_transform_list_batched, applied_flags) if applied]
+        image_transforms = [trans for trans, _, batched in selected if not batched]
+        image_transform_for_mask_flags = [for_mask for _, for_mask, batched in selected if not batched]
+        batch_transforms = [trans for trans, _, batched in selected if batched]
+        batch_transform_for_mask_flags = [for_mask for _, for_mask, batched in selected if batched]
+        return image_transforms, image_transform_for_mask_flags, batch_transforms, batch_transform_for_mask_flags
+
     def create_classification(self, attribute: str, mask_input: bool = False):
         if not self.__from_cache:
             self.__fetch_filter_lesions()
 
-        label_list = self.__dataframe[attribute].unique().tolist()
-        if self.__plus_normal:
+        # NORMAL comes last, so that the class indices of the lesion labels do not depend on normal patches
+        lesion_labels = self.__dataframe[attribute].unique().tolist()
+        label_list = [label for label in lesion_labels if label != 'NORMAL']
+        if self.__plus_normal or len(label_list) < len(lesion_labels):
             label_list.append('NORMAL')
 
-        train_image_transforms = [trans for trans, ft in
-                                  zip(self.__image_transform_list, self.__image_transform_list_applied_training) if
-                                  ft]
-        train_image_transform_for_mask_flags = [flag for flag, ft in
-                                  zip(self.__image_transform_list_applied_mask, self.__image_transform_list_applied_training) if
-                                  ft]
-        val_transforms = [trans for trans, fv in
-                          zip(self.__image_transform_list, self.__image_transform_list_applied_validation) if fv]
-        val_image_transform_for_mask_flags = [flag for flag, fv in
-                          zip(self.__image_transform_list_applied_mask, self.__image_transform_list_applied_validation) if fv]
-
-        dataset = CBISDDSMClassificationDataset(self.__dataframe, self.__download_folder, attribute,
-                                                label_list,
-                                                masks=mask_input, transform=Compose(self.__transform_list),
+        train_image_transforms, train_image_transform_for_mask_flags, \
+            train_batch_transforms, train_batch_transform_for_mask_flags = \
+            self.__select_image_transforms(self.__image_transform_list_applied_training)
+        val_transforms, val_image_transform_for_mask_flags, \
+            val_batch_transforms, val_batch_transform_for_mask_flags = \
+            self.__select_image_transforms(self.__image_transform_list_applied_validation)
+
+        # The smallest pyramid level that still covers the resized output is read, if the converter wrote any
+        pyramid_factor = self.__pyramid_factor(mask_input, list(zip(self.__image_transform_list_applied_training,
+                                                                    self.__image_transform_list_applied_validation)))
+
+        dataset = CBISDDSMClassificationDataset(self.__pyramid_dataframe(pyramid_factor), self.__download_folder,
+                                                attribute, label_list,
+                                                masks=mask_input,
+                                                transform=Compose(self.__pyramid_transforms(pyramid_factor)),
                                                 train_image_transform=train_image_transforms,
                                                 train_image_transform_for_mask_flags=train_image_transform_for_mask_flags,
                                                 test_image_transform=val_transforms,
-                                                test_image_transform_for_mask_flags=val_image_transform_for_mask_flags)
+                                                test_image_transform_for_mask_flags=val_image_transform_for_mask_flags,
+                                                tiled=self.__tiled,
+                                                shard_path=self.__shard_path,
+                                                train_batch_transform=train_batch_transforms,
+                                                train_batch_transform_for_mask_flags=train_batch_transform_for_mask_flags,
+                                                test_batch_transform=val_batch_transforms,
+                                                test_batch_transform_for_mask_flags=val_batch_transform_for_mask_flags,
+                                                image_cache=self.__image_cache,
+                                                pyramid_factor=pyramid_factor)
+        self.__index_normal_positions(dataset)
 
         return dataset
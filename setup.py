@@ -1,9 +1,11 @@
 import json
+import os
 import argparse
 
 from utils.ddsm_downloader import CBISDDSMDownloader
 from utils.ddsm_png_converter import CBISDDSMConverter
 from utils.ddsm_preprocessor import CBISDDSMPreprocessor
+from utils.ddsm_pipeline import CBISDDSMPipeline
 
 parser = argparse.ArgumentParser(prog='CBIS DDSM Setup',
                                  description="Welcome to CBIS DDSM Dataloader library.\n"
@@ -17,20 +19,41 @@ parser.add_argument('-c', '--config_file', default='./config.json',
                     help='Path to the configuration file. Default=config.json')
 parser.add_argument('-d', action='store_true', help='If used, dcm file will be deleted during conversion, to free up space.'
                                                     'However, if download runs again it will need to download the whole dataset again.')
+parser.add_argument('-t', action='store_true', help='If used, tiled copies of the images are also written, so that patch '
+                                                    'datasets created with .tiled_images() decode only the patch region.')
+parser.add_argument('-s', action='store_true', help='If used, the images are packed into memory-mapped shard files '
+                                                    'instead of PNG. Use .sharded_images() to read them.')
+parser.add_argument('-f', action='store_true', help='If used, PNG files are written uncompressed. Conversion is much faster, '
+                                                    'but the images take about twice the disk space.')
+parser.add_argument('-p', action='store_true', help='If used, the three steps run as a pipeline: every series is converted '
+                                                    'as soon as it is downloaded, and the lesions of an image are processed '
+                                                    'together as soon as the image and their masks are converted.')
+parser.add_argument('-y', type=int, nargs='*', default=[], help='Downsampling factors of pyramid levels written next to '
+                                                                   'every image, e.g. -y 2 4 8. Datasets that resize '
+                                                                   'their samples then read the smallest sufficient level.')
 args = parser.parse_args()
 
 with open(args.config_file, 'r') as cf:
     config = json.load(cf)
 
-downloader = CBISDDSMDownloader(config['manifest'], config['download_path'])
-downloader.start()
-downloader.start()  # Run twice for checks
-
-converter = CBISDDSMConverter(config['download_path'], delete_dcm=args.d)
-converter.start()
-converter.start()  # Run twice for checks
+shard_path = os.path.join(config['download_path'], 'shards') if args.s else None
 
+downloader = CBISDDSMDownloader(config['manifest'], config['download_path'])
+converter = CBISDDSMConverter(config['download_path'], delete_dcm=args.d, tiled=args.t, shard_path=shard_path,
+                              compress_level=0 if args.f else 6, pyramid_factors=args.y)
 preprocessor = CBISDDSMPreprocessor(config['download_path'],
                                     (config['mass_train_csv'], config['calc_train_csv']),
-                                    (config['mass_test_csv'], config['calc_test_csv']))
-preprocessor.start()
+                                    (config['mass_test_csv'], config['calc_test_csv']),
+                                    shard_path=shard_path)
+
+if args.p:
+    pipeline = CBISDDSMPipeline(downloader, converter, preprocessor)
+    pipeline.start()
+else:
+    downloader.start()
+    downloader.start()  # Run twice for checks
+
+    converter.start()
+    converter.start()  # Run twice for checks
+
+    preprocessor.start()
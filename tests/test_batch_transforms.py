@@ -0,0 +1,76 @@
+import pytest
+import torch
+from torchvision import transforms
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+from transforms.batch_transforms import BatchAugmentation, BatchRandomAffine, BatchResize, to_batch_transform
+
+
+@pytest.fixture
+def batch():
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand(3, 1, 37, 50, generator=generator)
+
+
+def affine_reference(batch, angle, translate, scale, shear, interpolation, fill):
+    return torch.stack([TF.affine(image, angle=angle, translate=list(translate), scale=scale, shear=[shear, 0.0],
+                                  interpolation=interpolation, fill=[fill]) for image in batch])
+
+
+# No sampling point of these parameters lies halfway between two pixels, where nearest interpolation may round either
+# way, so both interpolations match torchvision up to float error
+@pytest.mark.parametrize('interpolation', [InterpolationMode.NEAREST, InterpolationMode.BILINEAR])
+@pytest.mark.parametrize('fill', [0.0, 0.5])
+@pytest.mark.parametrize('angle, scale, shear', [(30.0, 1.0, 0.0), (-17.0, 0.8, 10.0), (45.0, 1.3, -5.0)])
+def test_affine_matches_torchvision(batch, interpolation, fill, angle, scale, shear):
+    # Ranges of a single value make the random parameters those of the reference
+    transform = BatchRandomAffine((angle, angle), scale=(scale, scale), shear=(shear, shear),
+                                  interpolation=interpolation, fill=fill)
+    expected = affine_reference(batch, angle, (0, 0), scale, shear, interpolation, fill)
+    torch.testing.assert_close(transform(batch), expected, atol=1e-5, rtol=0)
+
+
+@pytest.mark.parametrize('translate', [(3, -4), (-5, 2)])
+def test_affine_translation_matches_torchvision(batch, translate):
+    transform = BatchRandomAffine(0, interpolation=InterpolationMode.BILINEAR)
+    size = batch.shape[0]
+    params = (torch.full((size,), 90.0), torch.full((size,), float(translate[0])),
+              torch.full((size,), float(translate[1])), torch.full((size,), 1.2), torch.zeros(size), torch.zeros(size))
+    grid = transform.affine_grid(params, batch.shape[-2:], batch.device)
+    expected = affine_reference(batch, 90.0, translate, 1.2, 0.0, InterpolationMode.BILINEAR, 0.0)
+    torch.testing.assert_close(transform.apply(batch, grid), expected, atol=1e-5, rtol=0)
+
+
+def test_affine_converted_from_torchvision(batch):
+    transform = to_batch_transform(transforms.RandomAffine((20, 20), scale=(0.9, 0.9),
+                                                           interpolation=InterpolationMode.BILINEAR))
+    assert isinstance(transform, BatchRandomAffine)
+    expected = affine_reference(batch, 20.0, (0, 0), 0.9, 0.0, InterpolationMode.BILINEAR, 0.0)
+    torch.testing.assert_close(transform(batch), expected, atol=1e-5, rtol=0)
+
+
+def test_affine_draws_parameters_per_sample(batch):
+    torch.manual_seed(0)
+    output = BatchRandomAffine(45, interpolation=InterpolationMode.BILINEAR)(batch[:1].expand(8, -1, -1, -1))
+    assert len({tuple(image.flatten().tolist()) for image in output}) == 8
+
+
+def test_image_and_mask_share_parameters(batch):
+    torch.manual_seed(0)
+    augmentation = BatchAugmentation([transforms.RandomAffine(45, translate=(0.1, 0.1))], [True])
+    image, mask = augmentation([batch, batch.clone()])
+    torch.testing.assert_close(image, mask)
+
+
+@pytest.mark.parametrize('interpolation', [InterpolationMode.NEAREST, InterpolationMode.BILINEAR,
+                                           InterpolationMode.BICUBIC])
+@pytest.mark.parametrize('size, max_size', [(16, None), (64, None), ((20, 30), None), (30, 35)])
+def test_resize_matches_torchvision(batch, interpolation, size, max_size):
+    transform = to_batch_transform(transforms.Resize(size, interpolation, max_size=max_size, antialias=True))
+    assert isinstance(transform, BatchResize)
+    expected = torch.stack([TF.resize(image, size, interpolation, max_size=max_size, antialias=True)
+                            for image in batch])
+    output = transform(batch)
+    assert output.shape == expected.shape
+    torch.testing.assert_close(output, expected, atol=1e-5, rtol=0)
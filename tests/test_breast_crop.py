@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from transforms.breast_crop import BreastCrop
+
+
+def crop(image, box, margin=0.0, aspect_ratio=None):
+    minx, maxx, miny, maxy = box
+    item = {'breast_minx': minx, 'breast_maxx': maxx, 'breast_miny': miny, 'breast_maxy': maxy}
+    sample = BreastCrop(margin, aspect_ratio)({'image_tensor_list': [image], 'item': item})
+    return sample['image_tensor_list'][0]
+
+
+def breast_image(height, width, box):
+    minx, maxx, miny, maxy = box
+    image = torch.zeros(1, height, width)
+    image[:, miny:maxy + 1, minx:maxx + 1] = 1
+    return image
+
+
+def test_crop_covers_inclusive_box():
+    box = (10, 29, 5, 44)
+    output = crop(breast_image(60, 50, box), box)
+    assert output.shape == (1, 40, 20)
+    assert bool((output == 1).all())
+
+
+@pytest.mark.parametrize('aspect_ratio', [0.8, 1.0])
+def test_aspect_ratio_kept_at_image_border(aspect_ratio):
+    # The breast touches the left border and spans almost the whole height, so the crop cannot grow inside the image
+    box = (0, 1999, 200, 4799)
+    image = breast_image(5000, 3000, box)
+    output = crop(image, box, margin=0.05, aspect_ratio=aspect_ratio)
+    height, width = output.shape[1:]
+    assert width / height == pytest.approx(aspect_ratio, abs=1e-3)
+    # The breast is kept whole and padding adds no breast pixels
+    assert output.sum() == image.sum()
+
+
+def test_crop_inside_image_is_not_padded():
+    box = (400, 599, 300, 699)
+    image = torch.rand(1, 1000, 1000)
+    output = crop(image, box, margin=0.1, aspect_ratio=1.0)
+    assert output.shape == (1, 480, 480)
+    assert torch.equal(output, image[:, 260:740, 260:740])
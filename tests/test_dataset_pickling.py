@@ -0,0 +1,52 @@
+import copy
+import multiprocessing
+import pickle
+
+import pandas as pd
+import pytest
+
+from datasets.classification_dataset import CBISDDSMClassificationDataset
+
+LABELS = ['BENIGN', 'MALIGNANT']
+
+
+@pytest.fixture
+def dataset():
+    rows = [{'patient_id': f'P_{i // 2:05d}', 'pathology': LABELS[i % 2], 'image_path': f'{i}/image.png',
+             'mask_path': f'{i}/mask.png'} for i in range(10)]
+    return CBISDDSMClassificationDataset(pd.DataFrame(rows), '.', 'pathology', LABELS)
+
+
+def assert_copied(dataset, copied):
+    assert copied.epoch == dataset.epoch
+    assert len(copied) == len(dataset)
+    assert copied.labels.tolist() == dataset.labels.tolist()
+    # Copies get their own epoch
+    copied.set_epoch(dataset.epoch + 1)
+    assert dataset.epoch != copied.epoch
+
+
+@pytest.mark.parametrize('copy_function', [lambda obj: pickle.loads(pickle.dumps(obj)), copy.deepcopy])
+def test_dataset_round_trip(dataset, copy_function):
+    dataset.set_epoch(3)
+    assert_copied(dataset, copy_function(dataset))
+
+
+def test_split_round_trip(dataset):
+    dataset.set_epoch(2)
+    train, val = dataset.split_train_val(0.2)
+    assert_copied(train, pickle.loads(pickle.dumps(train)))
+    assert_copied(val, copy.deepcopy(val))
+
+
+def _set_epoch(dataset):
+    dataset.set_epoch(7)
+
+
+def test_spawned_workers_share_epoch(dataset):
+    dataset.set_epoch(5)
+    process = multiprocessing.get_context('spawn').Process(target=_set_epoch, args=(dataset,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert dataset.epoch == 7
@@ -0,0 +1,72 @@
+import csv
+import json
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.ddsm_preprocessor import CBISDDSMPreprocessor, LESIONS_CACHE_NAME
+
+HEADER = ['patient_id', 'breast_density', 'left or right breast', 'image view', 'abnormality id', 'abnormality type',
+          'mass shape', 'mass margins', 'assessment', 'pathology', 'subtlety', 'image file path',
+          'cropped image file path', 'ROI mask file path']
+
+
+@pytest.fixture
+def download_path(tmp_path):
+    # A mammogram whose breast is an ellipse, with one lesion
+    image = np.zeros((403, 301), dtype=np.uint16)
+    cv2.ellipse(image, (0, 200), (217, 173), 0, -90, 90, 30000, -1)
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    cv2.circle(mask, (80, 190), 20, 255, -1)
+    for name, array in (('image', image), ('mask', mask), ('crop', mask[170:211, 60:101])):
+        os.makedirs(tmp_path / name)
+        cv2.imwrite(str(tmp_path / name / '000000.png'), array)
+    row = ['P_00001', '2', 'LEFT', 'CC', None, 'mass', 'OVAL', 'CIRCUMSCRIBED', '3', 'BENIGN', '4',
+           'image/000000.dcm', 'crop/000000.dcm', 'mask/000000.dcm']
+    # The splits hold different lesions, so that the test split does not reuse the train lesion
+    for abnormality_id, split in enumerate(('train', 'test')):
+        row[4] = str(abnormality_id + 1)
+        with open(tmp_path / f'{split}.csv', 'w', newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(HEADER)
+            writer.writerow(row)
+    return tmp_path
+
+
+def preprocess(path, capsys, downsample):
+    CBISDDSMPreprocessor(str(path), [str(path / 'train.csv')], [str(path / 'test.csv')], max_workers=1,
+                         downsample=downsample).start()
+    output = capsys.readouterr().out
+    return pd.read_csv(path / 'lesions_train.csv').iloc[0], 'Reusing' in output
+
+
+def test_cache_reused_with_same_settings(download_path, capsys):
+    first, reused = preprocess(download_path, capsys, downsample=4)
+    assert not reused
+    second, reused = preprocess(download_path, capsys, downsample=4)
+    assert reused
+    pd.testing.assert_series_equal(first, second)
+
+
+def test_cache_invalidated_by_downsample(download_path, capsys):
+    preprocess(download_path, capsys, downsample=4)
+    full_resolution, reused = preprocess(download_path, capsys, downsample=1)
+    assert not reused
+    # The rows match those of a run without cache
+    os.remove(download_path / LESIONS_CACHE_NAME)
+    uncached, _ = preprocess(download_path, capsys, downsample=1)
+    pd.testing.assert_series_equal(full_resolution, uncached)
+
+
+def test_cache_of_older_format_is_ignored(download_path, capsys):
+    preprocess(download_path, capsys, downsample=4)
+    with open(download_path / LESIONS_CACHE_NAME) as fin:
+        rows = json.load(fin)['rows']
+    # Earlier versions stored the rows without header
+    with open(download_path / LESIONS_CACHE_NAME, 'w') as fout:
+        json.dump(rows, fout)
+    _, reused = preprocess(download_path, capsys, downsample=4)
+    assert not reused
@@ -0,0 +1,88 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from utils.shard_store import ShardStore, ShardWriter
+
+
+@pytest.fixture
+def arrays():
+    rng = np.random.default_rng(0)
+    return {
+        'a/image.png': rng.integers(0, 65535, size=(37, 53), dtype=np.uint16),
+        'a/mask.png': rng.integers(0, 2, size=(37, 53), dtype=np.uint8) * 255,
+        'b/image_x4.png': rng.integers(0, 65535, size=(10, 14), dtype=np.uint16),
+        'c/sample.npy': rng.random((3, 8, 8), dtype=np.float32),
+    }
+
+
+def write(root, arrays, shard_size=4 * 2 ** 30):
+    with ShardWriter(root, shard_size=shard_size) as writer:
+        for key, array in arrays.items():
+            writer.add(key, array)
+
+
+def assert_round_trip(store, arrays):
+    assert len(store) == len(arrays)
+    assert sorted(store.keys()) == sorted(arrays)
+    for key, array in arrays.items():
+        assert key in store
+        read = store.get(key)
+        assert read.dtype == array.dtype
+        np.testing.assert_array_equal(read, array)
+
+
+def test_round_trip(tmp_path, arrays):
+    write(str(tmp_path), arrays)
+    assert_round_trip(ShardStore(str(tmp_path)), arrays)
+
+
+def test_index_entries(tmp_path, arrays):
+    write(str(tmp_path), arrays)
+    store = ShardStore(str(tmp_path))
+    for key, array in arrays.items():
+        shard_id, offset, dtype, shape = store.entry(key)
+        assert shard_id == 0
+        assert offset % 64 == 0
+        assert np.dtype(dtype) == array.dtype
+        assert shape == list(array.shape)
+    assert store.entry('missing.png') is None
+    assert 'missing.png' not in store
+    with pytest.raises(FileNotFoundError):
+        store.get('missing.png')
+
+
+def test_arrays_split_across_shards(tmp_path, arrays):
+    # Arrays larger than a shard get a shard of their own, and the next array opens a new shard
+    write(str(tmp_path), arrays, shard_size=2000)
+    store = ShardStore(str(tmp_path))
+    assert [store.entry(key)[0] for key in arrays] == [0, 1, 2, 2]
+    assert_round_trip(store, arrays)
+
+
+def test_later_runs_append_new_shards(tmp_path, arrays):
+    keys = list(arrays)
+    write(str(tmp_path), {key: arrays[key] for key in keys[:2]})
+    write(str(tmp_path), {key: arrays[key] for key in keys[2:]})
+    store = ShardStore(str(tmp_path))
+    assert {store.entry(key)[0] for key in keys[:2]} == {0}
+    assert {store.entry(key)[0] for key in keys[2:]} == {1}
+    assert_round_trip(store, arrays)
+
+
+def test_views_are_memory_mapped_and_writable(tmp_path, arrays):
+    write(str(tmp_path), arrays)
+    store = ShardStore(str(tmp_path))
+    read = store.get('a/image.png')
+    assert isinstance(read.base, np.memmap)
+    # Writes go to private pages and never reach the shard
+    read[0, 0] = arrays['a/image.png'][0, 0] + 1
+    np.testing.assert_array_equal(ShardStore(str(tmp_path)).get('a/image.png'), arrays['a/image.png'])
+
+
+def test_pickled_store_reopens_shards(tmp_path, arrays):
+    write(str(tmp_path), arrays)
+    store = ShardStore(str(tmp_path))
+    store.get('a/image.png')
+    assert_round_trip(pickle.loads(pickle.dumps(store)), arrays)
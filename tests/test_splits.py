@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datasets.classification_dataset import CBISDDSMClassificationDataset
+
+LABELS = ['BENIGN', 'MALIGNANT', 'BENIGN_WITHOUT_CALLBACK']
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.default_rng(0)
+    # Patients with one to six lesions, whose labels are mostly shared by the lesions of a patient
+    rows = []
+    for patient in range(120):
+        patient_label = LABELS[rng.integers(0, len(LABELS))]
+        for _ in range(rng.integers(1, 7)):
+            label = patient_label if rng.random() < 0.8 else LABELS[rng.integers(0, len(LABELS))]
+            rows.append({'patient_id': f'P_{patient:05d}', 'pathology': label,
+                         'image_path': f'P_{patient:05d}/image.png', 'mask_path': f'P_{patient:05d}/mask.png'})
+    return CBISDDSMClassificationDataset(pd.DataFrame(rows), '.', 'pathology', LABELS)
+
+
+def patients(dataset):
+    return set(dataset.records.column('patient_id'))
+
+
+def label_shares(dataset):
+    return np.bincount(dataset.labels, minlength=len(LABELS)) / len(dataset)
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_split_indices_cover_rows_once(dataset, shuffle):
+    parts = dataset._split_indices(np.full(5, 1 / 5), shuffle=shuffle, random_state=3)
+    np.testing.assert_array_equal(np.sort(np.concatenate(parts)), np.arange(len(dataset)))
+
+
+def test_split_indices_keep_groups_together(dataset):
+    parts = dataset._split_indices((0.7, 0.3))
+    patient_ids = dataset.records.column('patient_id')
+    assert set(patient_ids[parts[0]]).isdisjoint(patient_ids[parts[1]])
+
+
+def test_split_indices_follow_shares(dataset):
+    parts = dataset._split_indices((0.7, 0.3))
+    assert abs(len(parts[1]) / len(dataset) - 0.3) < 0.02
+
+
+def test_split_indices_without_groups(dataset):
+    parts = dataset._split_indices((0.5, 0.5), group_by=None)
+    assert abs(len(parts[0]) - len(parts[1])) <= 1
+
+
+@pytest.mark.parametrize('stratify', [False, True])
+def test_split_train_val_is_patient_disjoint(dataset, stratify):
+    train, val = dataset.split_train_val(0.2, shuffle=True, random_state=0, stratify=stratify)
+    assert len(train) + len(val) == len(dataset)
+    assert patients(train).isdisjoint(patients(val))
+    assert patients(train) | patients(val) == patients(dataset)
+
+
+def test_stratified_split_keeps_label_shares(dataset):
+    _, val = dataset.split_train_val(0.2, shuffle=True, random_state=0, stratify=True)
+    np.testing.assert_allclose(label_shares(val), label_shares(dataset), atol=0.02)
+
+
+@pytest.mark.parametrize('stratify', [False, True])
+def test_crossval_folds_cover_dataset(dataset, stratify):
+    folds = dataset.split_crossval(5, shuffle=True, random_state=1, stratify=stratify)
+    assert len(folds) == 5
+    val_patients = [patients(val) for _, val in folds]
+    # Every lesion is validated in exactly one fold
+    assert sum(len(val) for _, val in folds) == len(dataset)
+    assert set().union(*val_patients) == patients(dataset)
+    for i, (train, val) in enumerate(folds):
+        assert len(train) + len(val) == len(dataset)
+        assert patients(train).isdisjoint(val_patients[i])
+        for j in range(i + 1, len(folds)):
+            assert val_patients[i].isdisjoint(val_patients[j])
+
+
+def test_crossval_rejects_more_folds_than_patients(dataset):
+    subset = dataset._subset(dataset.records.view(np.flatnonzero(np.isin(dataset.records.column('patient_id'),
+                                                                          ['P_00000', 'P_00001', 'P_00002']))))
+    assert len(patients(subset)) == 3
+    with pytest.raises(ValueError):
+        subset.split_crossval(5)
+    assert len(subset.split_crossval(3)) == 3
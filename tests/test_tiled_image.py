@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from utils.tiled_image import TiledImage, write_tiled_image
+
+
+@pytest.fixture(params=[(np.uint16, 0), (np.uint16, 1), (np.uint8, 6)])
+def image(request, tmp_path):
+    dtype, compression = request.param
+    rng = np.random.default_rng(0)
+    # Neither dimension is a multiple of the tile size, so the last tiles are partial
+    array = rng.integers(0, np.iinfo(dtype).max, size=(300, 200), dtype=dtype)
+    path = str(tmp_path / 'image.tiles')
+    write_tiled_image(path, array, tile_size=64, compression=compression)
+    return array, TiledImage(path)
+
+
+def test_header(image):
+    array, tiled = image
+    assert tiled.shape == array.shape
+    assert tiled.dtype == array.dtype
+    assert tiled.tile_size == (64, 64)
+
+
+def test_read_whole_image(image):
+    array, tiled = image
+    np.testing.assert_array_equal(tiled.read(), array)
+
+
+@pytest.mark.parametrize('window', [(0, 64, 0, 64), (10, 11, 20, 21), (50, 190, 30, 150), (250, 300, 150, 200),
+                                    (63, 65, 127, 129)])
+def test_read_window(image, window):
+    array, tiled = image
+    miny, maxy, minx, maxx = window
+    np.testing.assert_array_equal(tiled.read_window(miny, maxy, minx, maxx), array[miny:maxy, minx:maxx])
+
+
+def test_read_window_clips_to_image(image):
+    array, tiled = image
+    np.testing.assert_array_equal(tiled.read_window(-20, 40, 180, 260), array[0:40, 180:200])
+    assert tiled.read_window(310, 320, 0, 10).shape == (0, 10)
+
+
+def test_read_window_reads_only_covered_tiles(image):
+    array, tiled = image
+    tiled.read_window(70, 80, 70, 80)
+    one_tile = tiled.bytes_read
+    tiled.bytes_read = 0
+    tiled.read()
+    assert 0 < one_tile < tiled.bytes_read / 10
+
+
+def test_rejects_multichannel(tmp_path):
+    with pytest.raises(ValueError):
+        write_tiled_image(str(tmp_path / 'rgb.tiles'), np.zeros((8, 8, 3), dtype=np.uint8))
@@ -0,0 +1,271 @@
+import numbers
+
+import torch
+from torch.nn import functional as nnf
+from torchvision import transforms
+from torchvision.transforms import InterpolationMode
+
+
+class BatchTransform(torch.nn.Module):
+    """Transform of a whole B x C x H x W batch with independent random parameters per sample.
+
+    The parameters are drawn once by sample_params() so that the image and mask batches can be transformed alike.
+    """
+
+    def sample_params(self, batch_size, image_size, device):
+        return None
+
+    def apply(self, batch, params):
+        raise NotImplementedError
+
+    def forward(self, batch):
+        return self.apply(batch, self.sample_params(batch.shape[0], batch.shape[-2:], batch.device))
+
+
+class BatchRandomAffine(BatchTransform):
+    def __init__(self, degrees, translate=None, scale=None, shear=None,
+                 interpolation=InterpolationMode.NEAREST, fill=0):
+        super(BatchRandomAffine, self).__init__()
+        self.degrees = [-degrees, degrees] if isinstance(degrees, numbers.Number) else list(degrees)
+        self.translate = translate
+        self.scale = scale
+        if isinstance(shear, numbers.Number):
+            shear = [-shear, shear]
+        self.shear = shear
+        self.interpolation = interpolation
+        self.fill = fill
+
+    @staticmethod
+    def __uniform(low, high, batch_size, device):
+        return torch.empty(batch_size, device=device).uniform_(float(low), float(high))
+
+    def __sample_affine_params(self, batch_size, image_size, device):
+        height, width = image_size
+        angle = self.__uniform(self.degrees[0], self.degrees[1], batch_size, device)
+        if self.translate is not None:
+            max_dx = float(self.translate[0] * width)
+            max_dy = float(self.translate[1] * height)
+            tx = torch.round(self.__uniform(-max_dx, max_dx, batch_size, device))
+            ty = torch.round(self.__uniform(-max_dy, max_dy, batch_size, device))
+        else:
+            tx = ty = torch.zeros(batch_size, device=device)
+        if self.scale is not None:
+            scale = self.__uniform(self.scale[0], self.scale[1], batch_size, device)
+        else:
+            scale = torch.ones(batch_size, device=device)
+        shear_x = shear_y = torch.zeros(batch_size, device=device)
+        if self.shear is not None:
+            shear_x = self.__uniform(self.shear[0], self.shear[1], batch_size, device)
+            if len(self.shear) == 4:
+                shear_y = self.__uniform(self.shear[2], self.shear[3], batch_size, device)
+        return angle, tx, ty, scale, shear_x, shear_y
+
+    @staticmethod
+    def __inverse_matrices(angle, tx, ty, scale, shear_x, shear_y):
+        # Batched torchvision _get_inverse_affine_matrix() around the image center
+        rot, sx, sy = torch.deg2rad(angle), torch.deg2rad(shear_x), torch.deg2rad(shear_y)
+        a = torch.cos(rot - sy) / torch.cos(sy)
+        b = -torch.cos(rot - sy) * torch.tan(sx) / torch.cos(sy) - torch.sin(rot)
+        c = torch.sin(rot - sy) / torch.cos(sy)
+        d = -torch.sin(rot - sy) * torch.tan(sx) / torch.cos(sy) + torch.cos(rot)
+        m0, m1, m3, m4 = d / scale, -b / scale, -c / scale, a / scale
+        m2 = m0 * -tx + m1 * -ty
+        m5 = m3 * -tx + m4 * -ty
+        return torch.stack([m0, m1, m2, m3, m4, m5], dim=1).reshape(-1, 2, 3)
+
+    def sample_params(self, batch_size, image_size, device):
+        # The sampling grid is shared by the image and mask batches, so it is built once here
+        return self.affine_grid(self.__sample_affine_params(batch_size, image_size, device), image_size, device)
+
+    def affine_grid(self, affine_params, image_size, device):
+        # Sampling grid of given per-sample angle, tx, ty, scale, shear_x and shear_y tensors, which apply() takes
+        height, width = image_size
+        theta = self.__inverse_matrices(*affine_params)
+
+        base_grid = torch.empty(1, height, width, 3, device=device)
+        base_grid[..., 0].copy_(torch.linspace(-width * 0.5 + 0.5, width * 0.5 - 0.5, steps=width))
+        base_grid[..., 1].copy_(torch.linspace(-height * 0.5 + 0.5, height * 0.5 - 0.5, steps=height).unsqueeze_(-1))
+        base_grid[..., 2].fill_(1)
+        scaling = torch.tensor([0.5 * width, 0.5 * height], device=device)
+        rescaled_theta = theta.transpose(1, 2) / scaling
+        grid = base_grid.view(1, height * width, 3).expand(theta.shape[0], -1, -1).bmm(rescaled_theta)
+        return grid.view(theta.shape[0], height, width, 2)
+
+    def apply(self, batch, params):
+        grid = params.to(batch.dtype)
+        mode = InterpolationMode(self.interpolation).value
+        fill = torch.as_tensor(self.fill, dtype=batch.dtype, device=batch.device)
+        if mode == 'nearest' and not fill.any():
+            # Zero padding already fills the pixels coming from outside the image
+            return nnf.grid_sample(batch, grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+        # A channel of ones marks the pixels that come from outside the image, as in torchvision
+        ones = torch.ones((batch.shape[0], 1) + batch.shape[2:], dtype=batch.dtype, device=batch.device)
+        output = nnf.grid_sample(torch.cat((batch, ones), dim=1), grid, mode=mode, padding_mode='zeros',
+                                 align_corners=False)
+        output, inside = output[:, :-1], output[:, -1:].expand_as(output[:, :-1])
+        fill = fill.reshape(1, -1, 1, 1).expand_as(output)
+        if mode == 'nearest':
+            outside = inside < 0.5
+            output[outside] = fill[outside]
+            return output
+        return output * inside + (1.0 - inside) * fill
+
+    def __repr__(self):
+        detail = f"(degrees={self.degrees}, translate={self.translate}, scale={self.scale}, shear={self.shear})"
+        return f"{self.__class__.__name__}{detail}"
+
+
+class BatchRandomHorizontalFlip(BatchTransform):
+    def __init__(self, p=0.5):
+        super(BatchRandomHorizontalFlip, self).__init__()
+        self.p = p
+
+    def sample_params(self, batch_size, image_size, device):
+        return torch.rand(batch_size, device=device) < self.p
+
+    def apply(self, batch, params):
+        batch = batch.clone()
+        batch[params] = batch[params].flip(-1)
+        return batch
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(p={self.p})"
+
+
+class BatchRandomVerticalFlip(BatchRandomHorizontalFlip):
+    def apply(self, batch, params):
+        batch = batch.clone()
+        batch[params] = batch[params].flip(-2)
+        return batch
+
+
+class BatchResize(BatchTransform):
+    def __init__(self, size, interpolation=InterpolationMode.BILINEAR, max_size=None, antialias=True):
+        super(BatchResize, self).__init__()
+        self.size = size
+        self.interpolation = interpolation
+        self.max_size = max_size
+        self.antialias = antialias
+
+    def __output_size(self, height, width):
+        if not isinstance(self.size, int) and len(self.size) == 2:
+            return list(self.size)
+        size = self.size if isinstance(self.size, int) else self.size[0]
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = size, int(size * long / short)
+        if self.max_size is not None and new_long > self.max_size:
+            new_short, new_long = int(self.max_size * new_short / new_long), self.max_size
+        return [new_long, new_short] if width <= height else [new_short, new_long]
+
+    def apply(self, batch, params):
+        mode = InterpolationMode(self.interpolation).value
+        antialias = self.antialias and mode in ('bilinear', 'bicubic')
+        align_corners = False if mode in ('bilinear', 'bicubic') else None
+        return nnf.interpolate(batch, size=self.__output_size(*batch.shape[-2:]), mode=mode,
+                               align_corners=align_corners, antialias=antialias)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(size={self.size})"
+
+
+class BatchColorJitter(BatchTransform):
+    """Per-sample brightness and contrast jitter of grayscale batches, applied in this order."""
+
+    def __init__(self, brightness=None, contrast=None):
+        super(BatchColorJitter, self).__init__()
+        self.brightness = self.__range(brightness)
+        self.contrast = self.__range(contrast)
+
+    @staticmethod
+    def __range(value):
+        if value is None or isinstance(value, (tuple, list)):
+            return value
+        return (max(0.0, 1 - value), 1 + value) if value > 0 else None
+
+    def sample_params(self, batch_size, image_size, device):
+        factors = []
+        for value_range in (self.brightness, self.contrast):
+            if value_range is None:
+                factors.append(None)
+            else:
+                factors.append(torch.empty(batch_size, 1, 1, 1, device=device).uniform_(value_range[0],
+                                                                                       value_range[1]))
+        return factors
+
+    def apply(self, batch, params):
+        brightness, contrast = params
+        if brightness is not None:
+            batch = (batch * brightness).clamp(0, 1)
+        if contrast is not None:
+            mean = batch.mean(dim=(-3, -2, -1), keepdim=True)
+            batch = (contrast * batch + (1 - contrast) * mean).clamp(0, 1)
+        return batch
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(brightness={self.brightness}, contrast={self.contrast})"
+
+
+class BatchPerSample(BatchTransform):
+    """Fallback applying a per-sample transform to every sample of the batch.
+
+    Every sample gets its own seed, so that random transforms act alike on the image and mask batches.
+    """
+
+    def __init__(self, transform):
+        super(BatchPerSample, self).__init__()
+        self.transform = transform
+
+    def sample_params(self, batch_size, image_size, device):
+        return torch.randint(0, 2 ** 62, (batch_size,)).tolist()
+
+    def apply(self, batch, params):
+        state = torch.get_rng_state()
+        outputs = []
+        for sample, seed in zip(batch, params):
+            torch.manual_seed(seed)
+            outputs.append(self.transform(sample))
+        torch.set_rng_state(state)
+        return torch.stack(outputs)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.transform})"
+
+
+def to_batch_transform(transform):
+    if isinstance(transform, BatchTransform):
+        return transform
+    if isinstance(transform, transforms.RandomAffine):
+        return BatchRandomAffine(transform.degrees, transform.translate, transform.scale, transform.shear,
+                                 transform.interpolation, transform.fill)
+    if isinstance(transform, transforms.RandomHorizontalFlip):
+        return BatchRandomHorizontalFlip(transform.p)
+    if isinstance(transform, transforms.RandomVerticalFlip):
+        return BatchRandomVerticalFlip(transform.p)
+    if isinstance(transform, transforms.Resize):
+        return BatchResize(transform.size, transform.interpolation, transform.max_size, transform.antialias)
+    if isinstance(transform, transforms.ColorJitter) and transform.saturation is None and transform.hue is None:
+        return BatchColorJitter(transform.brightness, transform.contrast)
+    return BatchPerSample(transform)
+
+
+class BatchAugmentation:
+    """Applies batch transforms to the collated image and mask batches with shared per-sample parameters."""
+
+    def __init__(self, transform_list, for_mask_flags):
+        self.transform_list = [to_batch_transform(t) for t in transform_list]
+        self.for_mask_flags = list(for_mask_flags)
+
+    def __call__(self, image_batch_list):
+        image_batch_list = list(image_batch_list)
+        for transform, mask_flag in zip(self.transform_list, self.for_mask_flags):
+            batch = image_batch_list[0]
+            params = transform.sample_params(batch.shape[0], batch.shape[-2:], batch.device)
+            for i in range(len(image_batch_list)):
+                image_batch_list[i] = transform.apply(image_batch_list[i], params)
+                if not mask_flag:
+                    break
+        return image_batch_list
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.transform_list})"
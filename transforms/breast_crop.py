@@ -0,0 +1,60 @@
+import torch
+from torch.nn import functional as nnf
+
+from transforms.windows import crop_window
+
+
+def _expand(low, high, size, limit):
+    # Grows the inclusive range [low, high] to size around its centre, shifted to stay inside [0, limit), or to
+    # cover it if larger
+    size = max(int(round(size)), 1)
+    low = int(round((low + high + 1 - size) / 2))
+    low = min(max(low, min(0, limit - size)), max(0, limit - size))
+    return low, low + size
+
+
+class BreastCrop(torch.nn.Module):
+    """Crops the images of a sample to the bounding box of the breast, grown by a margin on every side.
+
+    The margin is a fraction of the box size. If aspect_ratio (width / height) is given, the shorter side of the box is
+    grown to it, so that a later resize does not distort the breast. Crops larger than the image are padded with fill.
+    """
+
+    def __init__(self, margin=0.05, aspect_ratio=None, fill=0):
+        super(BreastCrop, self).__init__()
+        self.margin = margin
+        self.aspect_ratio = aspect_ratio
+        self.fill = fill
+
+    def forward(self, sample):
+        image_tensor_list, item = sample['image_tensor_list'], sample['item']
+        image_shape = image_tensor_list[-1].shape[1:3]
+
+        width = item['breast_maxx'] - item['breast_minx'] + 1
+        height = item['breast_maxy'] - item['breast_miny'] + 1
+        width, height = width * (1 + 2 * self.margin), height * (1 + 2 * self.margin)
+        if self.aspect_ratio is not None:
+            if width < height * self.aspect_ratio:
+                width = height * self.aspect_ratio
+            else:
+                height = width / self.aspect_ratio
+
+        minx, maxx = _expand(item['breast_minx'], item['breast_maxx'], width, image_shape[1])
+        miny, maxy = _expand(item['breast_miny'], item['breast_maxy'], height, image_shape[0])
+
+        # Only the part inside the image is read, and the rest of the crop is padded
+        padding = (max(-minx, 0), max(maxx - image_shape[1], 0), max(-miny, 0), max(maxy - image_shape[0], 0))
+        out_tensors = []
+        for image_tensor in image_tensor_list:
+            image_tensor = crop_window(image_tensor, max(miny, 0), min(maxy, image_shape[0]),
+                                       max(minx, 0), min(maxx, image_shape[1]))
+            if any(padding):
+                image_tensor = nnf.pad(image_tensor, padding, value=self.fill)
+            out_tensors.append(image_tensor)
+
+        sample = {'image_tensor_list': out_tensors, 'item': item}
+        return sample
+
+    def __repr__(self):
+        detail = f"(margin={self.margin}, aspect_ratio={self.aspect_ratio}, fill={self.fill})"
+        return f"{self.__class__.__name__}{detail}"
@@ -1,5 +1,7 @@
 import torch
 
+from transforms.windows import crop_window
+
 
 class CenteredPatches(torch.nn.Module):
     def __init__(self, patch_size):
@@ -43,7 +45,7 @@ class CenteredPatches(torch.nn.Module):
 
         out_tensors = []
         for image_tensor in image_tensor_list:
-            image_tensor = image_tensor[:, miny: maxy, minx: maxx]
+            image_tensor = crop_window(image_tensor, miny, maxy, minx, maxx)
             out_tensors.append(image_tensor)
 
         sample = {'image_tensor_list': out_tensors, 'item': item}
@@ -91,7 +93,7 @@ def centered_patch_transform(patch_size=(1024, 1024)):
 
         out_tensors = []
         for image_tensor in image_tensor_list:
-            image_tensor = image_tensor[:, miny: maxy, minx: maxx]
+            image_tensor = crop_window(image_tensor, miny, maxy, minx, maxx)
             out_tensors.append(image_tensor)
 
         sample = {'image_tensor_list': out_tensors, 'item': item}
@@ -1,9 +1,10 @@
 import torch
 
 from transforms.patches_random import _find_boundaries
+from transforms.windows import crop_window
 
 class PatchesNormalWrapper(torch.nn.Module):
-    def __init__(self, other_tranform, probability=0.5, patch_size=(1024, 1024), min_breast_overlap=0.5, max_abnorm_overlap=0.1, max_tries=5):
+    def __init__(self, other_tranform, probability=0.5, patch_size=(1024, 1024), min_breast_overlap=0.5, max_abnorm_overlap=0.1, max_tries=5, position_index=None):
         super(PatchesNormalWrapper, self).__init__()
         self.other_tranform = other_tranform
         self.probability = probability
@@ -11,14 +12,27 @@ class PatchesNormalWrapper(torch.nn.Module):
         self.min_breast_overlap = min_breast_overlap
         self.max_abnorm_overlap = max_abnorm_overlap
         self.max_tries = max_tries
+        # A NormalPatchIndex of the valid patch origins, which replaces the rejection sampling
+        self.position_index = position_index
 
     def forward(self, sample):
         choice = torch.randint(0, 100, (1,))
         if choice >= self.probability * 100:
             return self.other_tranform(sample)
+        elif self.position_index is not None:
+            image_tensor_list, item = sample['image_tensor_list'], sample['item']
+            origin = self.position_index.sample(item['image_path'])
+            if origin is None:
+                # No patch of this mammogram avoids its lesions
+                return self.other_tranform(sample)
+            patch_x, patch_y = origin
+            out_tensors = [crop_window(image_tensor, patch_y, patch_y + self.patch_size[1],
+                                       patch_x, patch_x + self.patch_size[0]) for image_tensor in image_tensor_list]
+            item['pathology'] = 'NORMAL'
+            return {'image_tensor_list': out_tensors, 'item': item}
         else:
             image_tensor_list, item = sample['image_tensor_list'], sample['item']
-            image_shape = image_tensor_list[0].shape
+            image_shape = image_tensor_list[-1].shape[1:3]
 
             abnorm_w = (item['maxx'] - item['minx']) / 2
             abnorm_x = int(abnorm_w + item['minx'])
@@ -41,20 +55,21 @@ class PatchesNormalWrapper(torch.nn.Module):
                                                                                       self.min_breast_overlap)
             counter = 0
             while (True):
-                patch_y = torch.randint(breast_min_y, breast_max_y, (1,))
-                patch_x = torch.randint(breast_min_x, breast_max_x, (1,))
+                patch_y = torch.randint(breast_min_y, breast_max_y + 1, (1,))
+                patch_x = torch.randint(breast_min_x, breast_max_x + 1, (1,))
 
                 if (patch_x < abnorm_min_x or patch_x > abnorm_max_x) and (
                         patch_y < abnorm_min_y or patch_y > abnorm_max_y):
                     break
                 counter += 1
-                if counter == 5:
+                if counter == self.max_tries:
                     # print('Giving up')
                     return self.other_tranform(sample)
 
             out_tensors = []
             for image_tensor in image_tensor_list:
-                image_tensor = image_tensor[patch_y: patch_y + self.patch_size[1], patch_x: patch_x + self.patch_size[0]]
+                image_tensor = crop_window(image_tensor, patch_y, patch_y + self.patch_size[1],
+                                           patch_x, patch_x + self.patch_size[0])
                 out_tensors.append(image_tensor)
 
             item['pathology'] = 'NORMAL'
@@ -62,6 +77,11 @@ class PatchesNormalWrapper(torch.nn.Module):
             return sample
         pass
 
+    def __repr__(self):
+        detail = f"({self.other_tranform}, probability={self.probability}, patch_size={self.patch_size}, " \
+                 f"min_breast_overlap={self.min_breast_overlap}, max_abnorm_overlap={self.max_abnorm_overlap})"
+        return f"{self.__class__.__name__}{detail}"
+
 
 def normal_patch_transform_wrapper(other_tranform, probability=0.5, patch_size=(1024, 1024), min_breast_overlap=0.5, max_abnorm_overlap=0.1, max_tries=5):
     def perform(sample):
@@ -70,7 +90,7 @@ def normal_patch_transform_wrapper(other_tranform, probability=0.5, patch_size=(
             return other_tranform(sample)
         else:
             image_tensor_list, item = sample['image_tensor_list'], sample['item']
-            image_shape = image_tensor_list[0].shape
+            image_shape = image_tensor_list[-1].shape[1:3]
 
             abnorm_w = (item['maxx'] - item['minx']) / 2
             abnorm_x = int(abnorm_w + item['minx'])
@@ -93,20 +113,21 @@ def normal_patch_transform_wrapper(other_tranform, probability=0.5, patch_size=(
                                                                                       min_breast_overlap)
             counter = 0
             while (True):
-                patch_y = torch.randint(breast_min_y, breast_max_y, (1,))
-                patch_x = torch.randint(breast_min_x, breast_max_x, (1,))
+                patch_y = torch.randint(breast_min_y, breast_max_y + 1, (1,))
+                patch_x = torch.randint(breast_min_x, breast_max_x + 1, (1,))
 
                 if (patch_x < abnorm_min_x or patch_x > abnorm_max_x) and (
                         patch_y < abnorm_min_y or patch_y > abnorm_max_y):
                     break
                 counter += 1
-                if counter == 5:
+                if counter == max_tries:
                     # print('Giving up')
                     return other_tranform(sample)
 
             out_tensors = []
             for image_tensor in image_tensor_list:
-                image_tensor = image_tensor[patch_y: patch_y + patch_size[1], patch_x: patch_x + patch_size[0]]
+                image_tensor = crop_window(image_tensor, patch_y, patch_y + patch_size[1],
+                                           patch_x, patch_x + patch_size[0])
                 out_tensors.append(image_tensor)
 
             item['pathology'] = 'NORMAL'
@@ -1,5 +1,7 @@
 import torch
 
+from transforms.windows import crop_window
+
 
 def _find_boundaries(x, y, w, h, image_shape, patch_size, min_overlap):
     max_h, min_h = max(h, patch_size[1]), min(h, patch_size[1])
@@ -40,7 +42,8 @@ class RandomPatches(torch.nn.Module):
 
         out_tensors = []
         for image_tensor in image_tensor_list:
-            image_tensor_cropped = image_tensor[:, patch_y: patch_y + self.patch_size[1], patch_x: patch_x + self.patch_size[0]]
+            image_tensor_cropped = crop_window(image_tensor, patch_y, patch_y + self.patch_size[1],
+                                               patch_x, patch_x + self.patch_size[0])
             out_tensors.append(image_tensor_cropped)
 
         sample = {'image_tensor_list': out_tensors, 'item': item}
@@ -0,0 +1,9 @@
+import torch
+
+
+def crop_window(image, miny, maxy, minx, maxx):
+    miny, maxy, minx, maxx = int(miny), int(maxy), int(minx), int(maxx)
+    if isinstance(image, torch.Tensor):
+        return image[:, miny: maxy, minx: maxx]
+    # Lazy image sources decode only the requested region
+    return image.read_window(miny, maxy, minx, maxx)
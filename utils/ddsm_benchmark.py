@@ -0,0 +1,249 @@
+import argparse
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+
+import numpy as np
+import torch
+
+from ddsm_dataset_factory import CBISDDSMDatasetFactory
+from utils.ddsm_downloader import CBISDDSMDownloader
+from utils.ddsm_png_converter import CBISDDSMConverter
+from utils.ddsm_preprocessor import CBISDDSMPreprocessor
+from utils.ddsm_synthetic import CBISDDSMSyntheticGenerator
+
+
+class SyntheticTCIAServer:
+    """Local HTTP server answering the metadata and image requests of the downloader from a synthetic source folder."""
+
+    def __init__(self, source_path):
+        self.__series = {}
+        for subject in os.listdir(source_path):
+            for study_uid in os.listdir(os.path.join(source_path, subject)):
+                for series_uid in os.listdir(os.path.join(source_path, subject, study_uid)):
+                    self.__series[series_uid] = (subject, study_uid,
+                                                 os.path.join(source_path, subject, study_uid, series_uid))
+        self.__server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.__handler())
+        self.__thread = None
+
+    def __handler(self):
+        series = self.__series
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                series_uid = self.path.split('SeriesInstanceUID=')[-1]
+                if series_uid not in series:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                subject, study_uid, path = series[series_uid]
+                dcm_list = sorted(item for item in os.listdir(path) if item.endswith('.dcm'))
+                if 'getSeriesMetaData' in self.path:
+                    body = json.dumps([{'Subject ID': subject, 'Study UID': study_uid, 'Series UID': series_uid,
+                                        'Number of Images': str(len(dcm_list))}]).encode('utf-8')
+                else:
+                    buffer = io.BytesIO()
+                    with zipfile.ZipFile(buffer, 'w') as z:
+                        for item in dcm_list:
+                            z.write(os.path.join(path, item), item)
+                    body = buffer.getvalue()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    @property
+    def base_url_image(self):
+        return 'http://127.0.0.1:{}/getImage?SeriesInstanceUID={{}}'.format(self.__server.server_address[1])
+
+    @property
+    def base_url_metadata(self):
+        return 'http://127.0.0.1:{}/getSeriesMetaData?SeriesInstanceUID={{}}'.format(self.__server.server_address[1])
+
+    def __enter__(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class CBISDDSMBenchmark:
+    """Measures setup and dataset throughput on a synthetic dataset and writes the results as json."""
+
+    def __init__(self, path, num_patients=8, height=3000, width=2000, num_samples=32, num_workers=None,
+                 patch_shape=(1024, 1024), regenerate=False):
+        self.__path = path
+        self.__num_patients = num_patients
+        self.__height = height
+        self.__width = width
+        self.__num_samples = num_samples
+        self.__num_workers = num_workers
+        self.__patch_shape = tuple(patch_shape)
+        self.__regenerate = regenerate
+        self.__results = []
+
+    def __measure(self, name, function, unit, setup=None):
+        # A failing benchmark is recorded and does not stop the others. The setup is not timed.
+        print(f'Benchmark {name}...')
+        result = {'name': name, 'unit': unit}
+        try:
+            args = (setup(),) if setup is not None else ()
+            start = time.perf_counter()
+            items = function(*args)
+            result['seconds'] = time.perf_counter() - start
+        except Exception as exc:
+            result['error'] = f'{type(exc).__name__}: {exc}'
+            print(f'{name} generated an exception: {exc}')
+            self.__results.append(result)
+            return
+        result['items'] = items
+        result['items_per_second'] = items / result['seconds'] if result['seconds'] > 0 else None
+        self.__results.append(result)
+
+    @staticmethod
+    def __count_files(path, extension):
+        return sum(1 for _, _, files in os.walk(path) for name in files if name.endswith(extension))
+
+    def __factory(self, config_path):
+        return CBISDDSMDatasetFactory(config_path, include_train_set=True, include_test_set=True,
+                                      include_masses=True, include_calcifications=True)
+
+    def __getitem(self, dataset):
+        torch.manual_seed(0)
+        for i in range(self.__num_samples):
+            dataset[i % len(dataset)]
+        return self.__num_samples
+
+    def __dataset_benchmarks(self, config_path):
+        patch_shape = self.__patch_shape
+        configurations = {
+            'getitem_whole_image': lambda: self.__factory(config_path),
+            'getitem_centered_patch': lambda: self.__factory(config_path).lesion_patches_centered(patch_shape),
+            'getitem_random_patch': lambda: self.__factory(config_path).lesion_patches_random(patch_shape),
+            'getitem_normal_patch': lambda: self.__factory(config_path).lesion_patches_random(
+                patch_shape, normal_probability=0.5),
+        }
+        for name, factory in configurations.items():
+            self.__measure(name, self.__getitem, 'samples', setup=lambda: factory().create_classification('pathology'))
+
+        cached = {}
+
+        def cache_here():
+            cached['factory'] = self.__factory(config_path).lesion_patches_centered(patch_shape) \
+                .cache_here(num_workers=self.__num_workers)
+            return len(cached['factory'].create_classification('pathology'))
+
+        self.__measure('cache_here_centered_patch', cache_here, 'samples')
+        if 'factory' in cached:
+            self.__measure('getitem_cached_centered_patch', self.__getitem, 'samples',
+                           setup=lambda: cached['factory'].create_classification('pathology'))
+
+    def __environment(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'torch': torch.__version__}
+
+    def start(self, output_path=None):
+        self.__results = []
+        generator = CBISDDSMSyntheticGenerator(self.__path, self.__num_patients, self.__height, self.__width)
+        if self.__regenerate or not os.path.exists(generator.config_path):
+            shutil.rmtree(self.__path, ignore_errors=True)
+            os.makedirs(self.__path)
+
+            def generate():
+                generator.start()
+                return self.__count_files(generator.source_path, '.dcm')
+
+            self.__measure('generate', generate, 'files')
+        with open(generator.config_path) as fin:
+            config = json.load(fin)
+        download_path = config['download_path']
+        shutil.rmtree(download_path, ignore_errors=True)
+
+        with SyntheticTCIAServer(generator.source_path) as server:
+            downloader = CBISDDSMDownloader(config['manifest'], download_path, base_url_image=server.base_url_image,
+                                            base_url_metadata=server.base_url_metadata)
+
+            def download():
+                downloader.start()
+                return self.__count_files(download_path, '.dcm')
+
+            self.__measure('download', download, 'files')
+
+        converter = CBISDDSMConverter(download_path, max_workers=self.__num_workers)
+
+        def convert():
+            converter.start()
+            return self.__count_files(download_path, '.png')
+
+        self.__measure('convert', convert, 'files')
+
+        preprocessor = CBISDDSMPreprocessor(download_path, (config['mass_train_csv'], config['calc_train_csv']),
+                                            (config['mass_test_csv'], config['calc_test_csv']),
+                                            max_workers=self.__num_workers)
+
+        def preprocess():
+            preprocessor.start()
+            return sum(len(preprocessor.read_rows(csv_files)) for csv_files, _ in preprocessor.outputs())
+
+        self.__measure('preprocess', preprocess, 'abnormalities')
+        self.__dataset_benchmarks(generator.config_path)
+
+        report = {'environment': self.__environment(),
+                  'parameters': {'num_patients': self.__num_patients, 'height': self.__height, 'width': self.__width,
+                                 'num_samples': self.__num_samples, 'num_workers': self.__num_workers,
+                                 'patch_shape': list(self.__patch_shape)},
+                  'results': self.__results}
+        if output_path is not None:
+            with open(output_path, 'w') as fout:
+                json.dump(report, fout, indent=2)
+        self.print_results()
+        return report
+
+    def print_results(self):
+        print('{:<32}{:>10}{:>14}  {}'.format('benchmark', 'seconds', 'items/s', 'unit'))
+        for result in self.__results:
+            if 'error' in result:
+                print('{:<32}{:>10}{:>14}  {}'.format(result['name'], '-', '-', result['error']))
+            else:
+                print('{:<32}{:>10.2f}{:>14.2f}  {}'.format(result['name'], result['seconds'],
+                                                           result['items_per_second'] or 0, result['unit']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CBIS DDSM Benchmark')
+    parser.add_argument('-p', '--path', default='../CBIS_DDSM_synthetic',
+                        help='Path to the synthetic dataset. It is generated if not existing.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Path to the json results.')
+    parser.add_argument('-n', '--patients', type=int, default=8, help='Number of synthetic patients, with 4 images each.')
+    parser.add_argument('--height', type=int, default=3000, help='Height of the synthetic mammograms.')
+    parser.add_argument('--width', type=int, default=2000, help='Width of the synthetic mammograms.')
+    parser.add_argument('-s', '--samples', type=int, default=32, help='Number of samples read per dataset benchmark.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('-r', '--regenerate', action='store_true', help='Generate the synthetic dataset again.')
+    args = parser.parse_args()
+    benchmark = CBISDDSMBenchmark(args.path, args.patients, args.height, args.width, args.samples, args.workers,
+                                  regenerate=args.regenerate)
+    benchmark.start(args.output)
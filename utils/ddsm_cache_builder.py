@@ -0,0 +1,146 @@
+import concurrent.futures
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from utils.ddsm_cache_store import CBISDDSMCacheStore
+
+PRECISIONS = ('uint8', 'uint16', 'float32')
+
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+    torch.set_num_threads(1)
+
+
+def _save_array(array, path, precision, is_mask):
+    # Samples are written under a temporary name, so that an interrupted build leaves no partial sample
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fout:
+        if precision == 'float32':
+            np.save(fout, array.astype(np.float32))
+        elif precision == 'uint16' and not is_mask:
+            # Images are read back normalised by 65536, which makes the 16-bit round trip exact
+            Image.fromarray(np.clip(np.rint(array * 65536), 0, 65535).astype(np.uint16)).save(fout, format='PNG')
+        elif precision == 'uint16':
+            Image.fromarray(np.clip(np.rint(array * 255), 0, 255).astype(np.uint8)).save(fout, format='PNG')
+        else:
+            Image.fromarray((array * 255).astype(np.uint8)).save(fout, format='PNG')
+    os.replace(tmp_path, path)
+
+
+def _changed(old, new):
+    if isinstance(old, float) and isinstance(new, float) and np.isnan(old) and np.isnan(new):
+        return False
+    return old != new
+
+
+def _render_group(samples, samples_path, precision):
+    dataset = _worker_dataset
+    # All lesions of the group share the mammogram, which is decoded only once
+    image = dataset._load_image(dataset.metadata(samples[0][0])['image_path'])
+    for index, key, (image_name, mask_name, item_name) in samples:
+        torch.manual_seed(int(key[:8], 16))
+        metadata = dataset.metadata(index)
+        image_list, item = dataset._load_sample(dict(metadata), image=image)
+        os.makedirs(os.path.dirname(os.path.join(samples_path, image_name)), exist_ok=True)
+        # Patch transforms may relabel the sample (e.g. as NORMAL), which is kept next to it
+        changes = {field: value for field, value in item.items() if _changed(metadata.get(field), value)}
+        if len(changes) > 0:
+            tmp_path = os.path.join(samples_path, item_name) + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as fout:
+                json.dump(changes, fout)
+            os.replace(tmp_path, os.path.join(samples_path, item_name))
+        _save_array(image_list[1].cpu().detach().numpy().squeeze(), os.path.join(samples_path, mask_name),
+                    precision, True)
+        _save_array(image_list[0].cpu().detach().numpy().squeeze(), os.path.join(samples_path, image_name),
+                    precision, False)
+    return len(samples)
+
+
+class CBISDDSMCacheBuilder:
+    """Renders the samples of a dataset that are missing from a cache store.
+
+    Every sample is named by its key, and its random transforms are seeded from the key, so the same lesion renders
+    alike in every configuration and samples already in the store are not rendered again. A lesion may have several
+    keys, one per variant.
+    """
+
+    def __init__(self, dataset, store: CBISDDSMCacheStore, sample_keys, num_workers=None, precision='uint8'):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown cache precision {precision}. Choose one of {PRECISIONS}.')
+        self.__dataset = dataset
+        self.__store = store
+        self.__sample_keys = sample_keys
+        self.__num_workers = num_workers
+        self.__precision = precision
+
+    @staticmethod
+    def __mp_context():
+        # Forked workers inherit the dataset, so transforms need not be picklable
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        return None
+
+    def __group_samples(self, samples):
+        # Samples of the same mammogram are rendered by the same worker
+        codes = self.__dataset.records.codes('image_path')
+        groups = {}
+        for sample in samples:
+            groups.setdefault(codes[sample[0]], []).append(sample)
+        return list(groups.values())
+
+    def start(self):
+        # Lesions with the same key render the same sample, which is rendered once
+        samples = {}
+        for index, keys in enumerate(self.__sample_keys):
+            for key in keys:
+                if key not in samples:
+                    samples[key] = (index, key, self.__store.sample_names(key, self.__precision))
+        missing = [sample for sample in samples.values() if not self.__store.is_cached(sample[2][:2])]
+        num_cached = len(samples) - len(missing)
+        if num_cached > 0:
+            print(f'{num_cached} of {len(samples)} samples already cached.')
+        if len(missing) == 0:
+            return self.__results()
+
+        num_fails = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.__num_workers,
+                                                    mp_context=self.__mp_context(),
+                                                    initializer=_init_worker,
+                                                    initargs=(self.__dataset,)) as executor, \
+                tqdm(total=len(samples), initial=num_cached, unit='sample') as progress_bar:
+            future_to_group = {executor.submit(_render_group, group, self.__store.samples_path, self.__precision):
+                               group for group in self.__group_samples(missing)}
+            for future in concurrent.futures.as_completed(future_to_group):
+                group = future_to_group[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    num_fails += len(group)
+                    print(f"Samples {[index for index, _, _ in group]} generated an exception: {exc}")
+                    continue
+                progress_bar.update(len(group))
+
+        if num_fails > 0:
+            raise Exception(f'Caching failed for {num_fails} samples. Re-run to render the missing samples.')
+        return self.__results()
+
+    def __results(self):
+        # The sample names of every variant of every lesion, with the lesion attributes the transforms changed
+        results = {}
+        for index, keys in enumerate(self.__sample_keys):
+            variants = []
+            for key in keys:
+                image_name, mask_name, item_name = self.__store.sample_names(key, self.__precision)
+                variants.append((image_name, mask_name, self.__store.read_item(item_name)))
+            results[index] = variants
+        return results
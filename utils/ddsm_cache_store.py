@@ -0,0 +1,195 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+SAMPLES_FOLDER_NAME = 'samples'
+CONFIGS_FOLDER_NAME = 'configs'
+SHARDS_FOLDER_NAME = 'shards'
+# Lesion attributes that determine the pixels of a rendered sample
+SAMPLE_KEY_FIELDS = ('image_path', 'mask_path', 'minx', 'maxx', 'miny', 'maxy', 'cx', 'cy',
+                     'breast_minx', 'breast_maxx', 'breast_miny', 'breast_maxy', 'breast_cx', 'breast_cy')
+
+
+def sample_extensions(precision):
+    return ('.npy', '.npy') if precision == 'float32' else ('.png', '.png')
+
+
+class CBISDDSMCacheStore:
+    """Rendered samples shared by all cache configurations of a download folder, addressed by their content.
+
+    The key of a sample hashes the attributes that determine its pixels together with the transform specification,
+    so datasets that differ only in their filters, mappings or subsets share their samples. Every configuration
+    records the samples it uses, which tells the garbage collection what is still needed.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.samples_path = os.path.join(cache_path, SAMPLES_FOLDER_NAME)
+        self.configs_path = os.path.join(cache_path, CONFIGS_FOLDER_NAME)
+        self.shards_path = os.path.join(cache_path, SHARDS_FOLDER_NAME)
+
+    @staticmethod
+    def sample_keys(dataframe, spec, variants=1):
+        # The first variant keeps the key of a single rendering, so that it is shared with caches without variants
+        fields = [field for field in SAMPLE_KEY_FIELDS if field in dataframe.columns]
+        columns = [dataframe[field].astype(str).tolist() for field in fields]
+        keys = []
+        for values in zip(*columns):
+            key = hashlib.sha1('|'.join((spec,) + values).encode('utf-8')).hexdigest()
+            keys.append([key] + [hashlib.sha1(f'{key}|variant={variant}'.encode('utf-8')).hexdigest()
+                                 for variant in range(1, variants)])
+        return keys
+
+    @staticmethod
+    def sample_names(key, precision):
+        # Two characters of the key spread the samples over subfolders
+        image_extension, mask_extension = sample_extensions(precision)
+        return (os.path.join(key[:2], key + image_extension), os.path.join(key[:2], key + '_mask' + mask_extension),
+                os.path.join(key[:2], key + '_item.json'))
+
+    def read_item(self, item_name):
+        # Lesion attributes changed by the transforms, e.g. the label of normal patches
+        item_path = os.path.join(self.samples_path, item_name)
+        if not os.path.exists(item_path):
+            return {}
+        with open(item_path) as fin:
+            return json.load(fin)
+
+    def is_cached(self, names):
+        return all(os.path.exists(os.path.join(self.samples_path, name)) for name in names)
+
+    def register(self, spec, names):
+        # The modification time of the configuration records when it was last used
+        os.makedirs(self.configs_path, exist_ok=True)
+        files = sorted({name for sample_names in names for name in sample_names})
+        config_name = hashlib.sha1('\n'.join([spec] + files).encode('utf-8')).hexdigest() + '.json'
+        config_path = os.path.join(self.configs_path, config_name)
+        if os.path.exists(config_path):
+            os.utime(config_path)
+            return config_path
+        tmp_path = config_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({'spec': spec, 'files': files}, fout)
+        os.replace(tmp_path, config_path)
+        return config_path
+
+    def config_shard_path(self, config_path):
+        # Shards packing the samples of a configuration, which live as long as the configuration
+        return os.path.join(self.shards_path, os.path.splitext(os.path.basename(config_path))[0])
+
+    def __configs(self):
+        if not os.path.isdir(self.configs_path):
+            return []
+        configs = []
+        for entry in os.scandir(self.configs_path):
+            if entry.name.endswith('.json'):
+                with open(entry.path) as fin:
+                    configs.append((entry.path, entry.stat().st_mtime, json.load(fin)['files']))
+        return configs
+
+    def __sample_sizes(self):
+        sizes = {}
+        if not os.path.isdir(self.samples_path):
+            return sizes
+        for folder in os.scandir(self.samples_path):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    sizes[os.path.join(folder.name, entry.name)] = entry.stat().st_size
+        return sizes
+
+    def __legacy_folders(self):
+        # Caches of earlier versions, one folder per configuration
+        if not os.path.isdir(self.cache_path):
+            return []
+        return [entry.path for entry in os.scandir(self.cache_path) if entry.is_dir() and
+                entry.name not in (SAMPLES_FOLDER_NAME, CONFIGS_FOLDER_NAME, SHARDS_FOLDER_NAME)]
+
+    def __orphan_shards(self, configs):
+        # Shards of configurations that were forgotten
+        if not os.path.isdir(self.shards_path):
+            return []
+        used = {os.path.basename(self.config_shard_path(config_path)) for config_path, _, _ in configs}
+        return [entry.path for entry in os.scandir(self.shards_path) if entry.is_dir() and entry.name not in used]
+
+    @staticmethod
+    def __folder_size(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+    @staticmethod
+    def __key(name):
+        # Sample files are named by the 40 hexadecimal digits of their key, followed by a suffix
+        return os.path.basename(name)[:40]
+
+    def __referenced_keys(self, configs):
+        return set(self.__key(name) for _, _, files in configs for name in files)
+
+    def report(self):
+        sizes = self.__sample_sizes()
+        configs = self.__configs()
+        referenced = self.__referenced_keys(configs)
+        legacy = self.__legacy_folders()
+        return {'configurations': len(configs),
+                'files': len(sizes),
+                'bytes': sum(sizes.values()),
+                # Bytes the configurations would take if every one of them stored its own samples
+                'configuration_bytes': sum(sizes.get(name, 0) for _, _, files in configs for name in files),
+                'unreferenced_files': sum(1 for name in sizes if self.__key(name) not in referenced),
+                'unreferenced_bytes': sum(size for name, size in sizes.items() if self.__key(name) not in referenced),
+                'shard_bytes': self.__folder_size(self.shards_path),
+                'orphan_shard_bytes': sum(self.__folder_size(path) for path in self.__orphan_shards(configs)),
+                'legacy_folders': len(legacy),
+                'legacy_bytes': sum(self.__folder_size(path) for path in legacy)}
+
+    def print_report(self):
+        report = self.report()
+        print('{} configurations share {} files, {:.1f} MB ({:.1f} MB if stored separately).'.format(
+            report['configurations'], report['files'], report['bytes'] / 1e6, report['configuration_bytes'] / 1e6))
+        print('{} files, {:.1f} MB, are not used by any configuration.'.format(
+            report['unreferenced_files'], report['unreferenced_bytes'] / 1e6))
+        if report['shard_bytes'] > 0:
+            print('Shards take {:.1f} MB, of which {:.1f} MB belong to no configuration.'.format(
+                report['shard_bytes'] / 1e6, report['orphan_shard_bytes'] / 1e6))
+        if report['legacy_folders'] > 0:
+            print('{} caches of earlier versions take {:.1f} MB.'.format(report['legacy_folders'],
+                                                                      report['legacy_bytes'] / 1e6))
+        return report
+
+    def collect_garbage(self, max_age_days=None, legacy=True):
+        # Configurations unused for max_age_days are forgotten, then every sample they alone used is removed
+        freed = 0
+        if max_age_days is not None:
+            oldest = time.time() - max_age_days * 24 * 3600
+            for config_path, last_used, _ in self.__configs():
+                if last_used < oldest:
+                    os.remove(config_path)
+        referenced = self.__referenced_keys(self.__configs())
+        for name, size in self.__sample_sizes().items():
+            if self.__key(name) not in referenced:
+                os.remove(os.path.join(self.samples_path, name))
+                freed += size
+        for path in self.__orphan_shards(self.__configs()):
+            freed += self.__folder_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+        if legacy:
+            for path in self.__legacy_folders():
+                freed += self.__folder_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+        print('Freed {:.1f} MB.'.format(freed / 1e6))
+        return freed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CBIS DDSM Cache Store')
+    parser.add_argument('-p', '--path', default='../CBIS_DDSM', help='Path to the download folder.')
+    parser.add_argument('-g', '--gc', action='store_true',
+                        help='Remove the samples that no cache configuration uses, and the caches of earlier versions.')
+    parser.add_argument('-a', '--max_age', type=float, default=None,
+                        help='With --gc, first forget the configurations that were not used for this many days.')
+    args = parser.parse_args()
+    store = CBISDDSMCacheStore(os.path.join(args.path, 'cache'))
+    if args.gc:
+        store.collect_garbage(args.max_age)
+    store.print_report()
@@ -1,9 +1,13 @@
 import concurrent.futures
 import requests
 import zipfile
-from io import BytesIO
 import os
 import json
+import shutil
+import tempfile
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import argparse
 
@@ -12,13 +16,34 @@ BASE_URL_METADATA = 'https://services.cancerimagingarchive.net/nbia-api/services
 
 
 class CBISDDSMDownloader:
-    def __init__(self, manifest_path, download_path, skip_existing=True):
+    def __init__(self, manifest_path, download_path, skip_existing=True, max_workers=None, retries=5,
+                 backoff_factor=1.0, chunk_size=2 ** 20, timeout=60,
+                 base_url_image=BASE_URL_IMAGE, base_url_metadata=BASE_URL_METADATA):
         self.__skip_existing = skip_existing
         self.__download_path = download_path
         self.__manifest_file_path = manifest_path
         self.__image_series_UID = []
+        self.__max_workers = max_workers if max_workers is not None else min(32, (os.cpu_count() or 1) + 4)
+        self.__retries = retries
+        self.__backoff_factor = backoff_factor
+        self.__chunk_size = chunk_size
+        self.__timeout = timeout
+        self.__base_url_image = base_url_image
+        self.__base_url_metadata = base_url_metadata
+        self.__session = self.__create_session()
+
+    def __create_session(self):
+        # Connections are pooled across worker threads, and transient HTTP failures are retried with backoff
+        retry = Retry(total=self.__retries, backoff_factor=self.__backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__max_workers, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def __parse_manifest(self):
+        self.__image_series_UID = []
         with open(self.__manifest_file_path) as file:
             found_starting_line_flag = False
             for line in file:
@@ -33,9 +58,9 @@ class CBISDDSMDownloader:
             else:
                 print("Incorrect format of the manifest file provided!")
 
-    @staticmethod
-    def __get_metadata(series_uid):
-        response = requests.get(BASE_URL_METADATA.format(series_uid))
+    def __get_metadata(self, series_uid):
+        response = self.__session.get(self.__base_url_metadata.format(series_uid), timeout=self.__timeout)
+        response.raise_for_status()
         response_dict = json.loads(response.content.decode("utf-8"))[0]
         return response_dict
 
@@ -48,11 +73,44 @@ class CBISDDSMDownloader:
                 return True
         return False
 
-    @staticmethod
-    def __download_extract_image(series_uid, path):
-        response = requests.get(BASE_URL_IMAGE.format(series_uid))
-        with zipfile.ZipFile(BytesIO(response.content)) as z:
-            z.extractall(path)
+    def __spool(self, series_uid, spool_file):
+        with self.__session.get(self.__base_url_image.format(series_uid), stream=True,
+                                timeout=self.__timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=self.__chunk_size):
+                spool_file.write(chunk)
+        spool_file.flush()
+
+    def __extract(self, spool_file, path):
+        os.makedirs(path, exist_ok=True)
+        with zipfile.ZipFile(spool_file) as z:
+            for member in z.infolist():
+                if member.is_dir():
+                    continue
+                # Members are copied chunk by chunk and appear under their name only once complete
+                output_path = os.path.join(path, *(part for part in member.filename.split('/')
+                                                   if part not in ('', '.', '..')))
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with z.open(member) as fin, open(output_path + '.part', 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, self.__chunk_size)
+                os.replace(output_path + '.part', output_path)
+
+    def __download_extract_image(self, series_uid, path):
+        os.makedirs(self.__download_path, exist_ok=True)
+        for attempt in range(self.__retries + 1):
+            # The series is spooled to disk instead of memory, next to its destination
+            with tempfile.TemporaryFile(dir=self.__download_path) as spool_file:
+                try:
+                    self.__spool(series_uid, spool_file)
+                    spool_file.seek(0)
+                    self.__extract(spool_file, path)
+                    return
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                        zipfile.BadZipFile):
+                    # Broken transfers are not covered by the adapter retries
+                    if attempt == self.__retries:
+                        raise
+            time.sleep(self.__backoff_factor * 2 ** attempt)
 
     def __payload(self, seriesUID):
         metadata = self.__get_metadata(seriesUID)
@@ -63,14 +121,22 @@ class CBISDDSMDownloader:
         download_path = os.path.join(self.__download_path, folder_name, study_uid, series_uid)
 
         if self.__skip_existing and self.__exists(download_path, num_imgs):
-            return
+            return download_path
 
         self.__download_extract_image(seriesUID, download_path)
+        return download_path
+
+    def series_uids(self):
+        self.__parse_manifest()
+        return list(self.__image_series_UID)
+
+    def download_series(self, series_uid):
+        return self.__payload(series_uid)
 
     def start(self):
         self.__parse_manifest()
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
             # Start the load operations and mark each future with its URL
             future_to_url = {executor.submit(self.__payload, uid): uid for uid in self.__image_series_UID}
             for future in tqdm(concurrent.futures.as_completed(future_to_url), total=len(self.__image_series_UID), unit="file"):
@@ -87,6 +153,8 @@ if __name__ == "__main__":
                         help='Path to the manifest file.')
     parser.add_argument('-p', '--path', default='../CBIS_DDSM',
                         help='Path to the download folder. It will be created if not existing.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of parallel downloads.')
     args = parser.parse_args()
-    downloader = CBISDDSMDownloader(args.manifest, args.path)
+    downloader = CBISDDSMDownloader(args.manifest, args.path, max_workers=args.workers)
     downloader.start()
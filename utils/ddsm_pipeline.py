@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+
+from tqdm import tqdm
+
+_STOP = None
+
+
+class CBISDDSMPipeline:
+    """Runs download, conversion and preprocessing as concurrent stages connected by bounded queues.
+
+    Every series is converted as soon as it is downloaded, and the abnormalities of a mammogram are preprocessed
+    together as soon as the series of the image and of all their ROI masks are converted, so that the breast is
+    contoured once per mammogram. When the images are packed into shards, preprocessing waits for the shard index,
+    which is written once all conversions are done.
+    """
+
+    def __init__(self, downloader, converter, preprocessor, download_workers=None, convert_workers=None,
+                 preprocess_workers=None, queue_size=16):
+        self.__downloader = downloader
+        self.__converter = converter
+        self.__preprocessor = preprocessor
+        self.__download_workers = download_workers if download_workers is not None else \
+            min(32, (os.cpu_count() or 1) + 4)
+        self.__convert_workers = convert_workers if convert_workers is not None else (os.cpu_count() or 1)
+        self.__preprocess_workers = preprocess_workers if preprocess_workers is not None else (os.cpu_count() or 1)
+        self.__queue_size = queue_size
+        self.__lock = threading.Lock()
+
+    def __initialize(self):
+        self.__uid_queue = queue.Queue()
+        self.__convert_queue = queue.Queue(maxsize=self.__queue_size)
+        self.__preprocess_queue = queue.Queue(maxsize=self.__queue_size)
+        self.__rows = []
+        self.__images = {}
+        self.__results = []
+        self.__missing = {}
+        self.__waiting = {}
+        self.__deferred = []
+        self.__num_fails = 0
+
+    def __track_rows(self):
+        image_series = {}
+        for output_index, (csv_files, _) in enumerate(self.__preprocessor.outputs()):
+            for row in self.__preprocessor.read_rows(csv_files):
+                row_id = len(self.__rows)
+                self.__rows.append((output_index, row))
+                image_path = self.__preprocessor.row_image(row)
+                self.__images.setdefault(image_path, []).append(row_id)
+                image_series.setdefault(image_path, set()).update(self.__preprocessor.row_series(row))
+        for image_path, series in image_series.items():
+            self.__missing[image_path] = len(series)
+            for series_path in series:
+                self.__waiting.setdefault(series_path, []).append(image_path)
+
+    def __series_ready(self, series_path):
+        ready = []
+        with self.__lock:
+            for image_path in self.__waiting.pop(os.path.normpath(series_path), []):
+                self.__missing[image_path] -= 1
+                if self.__missing[image_path] == 0:
+                    del self.__missing[image_path]
+                    ready.append(image_path)
+            if self.__preprocessor.sharded:
+                self.__deferred.extend(ready)
+                return
+        for image_path in ready:
+            self.__preprocess_queue.put(image_path)
+
+    def __fail(self, name, exc):
+        with self.__lock:
+            self.__num_fails += 1
+        print(f"{name} generated an exception: {exc}")
+
+    def __download_worker(self, progress_bar):
+        while True:
+            try:
+                series_uid = self.__uid_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.__convert_queue.put(self.__downloader.download_series(series_uid))
+            except Exception as exc:
+                self.__fail(series_uid, exc)
+            progress_bar.update(1)
+
+    def __convert_worker(self):
+        while True:
+            series_path = self.__convert_queue.get()
+            if series_path is _STOP:
+                return
+            try:
+                self.__converter.convert_series(series_path)
+            except Exception as exc:
+                self.__fail(series_path, exc)
+                continue
+            self.__series_ready(series_path)
+
+    def __preprocess_worker(self, progress_bar):
+        while True:
+            image_path = self.__preprocess_queue.get()
+            if image_path is _STOP:
+                return
+            row_ids = self.__images[image_path]
+            item_dicts = self.__preprocessor.process_rows([self.__rows[row_id][1] for row_id in row_ids])
+            with self.__lock:
+                for row_id, item_dict in zip(row_ids, item_dicts):
+                    if item_dict is not None:
+                        self.__results.append((row_id, self.__rows[row_id][0], item_dict))
+            progress_bar.update(len(row_ids))
+
+    @staticmethod
+    def __run(target, num_workers, *args):
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def start(self):
+        self.__initialize()
+        for series_uid in self.__downloader.series_uids():
+            self.__uid_queue.put(series_uid)
+        self.__track_rows()
+
+        series_bar = tqdm(total=self.__uid_queue.qsize(), unit='series', position=0)
+        rows_bar = tqdm(total=len(self.__rows), unit='abnormalities', position=1)
+        with self.__preprocessor:
+            with self.__converter:
+                download_threads = self.__run(self.__download_worker, self.__download_workers, series_bar)
+                convert_threads = self.__run(self.__convert_worker, self.__convert_workers)
+                preprocess_threads = self.__run(self.__preprocess_worker, self.__preprocess_workers, rows_bar)
+                for thread in download_threads:
+                    thread.join()
+                for _ in convert_threads:
+                    self.__convert_queue.put(_STOP)
+                for thread in convert_threads:
+                    thread.join()
+            # Shards are readable once the converter has written their index
+            for image_path in self.__deferred:
+                self.__preprocess_queue.put(image_path)
+            for _ in preprocess_threads:
+                self.__preprocess_queue.put(_STOP)
+            for thread in preprocess_threads:
+                thread.join()
+        series_bar.close()
+        rows_bar.close()
+
+        # Rows whose series never arrived are reported like missing files
+        self.__preprocessor.count_not_found(sum(len(self.__images[image_path]) for image_path in self.__missing))
+        outputs = self.__preprocessor.outputs()
+        for output_index, (_, out_csv_path) in enumerate(outputs):
+            data = [item_dict for _, index, item_dict in sorted(self.__results, key=lambda result: result[0])
+                    if index == output_index]
+            self.__preprocessor.write(data, out_csv_path)
+        self.__preprocessor.save_cache()
+        self.__converter.print_timing_summary()
+        if self.__num_fails > 0:
+            print('Download or conversion failed for {} series. Please re-run the setup.'.format(self.__num_fails))
+        self.__preprocessor.report()
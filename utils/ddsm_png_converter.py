@@ -1,22 +1,87 @@
 import concurrent.futures
+import multiprocessing
 import os
+import threading
+import time
+
+import numpy as np
 import pydicom
 from PIL import Image
 from tqdm import tqdm
 import argparse
 
+from utils.shard_store import ShardWriter, ShardStore
+from utils.pyramid import downsample, pyramid_level_path, is_pyramid_level_path, write_pyramid_config
+from utils.tiled_image import write_tiled_image, tiled_image_path, TILED_IMAGE_EXTENSION
+
+TIMING_STAGES = ('read', 'decode', 'pyramid', 'png', 'tiles', 'shard')
+
+
+def _read_dicom(input_path, timings):
+    start = time.perf_counter()
+    ds = pydicom.dcmread(input_path, force=True)
+    timings['read'] = time.perf_counter() - start
+    start = time.perf_counter()
+    pixel_array = ds.pixel_array
+    timings['decode'] = time.perf_counter() - start
+    return pixel_array
+
+
+def _pyramid(pixel_array, pyramid_factors, timings):
+    # The full resolution image followed by its downsampled levels, as (factor, array) pairs
+    levels = [(1, pixel_array)]
+    if len(pyramid_factors) > 0:
+        start = time.perf_counter()
+        levels.extend((factor, downsample(pixel_array, factor)) for factor in pyramid_factors)
+        timings['pyramid'] = time.perf_counter() - start
+    return levels
+
+
+def _dicom_to_png(input_path, output_path, tiled, tile_size, compress_level, pyramid_factors=()):
+    timings = {}
+    levels = _pyramid(_read_dicom(input_path, timings), pyramid_factors, timings)
+    start = time.perf_counter()
+    for factor, array in levels:
+        Image.fromarray(array).save(pyramid_level_path(output_path, factor), format='PNG',
+                                    compress_level=compress_level)
+    timings['png'] = time.perf_counter() - start
+    if tiled:
+        start = time.perf_counter()
+        for factor, array in levels:
+            write_tiled_image(tiled_image_path(pyramid_level_path(output_path, factor)), array, tile_size=tile_size)
+        timings['tiles'] = time.perf_counter() - start
+    return None, timings
+
+
+def _decode_dicom(input_path, pyramid_factors=()):
+    timings = {}
+    return _pyramid(_read_dicom(input_path, timings), pyramid_factors, timings), timings
+
 
 class CBISDDSMConverter:
-    def __init__(self, download_path, skip_existing=True, delete_dcm=False):
+    def __init__(self, download_path, skip_existing=True, delete_dcm=False, tiled=False, tile_size=256,
+                 shard_path=None, max_workers=None, compress_level=6, pyramid_factors=()):
         self.__download_path = download_path
         self.__skip_existing = skip_existing
         self.__delete_dcm = delete_dcm
+        self.__tiled = tiled
+        self.__tile_size = tile_size
+        self.__shard_path = shard_path
+        self.__shard_writer = None
+        # DICOM decoding and PNG encoding hold the GIL, so files are converted in worker processes
+        self.__max_workers = max_workers
+        self.__compress_level = compress_level
+        self.__pyramid_factors = tuple(sorted(pyramid_factors))
+        self.__executor = None
+        self.__lock = threading.Lock()
         self.__initialize_lists()
 
     def __initialize_lists(self):
         self.__dcm_image_list = []
         self.__to_delete_dcm_image_list = []
         self.__num_skipped = 0
+        self.__timings = []
+        self.__shard_keys = set(ShardStore(self.__shard_path).keys()) if self.__shard_path is not None else set()
 
     def __find_images(self, root_path):
         directory_list = os.listdir(root_path)
@@ -27,24 +92,39 @@ class CBISDDSMConverter:
             directory_list_1 = os.listdir(dir_path_1)
             for dir_1 in directory_list_1:
                 dir_path_2 = os.path.join(dir_path_1, dir_1)
+                if not os.path.isdir(dir_path_2):
+                    continue
                 directory_list_2 = os.listdir(dir_path_2)
                 for dir_2 in directory_list_2:
                     dir_path = os.path.join(dir_path_2, dir_2)
-                    contents_list = os.listdir(dir_path)
-                    dcm_list = list(item for item in contents_list if item.endswith('.dcm'))
-                    png_list = list(item for item in contents_list if item.endswith('.png'))
-                    if self.__delete_dcm:
-                        for img in dcm_list:
-                            img_path = os.path.join(dir_path, img)
-                            self.__to_delete_dcm_image_list.append(img_path)
-                    if self.__skip_existing and len(dcm_list) == len(png_list):
-                        self.__num_skipped += len(dcm_list)
+                    if not os.path.isdir(dir_path):
                         continue
-                    for img in dcm_list:
-                        img_path = os.path.join(dir_path, img)
-                        self.__dcm_image_list.append(img_path)
+                    dcm_to_convert, dcm_to_delete, num_skipped = self.__scan_series(dir_path)
+                    self.__dcm_image_list.extend(dcm_to_convert)
+                    self.__to_delete_dcm_image_list.extend(dcm_to_delete)
+                    self.__num_skipped += num_skipped
         print("Found {} dcm images to convert. Skipped {}.".format(len(self.__dcm_image_list), self.__num_skipped))
 
+    def __scan_series(self, dir_path):
+        contents_list = os.listdir(dir_path)
+        dcm_list = list(item for item in contents_list if item.endswith('.dcm'))
+        png_list = list(item for item in contents_list if item.endswith('.png') and not is_pyramid_level_path(item))
+        tiled_list = list(item for item in contents_list
+                          if item.endswith(TILED_IMAGE_EXTENSION) and not is_pyramid_level_path(item))
+        dcm_paths = [os.path.join(dir_path, img) for img in dcm_list]
+        dcm_to_delete = dcm_paths if self.__delete_dcm else []
+        if self.__shard_path is not None:
+            converted = all(pyramid_level_path(self.__shard_key(img_path), factor) in self.__shard_keys
+                            for img_path in dcm_paths for factor in (1,) + self.__pyramid_factors)
+        else:
+            converted = len(dcm_list) == len(png_list) and \
+                        (not self.__tiled or len(dcm_list) == len(tiled_list)) and \
+                        all(os.path.exists(pyramid_level_path(self.__get_png_path(img_path), factor))
+                            for img_path in dcm_paths for factor in self.__pyramid_factors)
+        if self.__skip_existing and converted:
+            return [], dcm_to_delete, len(dcm_list)
+        return dcm_paths, dcm_to_delete, 0
+
     @staticmethod
     def __get_png_path(dcm_path):
         path, name_ext = os.path.split(dcm_path)
@@ -54,39 +134,113 @@ class CBISDDSMConverter:
         output_path = os.path.join(path, name + '.png')
         return output_path
 
-    @staticmethod
-    def __dicom_to_png(input_path, output_path):
-        ds = pydicom.dcmread(input_path, force=True)
-        pixel_array = ds.pixel_array
-        image = Image.fromarray(pixel_array)
-        image.save(output_path, format='PNG', lossless=True)
+    def __shard_key(self, dcm_path):
+        # Images are keyed by the PNG path relative to the download folder, as referenced by the lesion csv files
+        return os.path.relpath(self.__get_png_path(dcm_path), self.__download_path)
+
+    def __submit_convert(self, input_path):
+        if self.__shard_writer is not None:
+            return self.__executor.submit(_decode_dicom, input_path, self.__pyramid_factors)
+        return self.__executor.submit(_dicom_to_png, input_path, self.__get_png_path(input_path), self.__tiled,
+                                      self.__tile_size, self.__compress_level, self.__pyramid_factors)
 
-    def __payload_convert(self, input_path):
-        output_path = self.__get_png_path(input_path)
-        self.__dicom_to_png(input_path, output_path)
+    def __finish_convert(self, input_path, future):
+        levels, timings = future.result()
+        if levels is not None:
+            start = time.perf_counter()
+            for factor, array in levels:
+                self.__shard_writer.add(pyramid_level_path(self.__shard_key(input_path), factor), array)
+            timings['shard'] = time.perf_counter() - start
+        with self.__lock:
+            self.__timings.append(timings)
 
     def __payload_delete(self, input_path):
         os.remove(input_path)
 
+    @staticmethod
+    def __mp_context():
+        # Forked workers do not re-import the calling script, which setup.py does not guard
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        return None
+
+    def __enter__(self):
+        self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.__max_workers,
+                                                                 mp_context=self.__mp_context())
+        # Forked pools start all workers on the first task, here before the setup pipeline starts its threads
+        self.__executor.submit(int).result()
+        if self.__shard_path is not None:
+            self.__shard_writer = ShardWriter(self.__shard_path)
+        if len(self.__pyramid_factors) > 0:
+            # Datasets read the available levels from here
+            os.makedirs(self.__download_path, exist_ok=True)
+            write_pyramid_config(self.__download_path, self.__pyramid_factors)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__executor.shutdown()
+        self.__executor = None
+        if self.__shard_writer is not None:
+            self.__shard_writer.close()
+            self.__shard_writer = None
+
+    def convert_series(self, series_path):
+        # Converts a single downloaded series. This must run inside a `with converter:` block.
+        dcm_to_convert, dcm_to_delete, _ = self.__scan_series(series_path)
+        futures = [(img_path, self.__submit_convert(img_path)) for img_path in dcm_to_convert]
+        for img_path, future in futures:
+            self.__finish_convert(img_path, future)
+        for img_path in dcm_to_delete:
+            self.__payload_delete(img_path)
+        return len(dcm_to_convert)
+
+    def timing_summary(self):
+        # Per-file seconds spent in every conversion stage, over the files converted so far
+        with self.__lock:
+            timings = list(self.__timings)
+        summary = {}
+        for stage in TIMING_STAGES:
+            values = np.array([t[stage] for t in timings if stage in t])
+            if len(values) == 0:
+                continue
+            summary[stage] = {'files': len(values), 'total': values.sum(), 'mean': values.mean(),
+                              'median': np.median(values), 'p95': np.percentile(values, 95), 'max': values.max()}
+        return summary
+
+    def print_timing_summary(self, elapsed=None):
+        summary = self.timing_summary()
+        if len(summary) == 0:
+            return
+        num_files = summary['read']['files']
+        if elapsed is not None:
+            print('Converted {} files in {:.1f}s ({:.2f} files/s).'.format(num_files, elapsed, num_files / elapsed))
+        print('{:<8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'files', 'total', 'mean', 'median', 'p95',
+                                                                 'max'))
+        for stage, stats in summary.items():
+            print('{:<8}{:>8}{:>9.1f}s{:>9.3f}s{:>9.3f}s{:>9.3f}s{:>9.3f}s'.format(
+                stage, stats['files'], stats['total'], stats['mean'], stats['median'], stats['p95'], stats['max']))
+
     def start(self):
         self.__initialize_lists()
         self.__find_images(self.__download_path)
         num_fails = 0
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        start = time.perf_counter()
+        with self:
             # Start the load operations and mark each future with its URL
-            future_to_url = {executor.submit(self.__payload_convert, uid): uid for uid in self.__dcm_image_list}
+            future_to_url = {self.__submit_convert(uid): uid for uid in self.__dcm_image_list}
             for future in tqdm(concurrent.futures.as_completed(future_to_url), total=len(self.__dcm_image_list),
                                unit="file"):
                 url = future_to_url[future]
                 try:
-                    future.result()
+                    self.__finish_convert(url, future)
                 except Exception as exc:
                     num_fails += 1
                     print(f"{url} generated an exception: {exc}")
-            if num_fails > 0:
-                print(
-                    'Conversion failed for {} dcm images. Please re-run the downloader to fix incorrect downloads.'.format(
-                        num_fails))
+        self.print_timing_summary(time.perf_counter() - start)
+        if num_fails > 0:
+            print(
+                'Conversion failed for {} dcm images. Please re-run the downloader to fix incorrect downloads.'.format(
+                    num_fails))
         if self.__delete_dcm:
             print('Cleaning up DICOM images...')
             with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -110,6 +264,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='CBIS DDSM Converter')
     parser.add_argument('-p', '--path', default='../CBIS_DDSM',
                         help='Path to the download folder. It will be created if not existing.')
+    parser.add_argument('-t', '--tiled', action='store_true',
+                        help='Also write tiled images, allowing patch datasets to decode only the patch region.')
+    parser.add_argument('-s', '--shards', action='store_true',
+                        help='Pack the raw pixels into memory-mappable shard files under <path>/shards instead of PNG.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of conversion processes. Defaults to the number of cores.')
+    parser.add_argument('-l', '--compress_level', type=int, default=6,
+                        help='PNG compression level, from 0 (fastest, largest files) to 9 (slowest, smallest files).')
+    parser.add_argument('-f', '--fast', action='store_true',
+                        help='Write uncompressed PNG files, same as --compress_level 0.')
+    parser.add_argument('-y', '--pyramid', type=int, nargs='*', default=[],
+                        help='Downsampling factors of additional pyramid levels, e.g. -y 2 4 8.')
     args = parser.parse_args()
-    downloader = CBISDDSMConverter(args.path, delete_dcm=True)
+    downloader = CBISDDSMConverter(args.path, delete_dcm=True, tiled=args.tiled,
+                                   shard_path=os.path.join(args.path, 'shards') if args.shards else None,
+                                   max_workers=args.workers, compress_level=0 if args.fast else args.compress_level,
+                                   pyramid_factors=args.pyramid)
     downloader.start()
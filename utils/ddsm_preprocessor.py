@@ -1,5 +1,6 @@
 import csv
 import argparse
+import json
 import os
 
 import cv2
@@ -9,32 +10,71 @@ import pandas
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 import concurrent.futures
+import multiprocessing
+import threading
+
+from utils.lesion_metadata import write_lesions
+from utils.shard_store import ShardStore
+
+LESIONS_CACHE_NAME = 'lesions_cache.json'
+# Increased whenever the processed rows change, which invalidates the cached ones
+LESIONS_CACHE_VERSION = 2
+NOT_FOUND = 'not_found'
+OTHER_ERROR = 'other_error'
+
+_worker_preprocessor = None
+
+
+def _init_worker(preprocessor):
+    global _worker_preprocessor
+    _worker_preprocessor = preprocessor
+
+
+def _process_image(rows):
+    return _worker_preprocessor._process_image(rows)
 
 
 class CBISDDSMPreprocessor:
-    def __init__(self, download_path, csv_files_train, csv_files_test):
+    def __init__(self, download_path, csv_files_train, csv_files_test, shard_path=None, max_workers=None,
+                 downsample=4):
         self.__download_path = download_path
+        self.__max_workers = max_workers
+        self.__downsample = downsample
+        self.__executor = None
+        self.__shard_path = shard_path
+        self.__shard_store = None
+        self.__cache = None
         self.__csv_files_train = csv_files_train
         self.__csv_files_test = csv_files_test
         self.__not_found = 0
         self.__other_errors = 0
+        self.__lock = threading.Lock()
 
     @staticmethod
-    def __locate_lesion(mask_img, item_dict):
-        mask = np.array(mask_img)
-        ys, xs = np.where(mask)
-        item_dict['minx'] = xs.min().tolist()
-        item_dict['maxx'] = xs.max().tolist()
-        item_dict['miny'] = ys.min().tolist()
-        item_dict['maxy'] = ys.max().tolist()
+    def __locate_lesion(mask, item_dict):
+        # The bounding box only needs the extreme rows and columns holding lesion pixels
+        rows = mask.any(axis=1)
+        cols = mask.any(axis=0)
+        if not rows.any():
+            raise Exception('Empty ROI mask.')
+        item_dict['minx'] = int(np.argmax(cols))
+        item_dict['maxx'] = int(len(cols) - 1 - np.argmax(cols[::-1]))
+        item_dict['miny'] = int(np.argmax(rows))
+        item_dict['maxy'] = int(len(rows) - 1 - np.argmax(rows[::-1]))
         item_dict['cx'] = int((item_dict['maxx'] - item_dict['minx']) / 2 + item_dict['minx'])
         item_dict['cy'] = int((item_dict['maxy'] - item_dict['miny']) / 2 + item_dict['miny'])
 
         return True
 
     @staticmethod
-    def __locate_breast(image, item_dict):
-        image = (np.array(image) / 255).astype(np.uint8)
+    def __locate_breast(image, downsample):
+        # The contour is found on a downsampled copy and scaled back, which is accurate to half the downsampling factor
+        height, width = image.shape[:2]
+        if downsample > 1:
+            image = cv2.resize(image, (max(1, width // downsample), max(1, height // downsample)),
+                               interpolation=cv2.INTER_AREA)
+        scale = np.array([width / image.shape[1], height / image.shape[0]])
+        image = (image / 255).astype(np.uint8)
         threshold = int(0.05 * image.max())
         _, image_binary = cv2.threshold(image, threshold, 255, cv2.THRESH_BINARY)
         contours, _ = cv2.findContours(image_binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
@@ -46,22 +86,103 @@ class CBISDDSMPreprocessor:
         epsilon = 0.001 * cv2.arcLength(breast_contour, True)
         approxCurve = cv2.approxPolyDP(breast_contour, epsilon, True)
 
-        # print(approxCurve.shape[0])
-        # image_binary = np.dstack([image_binary]*3)
-        # cv2.drawContours(image_binary, [approxCurve], 0, (255, 0, 0), 3)
-        # plt.imshow(image_binary, cmap='gray')
-        # plt.show()
-
-        item_dict['breast_minx'] = breast_contour[:, 0, 0].min()
-        item_dict['breast_maxx'] = breast_contour[:, 0, 0].max()
-        item_dict['breast_miny'] = breast_contour[:, 0, 1].min()
-        item_dict['breast_maxy'] = breast_contour[:, 0, 1].max()
-        item_dict['breast_cx'] = int((item_dict['breast_maxx'] - item_dict['breast_minx']) / 2 + item_dict['breast_minx'])
-        item_dict['breast_cy'] = int((item_dict['breast_maxy'] - item_dict['breast_miny']) / 2 + item_dict['breast_miny'])
-        item_dict['breast_poly'] = approxCurve[:, 0, :].tolist()
-        return True
+        # The bounding box covers the full-resolution pixels of the extreme downsampled pixels, while the polygon
+        # vertices are mapped to the centers of the pixels they cover
+        minx, miny = np.floor(breast_contour[:, 0, :].min(axis=0) * scale).astype(int)
+        maxx, maxy = np.ceil((breast_contour[:, 0, :].max(axis=0) + 1) * scale).astype(int) - 1
+        approxCurve = np.rint((approxCurve[:, 0, :] + 0.5) * scale - 0.5).astype(int)
+
+        breast = {}
+        breast['breast_minx'] = int(minx)
+        breast['breast_maxx'] = int(maxx)
+        breast['breast_miny'] = int(miny)
+        breast['breast_maxy'] = int(maxy)
+        breast['breast_cx'] = int((breast['breast_maxx'] - breast['breast_minx']) / 2 + breast['breast_minx'])
+        breast['breast_cy'] = int((breast['breast_maxy'] - breast['breast_miny']) / 2 + breast['breast_miny'])
+        breast['breast_poly'] = approxCurve.tolist()
+        return breast
+
+    @property
+    def sharded(self):
+        return self.__shard_path is not None
+
+    def __store(self):
+        if self.__shard_store is None:
+            # Opened on first use, so that shards written after construction are visible
+            self.__shard_store = ShardStore(self.__shard_path)
+        return self.__shard_store
+
+    def __open(self, path):
+        if self.__shard_path is not None:
+            return self.__store().get(path)
+        return np.array(Image.open(os.path.join(self.__download_path, path)))
+
+    def __signature(self, path):
+        if self.__shard_path is not None:
+            # Shards of every conversion run get new ids, so the index entry changes with the pixels
+            return self.__store().entry(path)
+        try:
+            stat = os.stat(os.path.join(self.__download_path, path))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
 
-    def __payload(self, row):
+    def __row_signature(self, row):
+        # The image, patch and mask files are all covered, since the patch and mask paths may be swapped
+        return [self.__signature(os.path.splitext(path)[0] + '.png') for path in row[11:14]]
+
+    @staticmethod
+    def __row_key(row):
+        return '\t'.join(row)
+
+    def __cache_path(self):
+        return os.path.join(self.__download_path, LESIONS_CACHE_NAME)
+
+    def __cache_header(self):
+        # Settings that change the processed rows, next to the cache format
+        return {'version': LESIONS_CACHE_VERSION, 'downsample': self.__downsample}
+
+    def __load_cache(self):
+        if self.__cache is not None:
+            return
+        self.__cache = {}
+        if os.path.exists(self.__cache_path()):
+            with open(self.__cache_path()) as fin:
+                cache = json.load(fin)
+            if cache.get('header') == self.__cache_header():
+                self.__cache = cache['rows']
+            else:
+                print('The lesion cache was written by another version or with other settings, all lesions are '
+                      'processed again.')
+
+    def save_cache(self):
+        if self.__cache is None:
+            return
+        tmp_path = self.__cache_path() + '.tmp'
+        with self.__lock:
+            with open(tmp_path, 'w') as fout:
+                json.dump({'header': self.__cache_header(), 'rows': self.__cache}, fout)
+        os.replace(tmp_path, self.__cache_path())
+
+    def __cached(self, row, signature):
+        # Rows whose files changed, or that failed before, are not in the cache and are processed again
+        entry = self.__cache.get(self.__row_key(row))
+        if entry is None or entry[0] != signature:
+            return None
+        return entry[1]
+
+    def __update_cache(self, row, signature, item_dict):
+        with self.__lock:
+            if item_dict is None:
+                self.__cache.pop(self.__row_key(row), None)
+            else:
+                self.__cache[self.__row_key(row)] = [signature, item_dict]
+
+    @staticmethod
+    def __image_path(row):
+        return os.path.splitext(row[11])[0] + '.png'
+
+    def __payload(self, row, image, breast):
         item_dict = {
             "patient_id": row[0],
             "breast_density": row[1],
@@ -73,38 +194,91 @@ class CBISDDSMPreprocessor:
             "assessment": row[8],
             "pathology": row[9],
             "subtlety": row[10],
-            "image_path": os.path.splitext(row[11])[0] + '.png',
+            "image_path": self.__image_path(row),
             "patch_path": os.path.splitext(row[12])[0] + '.png',
             "mask_path": os.path.splitext(row[13])[0] + '.png'
         }
-        image = Image.open(os.path.join(self.__download_path, item_dict['image_path']))
-        mask_img = Image.open(os.path.join(self.__download_path, item_dict['mask_path']))
+        mask_img = self.__open(item_dict['mask_path'])
         # CBIS-DDSM has the problem that sometimes the paths of the patch and the mask are swapped, so that
         # 'patch_path' = <path of the mask> and vice versa.
         # This is detected by comparing the image size and the mask size.
         # However, sometimes the mask image is a little smaller than the image regardless of whether they are swapped.
         # So we need to check if the mask is a lot smaller as well.
-        if image.size != mask_img.size and (mask_img.size[0] < image.size[0] * 0.5 or mask_img.size[1] < image.size[1] * 0.5):
+        if image.shape != mask_img.shape and (mask_img.shape[1] < image.shape[1] * 0.5 or mask_img.shape[0] < image.shape[0] * 0.5):
             tmp = item_dict['mask_path']
             item_dict['mask_path'] = item_dict['patch_path']
             item_dict['patch_path'] = tmp
-            mask_img = Image.open(os.path.join(self.__download_path, item_dict['mask_path']))
+            mask_img = self.__open(item_dict['mask_path'])
 
         result = self.__locate_lesion(mask_img, item_dict)
 
         if not result:
             raise Exception()
 
-        result = self.__locate_breast(image, item_dict)
+        item_dict.update(breast)
+        return item_dict
 
-        if not result:
-            raise Exception()
+    @staticmethod
+    def __error(exc):
+        return NOT_FOUND if isinstance(exc, FileNotFoundError) else OTHER_ERROR
 
-        return item_dict
+    def _process_image(self, rows):
+        # All rows share the mammogram, which is opened and contoured only once
+        try:
+            image = self.__open(self.__image_path(rows[0]))
+            breast = self.__locate_breast(image, self.__downsample)
+        except Exception as exc:
+            return [(None, self.__error(exc))] * len(rows)
+        results = []
+        for row in rows:
+            try:
+                results.append((self.__payload(row, image, breast), None))
+            except Exception as exc:
+                results.append((None, self.__error(exc)))
+        return results
 
-    def __parse_file(self, file_list, out_csv_path):
+    def __count(self, error):
+        with self.__lock:
+            if error == NOT_FOUND:
+                self.__not_found += 1
+            elif error == OTHER_ERROR:
+                self.__other_errors += 1
+
+    def __group_by_image(self, rows, indices):
+        groups = {}
+        for index in indices:
+            groups.setdefault(self.__image_path(rows[index]), []).append(index)
+        return list(groups.values())
+
+    @staticmethod
+    def __mp_context():
+        # Forked workers inherit the preprocessor, and do not re-import the calling script
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        return None
+
+    def __enter__(self):
+        self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.__max_workers,
+                                                                 mp_context=self.__mp_context(),
+                                                                 initializer=_init_worker, initargs=(self,))
+        # Forked pools start all workers on the first task, here before the setup pipeline starts its threads
+        self.__executor.submit(int).result()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__executor.shutdown()
+        self.__executor = None
+
+    def __getstate__(self):
+        # Only needed by start methods other than fork
+        state = self.__dict__.copy()
+        state['_CBISDDSMPreprocessor__executor'] = None
+        state['_CBISDDSMPreprocessor__lock'] = None
+        return state
+
+    @staticmethod
+    def read_rows(file_list):
         rows = []
-        data = []
         for csv_file in file_list:
             with open(csv_file) as fin:
                 reader = csv.reader(fin, delimiter=',', quotechar='"')
@@ -112,34 +286,83 @@ class CBISDDSMPreprocessor:
 
                 for row in reader:
                     rows.append(row)
+        return rows
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_row = {executor.submit(self.__payload, row): row for row in rows}
-            for future in tqdm(concurrent.futures.as_completed(future_to_row), total=len(rows), unit='abnormalities'):
-                try:
-                    item_dict = future.result()
-                except FileNotFoundError:
-                    self.__not_found += 1
-                    continue
-                except Exception as e:
-                    self.__other_errors += 1
-                    continue
+    def row_series(self, row):
+        # Series folders that must be downloaded and converted before the row can be processed
+        return set(os.path.normpath(os.path.join(self.__download_path, os.path.dirname(path.strip())))
+                   for path in row[11:14])
 
-                data.append(item_dict)
+    def outputs(self):
+        return [(self.__csv_files_train, os.path.join(self.__download_path, 'lesions_train.csv')),
+                (self.__csv_files_test, os.path.join(self.__download_path, 'lesions_test.csv'))]
 
-        df = pandas.DataFrame(data)
-        df.to_csv(out_csv_path)
+    def row_image(self, row):
+        return self.__image_path(row)
 
-    def start(self):
-        print('Processing {} abnormality csv files for training.'.format(len(self.__csv_files_train)))
-        self.__parse_file(self.__csv_files_train, os.path.join(self.__download_path, 'lesions_train.csv'))
+    def process_rows(self, rows):
+        # The rows share their mammogram, whose breast is contoured once for all of them
+        self.__load_cache()
+        signatures = [self.__row_signature(row) for row in rows]
+        results = [self.__cached(row, signature) for row, signature in zip(rows, signatures)]
+        to_process = [index for index, item_dict in enumerate(results) if item_dict is None]
+        if len(to_process) == 0:
+            return results
+        if self.__executor is not None:
+            processed = self.__executor.submit(_process_image, [rows[index] for index in to_process]).result()
+        else:
+            processed = self._process_image([rows[index] for index in to_process])
+        for index, (item_dict, error) in zip(to_process, processed):
+            self.__count(error)
+            self.__update_cache(rows[index], signatures[index], item_dict)
+            results[index] = item_dict
+        return results
+
+    def count_not_found(self, num_rows):
+        with self.__lock:
+            self.__not_found += num_rows
 
-        print('Processing {} abnormality csv files for testing.'.format(len(self.__csv_files_train)))
-        self.__parse_file(self.__csv_files_test, os.path.join(self.__download_path, 'lesions_test.csv'))
+    @staticmethod
+    def write(data, out_csv_path):
+        write_lesions(pandas.DataFrame(data), out_csv_path)
 
+    def report(self):
         if self.__not_found > 0:
             print('Could not locate {} files. Please re-run the downloader.'.format(self.__not_found))
 
+    def __parse_file(self, file_list, out_csv_path):
+        self.__load_cache()
+        rows = self.read_rows(file_list)
+        signatures = [self.__row_signature(row) for row in rows]
+        results = [self.__cached(row, signature) for row, signature in zip(rows, signatures)]
+        to_process = [index for index, item_dict in enumerate(results) if item_dict is None]
+        if len(to_process) < len(rows):
+            print('Reusing {} cached abnormalities.'.format(len(rows) - len(to_process)))
+
+        with self, tqdm(total=len(to_process), unit='abnormalities') as progress_bar:
+            future_to_indices = {self.__executor.submit(_process_image, [rows[index] for index in group]): group
+                                 for group in self.__group_by_image(rows, to_process)}
+            for future in concurrent.futures.as_completed(future_to_indices):
+                group = future_to_indices[future]
+                for index, (item_dict, error) in zip(group, future.result()):
+                    self.__count(error)
+                    self.__update_cache(rows[index], signatures[index], item_dict)
+                    results[index] = item_dict
+                progress_bar.update(len(group))
+
+        self.save_cache()
+        self.write([item_dict for item_dict in results if item_dict is not None], out_csv_path)
+
+    def start(self):
+        (train_files, train_csv_path), (test_files, test_csv_path) = self.outputs()
+        print('Processing {} abnormality csv files for training.'.format(len(train_files)))
+        self.__parse_file(train_files, train_csv_path)
+
+        print('Processing {} abnormality csv files for testing.'.format(len(test_files)))
+        self.__parse_file(test_files, test_csv_path)
+
+        self.report()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='CBIS DDSM Preprocessor')
@@ -153,6 +376,12 @@ if __name__ == "__main__":
                         default=['../resources/calc_case_description_test_set.csv',
                                  '../resources/mass_case_description_test_set.csv'],
                         help='One or more csv files to proces, as downloaded by TCIA repository.')
+    parser.add_argument('-s', '--shards', action='store_true',
+                        help='Read the images from the shard files under <path>/shards instead of PNG.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of processes. Defaults to the number of cores.')
     args = parser.parse_args()
-    preprocessor = CBISDDSMPreprocessor(args.path, args.csv_files_train, args.csv_files_test)
+    preprocessor = CBISDDSMPreprocessor(args.path, args.csv_files_train, args.csv_files_test,
+                                        shard_path=os.path.join(args.path, 'shards') if args.shards else None,
+                                        max_workers=args.workers)
     preprocessor.start()
@@ -0,0 +1,70 @@
+import concurrent.futures
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from utils.pyramid import pyramid_level_path
+from utils.shard_store import ShardWriter, ShardStore
+
+
+def _read_array(path):
+    if path.endswith('.npy'):
+        return np.load(path)
+    image = Image.open(path)
+    array = np.array(image)
+    if image.mode == 'I':
+        # Older Pillow versions open 16-bit images as 32-bit integers
+        array = array.astype(np.uint16)
+    return array
+
+
+class CBISDDSMShardPacker:
+    """Packs the image and mask files of lesion records into shard files, in the order of the records.
+
+    The images of a lesion, its mask and the files of its variants are written next to each other, so that reading the
+    records in order reads the shards sequentially. Files already in the shards are skipped, which makes an interrupted
+    packing resumable.
+    """
+
+    def __init__(self, dataframe, download_path, shard_path, masks=True, pyramid_factor=1, num_workers=None):
+        self.__dataframe = dataframe
+        self.__download_path = download_path
+        self.__shard_path = shard_path
+        self.__masks = masks
+        self.__pyramid_factor = pyramid_factor
+        self.__num_workers = num_workers
+
+    def __keys(self):
+        fields = ('image_path', 'mask_path') if self.__masks else ('image_path',)
+        df = self.__dataframe
+        variants = df['variants'] if 'variants' in df.columns else [[]] * len(df.index)
+        keys = {}
+        for row, row_variants in zip(zip(*[df[field] for field in fields]), variants):
+            items = [dict(zip(fields, row))] + list(row_variants)[1:]
+            for item in items:
+                for field, value in zip(fields, row):
+                    keys.setdefault(pyramid_level_path(item.get(field, value), self.__pyramid_factor), None)
+        return list(keys)
+
+    def start(self):
+        packed = set(ShardStore(self.__shard_path).keys())
+        keys = [key for key in self.__keys() if key not in packed]
+        if len(keys) == 0:
+            return self.__shard_path
+
+        print(f'Packing {len(keys)} files into shards at {self.__shard_path}.')
+        # Files are decoded in parallel and written in order, a few chunks at a time to bound the memory
+        num_workers = self.__num_workers or os.cpu_count() or 1
+        chunk_size = 4 * num_workers
+        with ShardWriter(self.__shard_path) as writer, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor, \
+                tqdm(total=len(keys), unit='file') as progress_bar:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                arrays = executor.map(_read_array, [os.path.join(self.__download_path, key) for key in chunk])
+                for key, array in zip(chunk, arrays):
+                    writer.add(key, array)
+                progress_bar.update(len(chunk))
+        return self.__shard_path
@@ -0,0 +1,177 @@
+import argparse
+import csv
+import json
+import os
+
+import cv2
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+MASS_HEADER = ['patient_id', 'breast_density', 'left or right breast', 'image view', 'abnormality id',
+               'abnormality type', 'mass shape', 'mass margins', 'assessment', 'pathology', 'subtlety',
+               'image file path', 'cropped image file path', 'ROI mask file path']
+CALC_HEADER = MASS_HEADER[:6] + ['calc type', 'calc distribution'] + MASS_HEADER[8:]
+CSV_NAMES = {('mass', 'train'): 'mass_case_description_train_set.csv',
+             ('mass', 'test'): 'mass_case_description_test_set.csv',
+             ('calcification', 'train'): 'calc_case_description_train_set.csv',
+             ('calcification', 'test'): 'calc_case_description_test_set.csv'}
+PATHOLOGIES = ('MALIGNANT', 'BENIGN', 'BENIGN_WITHOUT_CALLBACK')
+MASS_SHAPES = ('IRREGULAR', 'OVAL', 'LOBULATED', 'ROUND', 'ARCHITECTURAL_DISTORTION')
+MASS_MARGINS = ('CIRCUMSCRIBED', 'SPICULATED', 'ILL_DEFINED', 'OBSCURED', 'MICROLOBULATED')
+CALC_TYPES = ('PLEOMORPHIC', 'AMORPHOUS', 'PUNCTATE', 'LUCENT_CENTER', 'VASCULAR')
+CALC_DISTRIBUTIONS = ('CLUSTERED', 'SEGMENTAL', 'REGIONAL', 'LINEAR')
+
+
+class CBISDDSMSyntheticGenerator:
+    """Writes a small dataset laid out like CBIS-DDSM, for measuring the library without downloading it.
+
+    <path>/source holds the DICOM series as the TCIA server would deliver them, next to a manifest, the four case
+    description csv files and a config.json whose download_path is <path>/download.
+    """
+
+    def __init__(self, path, num_patients=8, height=3000, width=2000, max_lesions=2, test_ratio=0.25, seed=0):
+        self.__path = path
+        self.__num_patients = num_patients
+        self.__height = height
+        self.__width = width
+        self.__max_lesions = max_lesions
+        self.__test_ratio = test_ratio
+        self.__rng = np.random.default_rng(seed)
+
+    @property
+    def source_path(self):
+        return os.path.join(self.__path, 'source')
+
+    @property
+    def config_path(self):
+        return os.path.join(self.__path, 'config.json')
+
+    @staticmethod
+    def __write_dicom(path, array):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1.2'  # Digital mammography
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Rows, ds.Columns = array.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = array.dtype.itemsize * 8
+        ds.BitsStored = ds.BitsAllocated
+        ds.HighBit = ds.BitsAllocated - 1
+        ds.PixelRepresentation = 0
+        ds.PixelData = array.tobytes()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ds.save_as(path, enforce_file_format=True)
+
+    def __breast(self, side):
+        # Half ellipse against the chest wall, with low-frequency tissue texture and sensor noise
+        height, width = self.__height, self.__width
+        yy, xx = np.ogrid[0:height, 0:width]
+        cx = 0 if side == 'LEFT' else width - 1
+        ry = height * self.__rng.uniform(0.38, 0.48)
+        rx = width * self.__rng.uniform(0.6, 0.85)
+        inside = ((yy - height / 2) / ry) ** 2 + ((xx - cx) / rx) ** 2 < 1
+        texture = cv2.resize(self.__rng.uniform(0, 1, (height // 64 + 1, width // 64 + 1)).astype(np.float32),
+                             (width, height), interpolation=cv2.INTER_CUBIC)
+        image = (18000 + 16000 * texture).astype(np.uint16)
+        image += self.__rng.integers(0, 2000, (height, width), dtype=np.uint16)
+        image[~inside] = self.__rng.integers(0, 300, int((~inside).sum()), dtype=np.uint16)
+        return image, inside
+
+    def __lesion(self, image, inside, lesion_type):
+        # An irregular blob inside the breast, brighter than the surrounding tissue
+        ys, xs = np.nonzero(inside[::16, ::16])
+        pick = self.__rng.integers(len(ys))
+        cy, cx = ys[pick] * 16, xs[pick] * 16
+        radius = self.__rng.uniform(20, 60) if lesion_type == 'calcification' else self.__rng.uniform(60, 250)
+        angles = np.linspace(0, 2 * np.pi, 24, endpoint=False)
+        radii = radius * self.__rng.uniform(0.6, 1.3, len(angles))
+        polygon = np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], axis=1).astype(np.int32)
+        mask = np.zeros(image.shape, np.uint8)
+        cv2.fillPoly(mask, [polygon], 255)
+        mask &= (inside * 255).astype(np.uint8)
+        if not mask.any():
+            mask[cy, cx] = 255
+        image[mask > 0] = np.minimum(image[mask > 0].astype(np.int32) + 12000, 65535).astype(np.uint16)
+        rows, cols = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+        crop = image[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()
+        return crop, mask
+
+    def __row(self, patient_id, lesion_type, side, view, lesion_id, image_path, crop_path, mask_path):
+        if lesion_type == 'mass':
+            type1, type2 = self.__rng.choice(MASS_SHAPES), self.__rng.choice(MASS_MARGINS)
+        else:
+            type1, type2 = self.__rng.choice(CALC_TYPES), self.__rng.choice(CALC_DISTRIBUTIONS)
+        # The mask paths of the original csv files end with a line break
+        return [patient_id, int(self.__rng.integers(1, 5)), side, view, lesion_id, lesion_type, type1, type2,
+                int(self.__rng.integers(2, 6)), self.__rng.choice(PATHOLOGIES), int(self.__rng.integers(1, 6)),
+                image_path, crop_path, mask_path + '\n']
+
+    def start(self):
+        series_uids = []
+        rows = {key: [] for key in CSV_NAMES}
+        for patient in range(self.__num_patients):
+            patient_id = f'P_{patient:05d}'
+            subset = 'test' if patient < self.__num_patients * self.__test_ratio else 'train'
+            lesion_type = 'mass' if patient % 2 == 0 else 'calcification'
+            prefix = ('Mass' if lesion_type == 'mass' else 'Calc') + ('-Test' if subset == 'test' else '-Training')
+            for side in ('LEFT', 'RIGHT'):
+                for view in ('CC', 'MLO'):
+                    subject = f'{prefix}_{patient_id}_{side}_{view}'
+                    study_uid, series_uid = generate_uid(), generate_uid()
+                    image, inside = self.__breast(side)
+                    masks = []
+                    for _ in range(int(self.__rng.integers(1, self.__max_lesions + 1))):
+                        masks.append(self.__lesion(image, inside, lesion_type))
+                    self.__write_dicom(os.path.join(self.source_path, subject, study_uid, series_uid, '000001.dcm'),
+                                       image)
+                    series_uids.append(series_uid)
+                    image_path = f'{subject}/{study_uid}/{series_uid}/000000.dcm'
+
+                    for lesion_id, (crop, mask) in enumerate(masks, start=1):
+                        roi_subject = f'{subject}_{lesion_id}'
+                        roi_study_uid, roi_series_uid = generate_uid(), generate_uid()
+                        roi_path = os.path.join(self.source_path, roi_subject, roi_study_uid, roi_series_uid)
+                        self.__write_dicom(os.path.join(roi_path, '000001.dcm'), crop)
+                        self.__write_dicom(os.path.join(roi_path, '000002.dcm'), mask)
+                        series_uids.append(roi_series_uid)
+                        crop_path = f'{roi_subject}/{roi_study_uid}/{roi_series_uid}/000000.dcm'
+                        mask_path = f'{roi_subject}/{roi_study_uid}/{roi_series_uid}/000001.dcm'
+                        if self.__rng.uniform() < 0.2:
+                            # As in CBIS-DDSM, some rows list the mask as the cropped image and vice versa
+                            crop_path, mask_path = mask_path, crop_path
+                        rows[(lesion_type, subset)].append(self.__row(patient_id, lesion_type, side, view, lesion_id,
+                                                                      image_path, crop_path, mask_path))
+
+        for (lesion_type, subset), name in CSV_NAMES.items():
+            with open(os.path.join(self.__path, name), 'w', newline='') as fout:
+                writer = csv.writer(fout)
+                writer.writerow(MASS_HEADER if lesion_type == 'mass' else CALC_HEADER)
+                writer.writerows(rows[(lesion_type, subset)])
+        with open(os.path.join(self.__path, 'manifest.tcia'), 'w') as fout:
+            fout.write('manifestVersion=3.0\nListOfSeriesToDownload=\n' + '\n'.join(series_uids) + '\n')
+        config = {'download_path': os.path.join(self.__path, 'download'),
+                  'manifest': os.path.join(self.__path, 'manifest.tcia')}
+        for (lesion_type, subset), name in CSV_NAMES.items():
+            config[f"{'mass' if lesion_type == 'mass' else 'calc'}_{subset}_csv"] = os.path.join(self.__path, name)
+        with open(self.config_path, 'w') as fout:
+            json.dump(config, fout, indent=2)
+        print('Generated {} series and {} abnormalities in {}.'.format(
+            len(series_uids), sum(len(r) for r in rows.values()), self.__path))
+        return config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CBIS DDSM Synthetic Generator')
+    parser.add_argument('-p', '--path', default='../CBIS_DDSM_synthetic',
+                        help='Path to the output folder. It will be created if not existing.')
+    parser.add_argument('-n', '--patients', type=int, default=8, help='Number of patients, with 4 images each.')
+    parser.add_argument('--height', type=int, default=3000, help='Height of the mammograms.')
+    parser.add_argument('--width', type=int, default=2000, help='Width of the mammograms.')
+    args = parser.parse_args()
+    CBISDDSMSyntheticGenerator(args.path, args.patients, args.height, args.width).start()
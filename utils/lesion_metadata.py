@@ -0,0 +1,102 @@
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+LESION_METADATA_EXTENSION = '.pkl'
+# Columns holding lists of points, which the csv files store as strings
+LIST_COLUMNS = ('breast_poly',)
+
+
+def lesion_metadata_path(csv_path):
+    return os.path.splitext(csv_path)[0] + LESION_METADATA_EXTENSION
+
+
+def typed_lesions(df):
+    # Numbers as integers or floats, lists as lists and every other column as categorical
+    df = df.drop(columns=[column for column in df.columns if str(column).startswith('Unnamed')])
+    for column in df.columns:
+        series = df[column]
+        if column in LIST_COLUMNS:
+            df[column] = [json.loads(value) if isinstance(value, str) else value for value in series]
+        elif not pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            numeric = pd.to_numeric(series, errors='coerce')
+            if numeric.notna().sum() == series.notna().sum() and numeric.notna().any():
+                df[column] = numeric
+            else:
+                df[column] = series.astype('category')
+        series = df[column]
+        if pd.api.types.is_float_dtype(series.dtype) and series.notna().all() and (series % 1 == 0).all():
+            df[column] = series.astype(np.int64)
+    return df
+
+
+def write_lesions(df, csv_path):
+    # The csv file is kept for reading by hand, datasets load the typed binary file next to it
+    df.to_csv(csv_path)
+    typed_lesions(df.reset_index(drop=True)).to_pickle(lesion_metadata_path(csv_path))
+
+
+def _signature(csv_path):
+    # The binary file is preferred unless the csv file was written after it
+    metadata_path = lesion_metadata_path(csv_path)
+    csv_stat = os.stat(csv_path)
+    if os.path.exists(metadata_path):
+        metadata_stat = os.stat(metadata_path)
+        if metadata_stat.st_mtime_ns >= csv_stat.st_mtime_ns:
+            return metadata_path, metadata_stat.st_mtime_ns, metadata_stat.st_size
+    return csv_path, csv_stat.st_mtime_ns, csv_stat.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _read(signature):
+    path = signature[0]
+    if path.endswith(LESION_METADATA_EXTENSION):
+        return pd.read_pickle(path)
+    return typed_lesions(pd.read_csv(path))
+
+
+def read_lesions(csv_path):
+    # The returned frame is shared by all readers of the same file and must not be modified
+    return _read(_signature(csv_path))
+
+
+@functools.lru_cache(maxsize=32)
+def _filter(signatures, excluded_attrs, excluded_values, mapped_values):
+    frames = [_read(signature) for signature in signatures]
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    categorical = [column for column in df.columns
+                   if any(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+
+    keep = np.ones(len(df.index), dtype=bool)
+    for attribute, values in excluded_values:
+        keep &= ~df[attribute].isin(list(values)).to_numpy()
+    df = df.loc[keep, [column for column in df.columns if column not in excluded_attrs]]
+
+    for attribute, mapping in mapped_values:
+        mapping = dict(mapping)
+        if isinstance(df[attribute].dtype, pd.CategoricalDtype):
+            # Only the categories are mapped
+            df[attribute] = df[attribute].map(lambda value: mapping.get(value, value))
+        else:
+            df[attribute] = df[attribute].replace(mapping)
+    for column in categorical:
+        if column in df.columns:
+            df[column] = df[column].astype('category').cat.remove_unused_categories()
+    return df.reset_index(drop=True)
+
+
+def filter_lesions(csv_paths, excluded_attrs=(), excluded_values=None, mapped_values=None):
+    """Lesions of the csv files without the excluded attributes and values, with the attribute values mapped.
+
+    The result is memoised on the files and the filters, so factories created again with the same filters do not
+    read or filter the lesions again.
+    """
+    signatures = tuple(_signature(csv_path) for csv_path in csv_paths)
+    excluded_values = tuple(sorted((attribute, tuple(sorted(values, key=repr)))
+                                   for attribute, values in (excluded_values or {}).items()))
+    mapped_values = tuple(sorted((attribute, tuple(mapping.items()))
+                                 for attribute, mapping in (mapped_values or {}).items()))
+    return _filter(signatures, tuple(excluded_attrs), excluded_values, mapped_values).copy()
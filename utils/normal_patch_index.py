@@ -0,0 +1,186 @@
+import concurrent.futures
+import hashlib
+import math
+import multiprocessing
+import os
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from datasets.image_sources import materialize
+from utils.packed_strings import PackedKeys
+
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+    torch.set_num_threads(1)
+
+
+def _window_sums(grid, window_h, window_w):
+    # Sum over every window_h x window_w window of the grid, from its integral image
+    integral = np.pad(grid.astype(np.float64).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    return (integral[window_h:, window_w:] - integral[:-window_h, window_w:]
+            - integral[window_h:, :-window_w] + integral[:-window_h, :-window_w])
+
+
+def _index_image(mask_paths, breast, patch_size, min_breast_overlap, max_abnorm_overlap, step):
+    masks = [materialize(_worker_dataset._load_image(mask_path, max_value=255))[0].numpy()
+             for mask_path in mask_paths]
+    height, width = masks[0].shape
+    grid_h, grid_w = height // step, width // step
+    window_w, window_h = math.ceil(patch_size[0] / step), math.ceil(patch_size[1] / step)
+    if window_h > grid_h or window_w > grid_w:
+        return np.empty((0, 2), dtype=np.int32)
+
+    breast_grid = np.zeros((grid_h, grid_w), dtype=np.uint8)
+    if breast['poly'] is not None:
+        polygon = np.rint(np.asarray(breast['poly'], dtype=np.float64) / step).astype(np.int32)
+        cv2.fillPoly(breast_grid, [polygon.reshape(-1, 1, 2)], 1)
+    else:
+        breast_grid[breast['miny'] // step: breast['maxy'] // step + 1,
+                    breast['minx'] // step: breast['maxx'] // step + 1] = 1
+    window_area = window_h * window_w
+    valid = _window_sums(breast_grid, window_h, window_w) >= min_breast_overlap * window_area
+
+    for mask in masks:
+        # Fraction of every cell covered by the lesion
+        lesion_grid = cv2.resize(mask[:grid_h * step, :grid_w * step], (grid_w, grid_h), interpolation=cv2.INTER_AREA)
+        area = lesion_grid.sum()
+        if area > 0:
+            valid &= _window_sums(lesion_grid, window_h, window_w) <= max_abnorm_overlap * min(area, window_area)
+
+    # Origins whose patch fits in the image, as (x, y) cells
+    valid = valid[:(height - patch_size[1]) // step + 1, :(width - patch_size[0]) // step + 1]
+    return np.argwhere(valid)[:, ::-1].astype(np.int32)
+
+
+class NormalPatchIndex:
+    """Origins of the normal patches of every mammogram, on a grid of `step` pixels.
+
+    A valid origin places the patch inside the image, overlapping the breast polygon by at least min_breast_overlap
+    of the patch and every lesion mask of the image by at most max_abnorm_overlap of the lesion (or of the patch, if
+    smaller). Drawing an origin is a single random index.
+    """
+
+    def __init__(self, image_paths, offsets, origins, step):
+        self.step = step
+        self.__image_paths = PackedKeys(image_paths)
+        self.__offsets = np.asarray(offsets, dtype=np.int64)
+        self.__origins = origins
+
+    def __positions(self, image_path):
+        i = self.__image_paths.find(image_path)
+        return (int(self.__offsets[i]), int(self.__offsets[i + 1])) if i >= 0 else (0, 0)
+
+    def num_positions(self, image_path):
+        start, end = self.__positions(image_path)
+        return end - start
+
+    def sample(self, image_path):
+        start, end = self.__positions(image_path)
+        if end == start:
+            return None
+        x, y = self.__origins[start + int(torch.randint(0, end - start, (1,)))]
+        return int(x) * self.step, int(y) * self.step
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['image_paths'].tolist(), data['offsets'], data['origins'], int(data['step']))
+
+    @staticmethod
+    def save(path, image_paths, origin_list, step):
+        offsets = np.zeros(len(origin_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(origins) for origins in origin_list])
+        origins = np.concatenate(origin_list) if len(origin_list) > 0 else np.empty((0, 2), dtype=np.int32)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fout:
+            np.savez(fout, image_paths=np.array(image_paths, dtype=str), offsets=offsets, origins=origins,
+                     step=np.array(step))
+        os.replace(tmp_path, path)
+
+
+class CBISDDSMNormalIndexBuilder:
+    """Builds the NormalPatchIndex of the mammograms of a dataset, or loads it if already built.
+
+    The lesion masks of every mammogram are given by `lesion_masks`, which should list all the lesions of the image
+    and not only those selected in the dataset. The index is stored in `index_folder` under a key of its inputs.
+    """
+
+    def __init__(self, dataset, lesion_masks, patch_size, min_breast_overlap, max_abnorm_overlap, index_folder,
+                 num_workers=None, step=None):
+        self.__dataset = dataset
+        self.__lesion_masks = lesion_masks
+        self.__patch_size = tuple(patch_size)
+        self.__min_breast_overlap = min_breast_overlap
+        self.__max_abnorm_overlap = max_abnorm_overlap
+        self.__index_folder = index_folder
+        self.__num_workers = num_workers
+        # A sixteenth of the patch keeps the grid small while placing patches finely enough
+        self.__step = step if step is not None else max(min(self.__patch_size) // 16, 1)
+
+    def __images(self):
+        records = self.__dataset.records
+        images = {}
+        for index in range(len(records)):
+            image_path = records.value('image_path', index)
+            if image_path in images:
+                continue
+            breast = {field: int(records.value('breast_' + field, index)) for field in ('minx', 'maxx', 'miny', 'maxy')}
+            breast['poly'] = records.value('breast_poly', index) if 'breast_poly' in records else None
+            mask_paths = sorted(self.__lesion_masks.get(image_path, [records.value('mask_path', index)]))
+            images[image_path] = (mask_paths, breast)
+        return images
+
+    def __key(self, images):
+        key = hashlib.sha1(repr((self.__patch_size, self.__min_breast_overlap, self.__max_abnorm_overlap, self.__step,
+                                 self.__dataset.pyramid_factor)).encode('utf-8'))
+        for image_path in sorted(images):
+            key.update(repr((image_path,) + images[image_path]).encode('utf-8'))
+        return key.hexdigest()
+
+    @staticmethod
+    def __mp_context():
+        # Forked workers inherit the dataset
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+        return None
+
+    def start(self):
+        images = self.__images()
+        index_path = os.path.join(self.__index_folder, self.__key(images) + '.npz')
+        if os.path.exists(index_path):
+            return NormalPatchIndex.load(index_path)
+
+        print(f'Indexing normal patch positions of {len(images)} images.')
+        image_paths = sorted(images)
+        origin_list = [np.empty((0, 2), dtype=np.int32)] * len(image_paths)
+        num_fails = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.__num_workers,
+                                                    mp_context=self.__mp_context(),
+                                                    initializer=_init_worker,
+                                                    initargs=(self.__dataset,)) as executor:
+            future_to_index = {executor.submit(_index_image, *images[image_path], self.__patch_size,
+                                               self.__min_breast_overlap, self.__max_abnorm_overlap, self.__step): i
+                               for i, image_path in enumerate(image_paths)}
+            for future in tqdm(concurrent.futures.as_completed(future_to_index), total=len(future_to_index),
+                               unit='image'):
+                i = future_to_index[future]
+                try:
+                    origin_list[i] = future.result()
+                except Exception as exc:
+                    num_fails += 1
+                    print(f"{image_paths[i]} generated an exception: {exc}")
+        num_empty = sum(1 for origins in origin_list if len(origins) == 0)
+        if num_empty > 0:
+            print(f'{num_empty} images have no normal patch position, their normal patches are lesion patches.')
+        if num_fails == 0:
+            os.makedirs(self.__index_folder, exist_ok=True)
+            NormalPatchIndex.save(index_path, image_paths, origin_list, self.__step)
+        return NormalPatchIndex(image_paths, np.cumsum([0] + [len(origins) for origins in origin_list]),
+                                np.concatenate(origin_list), self.__step)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+def _to_json(value):
+    return json.dumps(value, default=lambda obj: obj.tolist())
+
+
+class PackedStrings:
+    """Strings packed in a single byte buffer with their offsets.
+
+    Reading a string decodes a new object from the buffer, so DataLoader workers forked from the process that built
+    the table never touch, and thus never copy, the memory pages holding it. With is_json, the strings hold JSON
+    values, which are decoded on reading.
+    """
+
+    def __init__(self, strings, is_json=False):
+        encoded = [string.encode('utf-8') for string in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(string) for string in encoded])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self.is_json = is_json
+
+    @classmethod
+    def from_values(cls, values):
+        return cls([_to_json(value) for value in values], is_json=True)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        string = self.buffer[self.offsets[index]: self.offsets[index + 1]].tobytes().decode('utf-8')
+        return json.loads(string) if self.is_json else string
+
+    def take(self, indices):
+        values = np.empty(len(indices), dtype=object)
+        for i, index in enumerate(indices):
+            values[i] = self[index]
+        return values
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class PackedKeys:
+    """Positions of string keys, looked up by binary search over sorted 64-bit hashes instead of a dict."""
+
+    def __init__(self, keys):
+        keys = list(keys)
+        hashes = np.array([_key_hash(key) for key in keys], dtype=np.uint64)
+        self.__order = np.argsort(hashes, kind='stable')
+        self.__hashes = hashes[self.__order]
+        self.__keys = PackedStrings(keys)
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def find(self, key):
+        # Position of the key in the list it was built from, or -1
+        key_hash = np.uint64(_key_hash(key))
+        index = int(np.searchsorted(self.__hashes, key_hash))
+        while index < len(self.__hashes) and self.__hashes[index] == key_hash:
+            position = int(self.__order[index])
+            if self.__keys[position] == key:
+                return position
+            index += 1
+        return -1
+
+    def keys(self):
+        return [self.__keys[position] for position in range(len(self.__keys))]
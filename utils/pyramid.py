@@ -0,0 +1,44 @@
+import json
+import math
+import os
+import re
+
+import cv2
+
+PYRAMID_CONFIG_NAME = 'pyramid.json'
+_LEVEL_PATTERN = re.compile(r'_x\d+$')
+
+
+def pyramid_level_path(path, factor):
+    # Levels are stored next to the full resolution image, e.g. 000000_x4.png
+    if factor == 1:
+        return path
+    name, extension = os.path.splitext(path)
+    return f'{name}_x{factor}{extension}'
+
+
+def is_pyramid_level_path(path):
+    return _LEVEL_PATTERN.search(os.path.splitext(path)[0]) is not None
+
+
+def pyramid_level_shape(shape, factor):
+    return max(int(math.ceil(shape[0] / factor)), 1), max(int(math.ceil(shape[1] / factor)), 1)
+
+
+def downsample(array, factor):
+    height, width = pyramid_level_shape(array.shape, factor)
+    # Area interpolation averages the full resolution pixels covered by every output pixel
+    return cv2.resize(array, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def write_pyramid_config(download_path, factors):
+    with open(os.path.join(download_path, PYRAMID_CONFIG_NAME), 'w') as fout:
+        json.dump({'factors': sorted(factors)}, fout)
+
+
+def read_pyramid_factors(download_path):
+    config_path = os.path.join(download_path, PYRAMID_CONFIG_NAME)
+    if not os.path.exists(config_path):
+        return []
+    with open(config_path) as fin:
+        return json.load(fin)['factors']
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.packed_strings import PackedKeys
+
+SHARD_INDEX_NAME = 'index.json'
+_ALIGNMENT = 64
+
+
+def _shard_name(shard_id):
+    return f'shard_{shard_id:05d}.bin'
+
+
+def _load_index(root):
+    index_path = os.path.join(root, SHARD_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as fin:
+        return json.load(fin)
+
+
+class ShardWriter:
+    """Appends arrays to large shard files and records their offset, dtype and shape in a shared index."""
+
+    def __init__(self, root, shard_size=4 * 2 ** 30):
+        os.makedirs(root, exist_ok=True)
+        self.__root = root
+        self.__shard_size = shard_size
+        self.__lock = threading.Lock()
+        self.__index = _load_index(root)
+        used_ids = [entry[0] for entry in self.__index.values()]
+        # Never append to shards of a previous run, whose index may not cover their tail
+        self.__shard_id = max(used_ids) + 1 if used_ids else 0
+        self.__file = None
+        self.__offset = 0
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def __open_next_shard(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__shard_id += 1
+        self.__file = open(os.path.join(self.__root, _shard_name(self.__shard_id)), 'wb')
+        self.__offset = 0
+
+    def add(self, key, array):
+        array = np.ascontiguousarray(array)
+        with self.__lock:
+            if self.__file is None or self.__offset + array.nbytes > self.__shard_size:
+                self.__open_next_shard()
+            padding = -self.__offset % _ALIGNMENT
+            self.__file.write(b'\0' * padding)
+            self.__offset += padding
+            self.__index[key] = [self.__shard_id, self.__offset, array.dtype.str, list(array.shape)]
+            self.__file.write(array.tobytes())
+            self.__offset += array.nbytes
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            tmp_path = os.path.join(self.__root, SHARD_INDEX_NAME + '.tmp')
+            with open(tmp_path, 'w') as fout:
+                json.dump(self.__index, fout)
+            os.replace(tmp_path, os.path.join(self.__root, SHARD_INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ShardStore:
+    """Read-only access to the arrays of a shard directory as zero-copy views of memory-mapped shards."""
+
+    def __init__(self, root):
+        self.root = root
+        # The index is packed in arrays, which forked DataLoader workers share without copying
+        index = _load_index(root)
+        entries = list(index.values())
+        self.__keys = PackedKeys(index.keys())
+        self.__shard_ids = np.array([entry[0] for entry in entries], dtype=np.int32)
+        self.__offsets = np.array([entry[1] for entry in entries], dtype=np.int64)
+        self.__dtypes = sorted({entry[2] for entry in entries})
+        self.__dtype_codes = np.array([self.__dtypes.index(entry[2]) for entry in entries], dtype=np.int16)
+        max_ndim = max((len(entry[3]) for entry in entries), default=0)
+        self.__ndims = np.array([len(entry[3]) for entry in entries], dtype=np.int8)
+        self.__shapes = np.zeros((len(entries), max_ndim), dtype=np.int64)
+        for i, entry in enumerate(entries):
+            self.__shapes[i, :len(entry[3])] = entry[3]
+        self.__shards = {}
+
+    def __getstate__(self):
+        # Memory maps are reopened in every process instead of being pickled as arrays
+        state = self.__dict__.copy()
+        state['_ShardStore__shards'] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.__keys
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def keys(self):
+        return self.__keys.keys()
+
+    def entry(self, key):
+        # Shard id, offset, dtype and shape of the array, or None if missing
+        i = self.__keys.find(key)
+        if i < 0:
+            return None
+        return [int(self.__shard_ids[i]), int(self.__offsets[i]), self.__dtypes[self.__dtype_codes[i]],
+                self.__shapes[i, :self.__ndims[i]].tolist()]
+
+    def shard_file(self, shard_id):
+        return os.path.join(self.root, _shard_name(shard_id))
+
+    def __shard(self, shard_id):
+        shard = self.__shards.get(shard_id)
+        if shard is None:
+            # Copy-on-write mode gives writable views without ever touching the file
+            shard = np.memmap(self.shard_file(shard_id), dtype=np.uint8, mode='c')
+            self.__shards[shard_id] = shard
+        return shard
+
+    def get(self, key):
+        entry = self.entry(key)
+        if entry is None:
+            raise FileNotFoundError(f'{key} not found in shard store {self.root}')
+        shard_id, offset, dtype, shape = entry
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.__shard(shard_id), offset=offset)
@@ -0,0 +1,113 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+TILED_IMAGE_EXTENSION = '.tiles'
+
+# File layout: header, tile offset table (num_tiles + 1 entries, row-major), tile payloads.
+# Every tile is stored zlib-compressed at the configured level (level 0 stores the raw bytes).
+_MAGIC = b'CBTI'
+_VERSION = 1
+_HEADER = struct.Struct('<4sBBIIHHb')
+_DTYPES = {0: np.dtype(np.uint8), 1: np.dtype(np.uint16)}
+_DTYPE_CODES = {dtype: code for code, dtype in _DTYPES.items()}
+
+
+def tiled_image_path(png_path):
+    return os.path.splitext(png_path)[0] + TILED_IMAGE_EXTENSION
+
+
+def write_tiled_image(path, array, tile_size=256, compression=1):
+    array = np.ascontiguousarray(array)
+    if array.ndim != 2:
+        raise ValueError(f'Only single channel images can be tiled, got shape {array.shape}.')
+    if array.dtype not in _DTYPE_CODES:
+        raise ValueError(f'Unsupported dtype {array.dtype} for tiled images.')
+    height, width = array.shape
+    tiles_y = (height + tile_size - 1) // tile_size
+    tiles_x = (width + tile_size - 1) // tile_size
+
+    payloads = []
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            tile = array[ty * tile_size: (ty + 1) * tile_size, tx * tile_size: (tx + 1) * tile_size]
+            tile_bytes = np.ascontiguousarray(tile).tobytes()
+            payloads.append(zlib.compress(tile_bytes, compression) if compression > 0 else tile_bytes)
+
+    header = _HEADER.pack(_MAGIC, _VERSION, _DTYPE_CODES[array.dtype], height, width, tile_size, tile_size,
+                          compression)
+    offsets = np.zeros(len(payloads) + 1, dtype='<u8')
+    offsets[0] = _HEADER.size + offsets.nbytes
+    offsets[1:] = offsets[0] + np.cumsum([len(p) for p in payloads])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(header)
+        fout.write(offsets.tobytes())
+        for payload in payloads:
+            fout.write(payload)
+    os.replace(tmp_path, path)
+
+
+class TiledImage:
+    def __init__(self, path):
+        self.path = path
+        self.bytes_read = 0
+        with open(path, 'rb') as fin:
+            magic, version, dtype_code, height, width, tile_h, tile_w, compression = \
+                _HEADER.unpack(fin.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f'{path} is not a tiled image.')
+            self.dtype = _DTYPES[dtype_code]
+            self.height, self.width = height, width
+            self.tile_size = (tile_h, tile_w)
+            self.compression = compression
+            self.__tiles_y = (height + tile_h - 1) // tile_h
+            self.__tiles_x = (width + tile_w - 1) // tile_w
+            num_offsets = self.__tiles_y * self.__tiles_x + 1
+            self.__offsets = np.frombuffer(fin.read(num_offsets * 8), dtype='<u8')
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def __decode_tile(self, payload, ty, tx):
+        tile_h, tile_w = self.tile_size
+        h = min(tile_h, self.height - ty * tile_h)
+        w = min(tile_w, self.width - tx * tile_w)
+        if self.compression > 0:
+            payload = zlib.decompress(payload)
+        return np.frombuffer(payload, dtype=self.dtype).reshape(h, w)
+
+    def read_window(self, miny, maxy, minx, maxx):
+        miny, maxy = max(int(miny), 0), min(int(maxy), self.height)
+        minx, maxx = max(int(minx), 0), min(int(maxx), self.width)
+        out = np.empty((max(maxy - miny, 0), max(maxx - minx, 0)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+
+        tile_h, tile_w = self.tile_size
+        tx0, tx1 = minx // tile_w, (maxx - 1) // tile_w
+        with open(self.path, 'rb') as fin:
+            for ty in range(miny // tile_h, (maxy - 1) // tile_h + 1):
+                # Tiles of a row are stored contiguously, so a row of the window is a single read.
+                first = ty * self.__tiles_x + tx0
+                last = ty * self.__tiles_x + tx1 + 1
+                fin.seek(int(self.__offsets[first]))
+                row_bytes = fin.read(int(self.__offsets[last] - self.__offsets[first]))
+                self.bytes_read += len(row_bytes)
+                for tx in range(tx0, tx1 + 1):
+                    start = int(self.__offsets[ty * self.__tiles_x + tx] - self.__offsets[first])
+                    end = int(self.__offsets[ty * self.__tiles_x + tx + 1] - self.__offsets[first])
+                    tile = self.__decode_tile(row_bytes[start:end], ty, tx)
+
+                    y0, x0 = ty * tile_h, tx * tile_w
+                    sy0, sy1 = max(miny - y0, 0), min(maxy - y0, tile.shape[0])
+                    sx0, sx1 = max(minx - x0, 0), min(maxx - x0, tile.shape[1])
+                    out[y0 + sy0 - miny: y0 + sy1 - miny, x0 + sx0 - minx: x0 + sx1 - minx] = tile[sy0:sy1, sx0:sx1]
+        return out
+
+    def read(self):
+        return self.read_window(0, self.height, 0, self.width)